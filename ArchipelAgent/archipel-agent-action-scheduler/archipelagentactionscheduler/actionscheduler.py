@@ -59,10 +59,12 @@ class TNActionScheduler (TNArchipelPlugin):
         self.supported_actions_for_vm = ("create", "shutdown", "destroy", "suspend", "resume", "reboot", "migrate", "pause")
         self.supported_actions_for_hypervisor = ("alloc", "free")
         # permissions
-        self.entity.permission_center.create_permission("scheduler_jobs", "Authorizes user to get the list of task", False)
-        self.entity.permission_center.create_permission("scheduler_schedule", "Authorizes user to schedule a task", False)
-        self.entity.permission_center.create_permission("scheduler_unschedule", "Authorizes user to unschedule a task", False)
-        self.entity.permission_center.create_permission("scheduler_actions", "Authorizes user to get available actions", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "scheduler_jobs", "description": "Authorizes user to get the list of task", "default": False},
+            {"name": "scheduler_schedule", "description": "Authorizes user to schedule a task", "default": False},
+            {"name": "scheduler_unschedule", "description": "Authorizes user to unschedule a task", "default": False},
+            {"name": "scheduler_actions", "description": "Authorizes user to get available actions", "default": False}
+        ])
         # hooks
         if self.entity.__class__.__name__ == "TNArchipelVirtualMachine":
             self.entity.register_hook("HOOK_VM_TERMINATE", method=self.vm_terminate)
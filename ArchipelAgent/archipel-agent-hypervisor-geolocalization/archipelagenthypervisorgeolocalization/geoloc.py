@@ -73,7 +73,9 @@ class TNHypervisorGeolocalization (TNArchipelPlugin):
                                 "description": "give my the latitude and longitude." }
             self.entity.add_message_registrar_item(registrar_item)
             # permissions
-            self.entity.permission_center.create_permission("geolocalization_get", "Authorizes user to get the entity location coordinates", False)
+            self.entity.permission_center.create_permissions([
+                {"name": "geolocalization_get", "description": "Authorizes user to get the entity location coordinates", "default": False}
+            ])
         except Exception as ex:
             self.plugin_deactivated = True;
             self.entity.log.error("Cannot initialize geolocalization. plugin deactivated. Exception: %s" % str(ex))
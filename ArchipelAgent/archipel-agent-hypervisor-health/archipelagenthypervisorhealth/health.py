@@ -57,9 +57,11 @@ class TNHypervisorHealth (TNArchipelPlugin):
         self.logfile = log_file
         self.collector.start()
         # permissions
-        self.entity.permission_center.create_permission("health_history", "Authorizes user to get the health history", False)
-        self.entity.permission_center.create_permission("health_info", "Authorizes user to get entity information", False)
-        self.entity.permission_center.create_permission("health_logs", "Authorizes user to get entity logs", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "health_history", "description": "Authorizes user to get the health history", "default": False},
+            {"name": "health_info", "description": "Authorizes user to get entity information", "default": False},
+            {"name": "health_logs", "description": "Authorizes user to get entity logs", "default": False}
+        ])
         registrar_items = [
                             {   "commands" : ["health"],
                                 "parameters": [{"name": "limit", "description": "Max number of returned entries. Equals 1 if ommited"}],
@@ -56,17 +56,21 @@ class TNHypervisorNetworks (TNArchipelPlugin):
         TNArchipelPlugin.__init__(self, configuration=configuration, entity=entity, entry_point_group=entry_point_group)
         # permissions
         if self.entity.__class__.__name__ == "TNArchipelVirtualMachine":
-            self.entity.permission_center.create_permission("network_getnames", "Authorizes user to get the existing network names", False)
-            self.entity.permission_center.create_permission("network_bridges", "Authorizes user to get existing bridges", False)
+            self.entity.permission_center.create_permissions([
+                {"name": "network_getnames", "description": "Authorizes user to get the existing network names", "default": False},
+                {"name": "network_bridges", "description": "Authorizes user to get existing bridges", "default": False}
+            ])
         elif self.entity.__class__.__name__ == "TNArchipelHypervisor":
-            self.entity.permission_center.create_permission("network_define", "Authorizes user to define a network", False)
-            self.entity.permission_center.create_permission("network_undefine", "Authorizes user to undefine a network", False)
-            self.entity.permission_center.create_permission("network_create", "Authorizes user to create (start) a network", False)
-            self.entity.permission_center.create_permission("network_destroy", "Authorizes user to destroy (stop) a network", False)
-            self.entity.permission_center.create_permission("network_get", "Authorizes user to get all networks informations", False)
-            self.entity.permission_center.create_permission("network_getnames", "Authorizes user to get the existing network names", False)
-            self.entity.permission_center.create_permission("network_bridges", "Authorizes user to get existing bridges", False)
-            self.entity.permission_center.create_permission("network_getnics", "Authorizes user to get existing network interfaces", False)
+            self.entity.permission_center.create_permissions([
+                {"name": "network_define", "description": "Authorizes user to define a network", "default": False},
+                {"name": "network_undefine", "description": "Authorizes user to undefine a network", "default": False},
+                {"name": "network_create", "description": "Authorizes user to create (start) a network", "default": False},
+                {"name": "network_destroy", "description": "Authorizes user to destroy (stop) a network", "default": False},
+                {"name": "network_get", "description": "Authorizes user to get all networks informations", "default": False},
+                {"name": "network_getnames", "description": "Authorizes user to get the existing network names", "default": False},
+                {"name": "network_bridges", "description": "Authorizes user to get existing bridges", "default": False},
+                {"name": "network_getnics", "description": "Authorizes user to get existing network interfaces", "default": False}
+            ])
             registrar_items = [
                                 {   "commands" : ["list networks"],
                                     "parameters": [],
@@ -51,7 +51,9 @@ class TNPlatformRequests (TNArchipelPlugin):
         # get eventual computing unit plugin
         self.load_computing_unit()
         # creates permissions
-        self.entity.permission_center.create_permission("platform_allocvm", "Authorizes user to send cross platform request", True)
+        self.entity.permission_center.create_permissions([
+            {"name": "platform_allocvm", "description": "Authorizes user to send cross platform request", "default": True}
+        ])
         # register to the node vmrequest
         self.entity.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.manage_platform_vm_request)
 
@@ -20,6 +20,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from archipelcore.archipelHookableEntity import ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET
 from archipelcore.archipelPlugin import TNArchipelPlugin
 
 import notifications
@@ -43,20 +44,20 @@ class AppNotificator (TNArchipelPlugin):
         for cred in creds.split(",,"):
             self.credentials.append(cred)
         if self.entity.__class__.__name__ == "TNArchipelVirtualMachine":
-            self.entity.register_hook("HOOK_VM_CREATE", method=self.vm_create)
-            self.entity.register_hook("HOOK_VM_SHUTOFF", method=self.vm_shutoff)
-            self.entity.register_hook("HOOK_VM_STOP", method=self.vm_stop)
-            self.entity.register_hook("HOOK_VM_DESTROY", method=self.vm_destroy)
-            self.entity.register_hook("HOOK_VM_SUSPEND", method=self.vm_suspend)
-            self.entity.register_hook("HOOK_VM_RESUME", method=self.vm_resume)
-            self.entity.register_hook("HOOK_VM_UNDEFINE", method=self.vm_undefine)
-            self.entity.register_hook("HOOK_VM_DEFINE", method=self.vm_define)
+            self.entity.register_hook("HOOK_VM_CREATE", method=self.vm_create, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_VM_SHUTOFF", method=self.vm_shutoff, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_VM_STOP", method=self.vm_stop, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_VM_DESTROY", method=self.vm_destroy, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_VM_SUSPEND", method=self.vm_suspend, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_VM_RESUME", method=self.vm_resume, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_VM_UNDEFINE", method=self.vm_undefine, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_VM_DEFINE", method=self.vm_define, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
         elif self.entity.__class__.__name__ == "TNArchipelHypervisor":
-            self.entity.register_hook("HOOK_HYPERVISOR_ALLOC", method=self.hypervisor_alloc)
-            self.entity.register_hook("HOOK_HYPERVISOR_FREE", method=self.hypervisor_free)
-            self.entity.register_hook("HOOK_HYPERVISOR_MIGRATEDVM_LEAVE", method=self.hypervisor_migrate_leave)
-            self.entity.register_hook("HOOK_HYPERVISOR_MIGRATEDVM_ARRIVE", method=self.hypervisor_migrate_arrive)
-            self.entity.register_hook("HOOK_HYPERVISOR_CLONE", method=self.hypervisor_clone)
+            self.entity.register_hook("HOOK_HYPERVISOR_ALLOC", method=self.hypervisor_alloc, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_HYPERVISOR_FREE", method=self.hypervisor_free, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_HYPERVISOR_MIGRATEDVM_LEAVE", method=self.hypervisor_migrate_leave, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_HYPERVISOR_MIGRATEDVM_ARRIVE", method=self.hypervisor_migrate_arrive, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
+            self.entity.register_hook("HOOK_HYPERVISOR_CLONE", method=self.hypervisor_clone, mode=ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET)
 
 
     ### Plugin interface
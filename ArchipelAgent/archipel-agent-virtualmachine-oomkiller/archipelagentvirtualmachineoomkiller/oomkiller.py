@@ -52,8 +52,10 @@ class TNOOMKiller (TNArchipelPlugin):
         self.cursor = self.database.cursor()
         self.entity.log.info("module oom killer initialized")
         # permissions
-        self.entity.permission_center.create_permission("oom_getadjust", "Authorizes user to get OOM values", False)
-        self.entity.permission_center.create_permission("oom_setadjust", "Authorizes user to set OOM values", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "oom_getadjust", "description": "Authorizes user to get OOM values", "default": False},
+            {"name": "oom_setadjust", "description": "Authorizes user to set OOM values", "default": False}
+        ])
 
     ### Module implementation
 
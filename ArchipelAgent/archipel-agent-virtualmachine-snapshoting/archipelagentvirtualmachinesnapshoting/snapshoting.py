@@ -53,11 +53,13 @@ class TNSnapshoting (TNArchipelPlugin):
         """
         TNArchipelPlugin.__init__(self, configuration=configuration, entity=entity, entry_point_group=entry_point_group)
         # permissions
-        self.entity.permission_center.create_permission("snapshot_take", "Authorizes user to get take a snapshot", False)
-        self.entity.permission_center.create_permission("snapshot_delete", "Authorizes user to delete a snapshot", False)
-        self.entity.permission_center.create_permission("snapshot_get", "Authorizes user to get all snapshots", False)
-        self.entity.permission_center.create_permission("snapshot_current", "Authorizes user to get current used snapshot", False)
-        self.entity.permission_center.create_permission("snapshot_revert", "Authorizes user to revert to a snapshot", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "snapshot_take", "description": "Authorizes user to get take a snapshot", "default": False},
+            {"name": "snapshot_delete", "description": "Authorizes user to delete a snapshot", "default": False},
+            {"name": "snapshot_get", "description": "Authorizes user to get all snapshots", "default": False},
+            {"name": "snapshot_current", "description": "Authorizes user to get current used snapshot", "default": False},
+            {"name": "snapshot_revert", "description": "Authorizes user to revert to a snapshot", "default": False}
+        ])
 
     ### Plugin interface
 
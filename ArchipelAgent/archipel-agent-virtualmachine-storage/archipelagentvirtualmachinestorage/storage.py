@@ -62,12 +62,14 @@ class TNStorageManagement (TNArchipelPlugin):
         if not os.path.exists(self.shared_isos_folder):
             os.makedirs(self.shared_isos_folder)
         # permissions
-        self.entity.permission_center.create_permission("drives_create", "Authorizes user to get create a drive", False)
-        self.entity.permission_center.create_permission("drives_delete", "Authorizes user to delete a drive", False)
-        self.entity.permission_center.create_permission("drives_get", "Authorizes user to get all drives", False)
-        self.entity.permission_center.create_permission("drives_getiso", "Authorizes user to get existing ISO images", False)
-        self.entity.permission_center.create_permission("drives_convert", "Authorizes user to convert a drive", False)
-        self.entity.permission_center.create_permission("drives_rename", "Authorizes user to rename a drive", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "drives_create", "description": "Authorizes user to get create a drive", "default": False},
+            {"name": "drives_delete", "description": "Authorizes user to delete a drive", "default": False},
+            {"name": "drives_get", "description": "Authorizes user to get all drives", "default": False},
+            {"name": "drives_getiso", "description": "Authorizes user to get existing ISO images", "default": False},
+            {"name": "drives_convert", "description": "Authorizes user to convert a drive", "default": False},
+            {"name": "drives_rename", "description": "Authorizes user to rename a drive", "default": False}
+        ])
 
 
     ### Plugin interface
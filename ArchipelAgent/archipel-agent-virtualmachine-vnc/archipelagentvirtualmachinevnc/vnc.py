@@ -55,7 +55,9 @@ class TNArchipelVNC (TNArchipelPlugin):
                             "description": "I'll show my VNC port" }
         self.entity.add_message_registrar_item(registrar_item)
         # permissions
-        self.entity.permission_center.create_permission("vnc_display", "Authorizes users to access the vnc display port", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "vnc_display", "description": "Authorizes users to access the vnc display port", "default": False}
+        ])
         # hooks
         self.entity.register_hook("HOOK_VM_CREATE", method=self.create_novnc_proxy)
         self.entity.register_hook("HOOK_VM_CRASH", method=self.stop_novnc_proxy)
@@ -175,14 +175,16 @@ class TNHypervisorRepoManager (TNArchipelPlugin):
         self.cursor.execute("create table if not exists vmcastappliances (name text, description text, url text, uuid text unique not null, status int, source text not null, save_path text)")
         self.entity.log.info("TNHypervisorRepoManager: Database ready.")
         # permissions
-        self.entity.permission_center.create_permission("vmcasting_get", "Authorizes user to get registered VMCast feeds", False)
-        self.entity.permission_center.create_permission("vmcasting_register", "Authorizes user to register to a VMCast feed", False)
-        self.entity.permission_center.create_permission("vmcasting_unregister", "Authorizes user to unregister from a VMCast feed", False)
-        self.entity.permission_center.create_permission("vmcasting_downloadappliance", "Authorizes user to download an appliance from a feed", False)
-        self.entity.permission_center.create_permission("vmcasting_downloadqueue", "Authorizes user to see the download queue", False)
-        self.entity.permission_center.create_permission("vmcasting_getappliances", "Authorizes user to get all availables appliances", False)
-        self.entity.permission_center.create_permission("vmcasting_deleteappliance", "Authorizes user to delete an installed appliance", False)
-        self.entity.permission_center.create_permission("vmcasting_getinstalledappliances", "Authorizes user to get all installed appliances", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "vmcasting_get", "description": "Authorizes user to get registered VMCast feeds", "default": False},
+            {"name": "vmcasting_register", "description": "Authorizes user to register to a VMCast feed", "default": False},
+            {"name": "vmcasting_unregister", "description": "Authorizes user to unregister from a VMCast feed", "default": False},
+            {"name": "vmcasting_downloadappliance", "description": "Authorizes user to download an appliance from a feed", "default": False},
+            {"name": "vmcasting_downloadqueue", "description": "Authorizes user to see the download queue", "default": False},
+            {"name": "vmcasting_getappliances", "description": "Authorizes user to get all availables appliances", "default": False},
+            {"name": "vmcasting_deleteappliance", "description": "Authorizes user to delete an installed appliance", "default": False},
+            {"name": "vmcasting_getinstalledappliances", "description": "Authorizes user to get all installed appliances", "default": False}
+        ])
 
 
     ### Plugin interface
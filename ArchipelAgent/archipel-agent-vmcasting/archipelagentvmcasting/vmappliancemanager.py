@@ -67,10 +67,12 @@ class TNVMApplianceManager (TNArchipelPlugin):
         self.database_connection = sqlite3.connect(self.configuration.get("VMCASTING", "vmcasting_database_path"), check_same_thread = False)
         self.cursor = self.database_connection.cursor()
         # permissions
-        self.entity.permission_center.create_permission("appliance_get", "Authorizes user to get installed appliances", False)
-        self.entity.permission_center.create_permission("appliance_attach", "Authorizes user attach appliance to virtual machine", False)
-        self.entity.permission_center.create_permission("appliance_detach", "Authorizes user to detach appliance_detach from virtual machine", False)
-        self.entity.permission_center.create_permission("appliance_package", "Authorizes user to package new appliance from virtual machine", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "appliance_get", "description": "Authorizes user to get installed appliances", "default": False},
+            {"name": "appliance_attach", "description": "Authorizes user attach appliance to virtual machine", "default": False},
+            {"name": "appliance_detach", "description": "Authorizes user to detach appliance_detach from virtual machine", "default": False},
+            {"name": "appliance_package", "description": "Authorizes user to package new appliance from virtual machine", "default": False}
+        ])
 
 
     ### Plugin interface
@@ -61,14 +61,16 @@ class TNXMPPServerController (TNArchipelPlugin):
         self.xmlrpc_server      = xmlrpclib.ServerProxy(self.xmlrpc_call)
 
         # permissions
-        self.entity.permission_center.create_permission("xmppserver_groups_create", "Authorizes user to create shared groups", False)
-        self.entity.permission_center.create_permission("xmppserver_groups_delete", "Authorizes user to delete shared groups", False)
-        self.entity.permission_center.create_permission("xmppserver_groups_list", "Authorizes user to list shared groups", False)
-        self.entity.permission_center.create_permission("xmppserver_groups_addusers", "Authorizes user to add users in shared groups", False)
-        self.entity.permission_center.create_permission("xmppserver_groups_deleteusers", "Authorizes user to remove users from shared groups", False)
-        self.entity.permission_center.create_permission("xmppserver_users_register", "Authorizes user to register XMPP users", False)
-        self.entity.permission_center.create_permission("xmppserver_users_unregister", "Authorizes user to unregister XMPP users", False)
-        self.entity.permission_center.create_permission("xmppserver_users_list", "Authorizes user to list XMPP users", False)
+        self.entity.permission_center.create_permissions([
+            {"name": "xmppserver_groups_create", "description": "Authorizes user to create shared groups", "default": False},
+            {"name": "xmppserver_groups_delete", "description": "Authorizes user to delete shared groups", "default": False},
+            {"name": "xmppserver_groups_list", "description": "Authorizes user to list shared groups", "default": False},
+            {"name": "xmppserver_groups_addusers", "description": "Authorizes user to add users in shared groups", "default": False},
+            {"name": "xmppserver_groups_deleteusers", "description": "Authorizes user to remove users from shared groups", "default": False},
+            {"name": "xmppserver_users_register", "description": "Authorizes user to register XMPP users", "default": False},
+            {"name": "xmppserver_users_unregister", "description": "Authorizes user to unregister XMPP users", "default": False},
+            {"name": "xmppserver_users_list", "description": "Authorizes user to list XMPP users", "default": False}
+        ])
 
 
     ### Plugin interface
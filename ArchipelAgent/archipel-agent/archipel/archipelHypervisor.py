@@ -28,19 +28,23 @@ This provides the possibility to instanciate TNArchipelVirtualMachines
 import datetime
 import libvirt
 import random
-import sqlite3
 import string
+import time
 import uuid as moduuid
 import xmpp
-from threading import Thread
+from multiprocessing.pool import ThreadPool
+from threading import Lock, RLock, Thread, Timer
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
-from archipelcore.archipelEntity import TNArchipelEntity
+from archipelcore.archipelComponentTransport import TNArchipelComponentTransport, ARCHIPEL_COMPONENT_DEFAULT_PORT
+from archipelcore.archipelEntity import TNArchipelEntity, ARCHIPEL_NS_IQ_PUSH, ARCHIPEL_XMPP_LOOP_RESTART
 from archipelcore.archipelHookableEntity import TNHookableEntity
-from archipelcore.archipelPermissionCenter import TNArchipelPermissionCenter
+from archipelcore.archipelPermissionCenter import TNArchipelPermissionCenter, TNArchipelSharedPermissionStore
+from archipelcore.archipelReactor import TNArchipelReactor
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
-from archipelcore.utils import build_error_iq, build_error_message
+from archipelcore.utils import TNArchipelRateLimiter, build_error_iq, build_error_message
 
+from archipelHypervisorDatabase import TNArchipelHypervisorDatabase
 from archipelLibvirtEntity import ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR
 from archipelVirtualMachine import TNArchipelVirtualMachine
 import archipelLibvirtEntity
@@ -68,6 +72,12 @@ ARCHIPEL_XMPP_GROUP_VM                          = "virtualmachines"
 ARCHIPEL_XMPP_GROUP_HYPERVISOR                  = "hypervisors"
 ARCHIPEL_XMPP_GROUP_CONTROLLER                  = "controllers"
 
+# Bulk allocation
+ARCHIPEL_HYPERVISOR_ALLOC_MAX_COUNT             = 1000
+ARCHIPEL_HYPERVISOR_ALLOC_TIMEOUT               = 300
+ARCHIPEL_ALLOC_STATUS_READY                     = "ready"
+ARCHIPEL_ALLOC_STATUS_FAILED                    = "failed"
+
 
 class TNThreadedVirtualMachine (Thread):
     """
@@ -75,7 +85,7 @@ class TNThreadedVirtualMachine (Thread):
     in a thread.
     """
 
-    def __init__(self, jid, password, hypervisor, configuration, name):
+    def __init__(self, jid, password, hypervisor, configuration, name, xmpp_transport=None, xmpp_reactor=None):
         """
         The contructor of the class.
         @type jid: string
@@ -86,11 +96,19 @@ class TNThreadedVirtualMachine (Thread):
         @param hypervisor: the hypervisor of the VM
         @type name: string
         @param name: the name of the VM
+        @type xmpp_transport: L{TNArchipelComponentTransport}
+        @param xmpp_transport: if given, the VM will use this shared transport instead of its own connection
+        @type xmpp_reactor: L{TNArchipelReactor}
+        @param xmpp_reactor: if given, the VM connection will be processed by this reactor instead of its own loop
         """
         Thread.__init__(self)
         self.jid = jid
         self.password = password
         self.xmppvm = TNArchipelVirtualMachine(self.jid, self.password, hypervisor, configuration, name)
+        self.xmppvm.xmpp_transport = xmpp_transport
+        self.xmppvm.xmpp_reactor = xmpp_reactor
+        self.startup_limiter = None
+        self.startup_callback = None
 
     def get_instance(self):
         """
@@ -103,11 +121,272 @@ class TNThreadedVirtualMachine (Thread):
     def run(self):
         """
         Overiddes sur super class method. Do the L{TNArchipelVirtualMachine} main loop.
-        """
-        self.xmppvm.connect()
+        If a startup limiter is set, wait for it before connecting. The startup
+        callback is called with the result of the connection, or the exception
+        that made it fail.
+        """
+        if not self.startup_limiter:
+            self.xmppvm.connect()
+            self.xmppvm.loop()
+            return
+        connected = False
+        error = None
+        self.startup_limiter.acquire()
+        start_time = time.time()
+        try:
+            try:
+                connected = self.xmppvm.connect()
+            except (Exception, SystemExit) as ex:
+                error = ex
+        finally:
+            self.startup_limiter.release()
+        if self.startup_callback:
+            self.startup_callback(self.xmppvm, time.time() - start_time, connected, error)
+        if error:
+            self.xmppvm.log.error("Unable to connect: %s" % str(error))
+            return
         self.xmppvm.loop()
 
 
+class TNArchipelVirtualMachineRegistry (object):
+    """
+    This class holds the virtual machines of the hypervisor. It maintains
+    indexes by UUID, bare JID and name, so lookups and counts don't need
+    to scan every virtual machine. It can be used from several threads:
+    names of virtual machines being allocated are reserved, so two
+    allocations can't use the same name.
+    """
+
+    def __init__(self):
+        """
+        Initialize the registry.
+        """
+        self.lock           = RLock()
+        self.vms_by_uuid    = {}
+        self.vms_by_jid     = {}
+        self.vms_by_name    = {}
+        self.reserved_names = set()
+
+    ### Updates
+
+    def add(self, vm, uuid=None):
+        """
+        Add a virtual machine to the registry. If a virtual machine with the
+        same UUID is already registered, it is replaced.
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine to add
+        @type uuid: string
+        @param uuid: the UUID of the virtual machine (default: the node of its JID)
+        """
+        uuid = (uuid or vm.jid.getNode()).lower()
+        self.lock.acquire()
+        try:
+            self.reserved_names.discard(vm.name.upper())
+            self._remove(uuid)
+            self.vms_by_uuid[uuid] = vm
+            self.vms_by_jid[vm.jid.getStripped().lower()] = vm
+            self.vms_by_name.setdefault(vm.name.upper(), {})[uuid] = vm
+        finally:
+            self.lock.release()
+
+    def reserve_name(self, name):
+        """
+        Reserve a name for a virtual machine being allocated, if no other
+        virtual machine uses or reserved it. The reservation ends when the
+        virtual machine is added, or when the name is released.
+        @type name: string
+        @param name: the name to reserve
+        @rtype: Boolean
+        @return: True if the name has been reserved, False if it is taken
+        """
+        name = name.upper()
+        self.lock.acquire()
+        try:
+            if name in self.vms_by_name or name in self.reserved_names:
+                return False
+            self.reserved_names.add(name)
+            return True
+        finally:
+            self.lock.release()
+
+    def release_name(self, name):
+        """
+        Release a reserved name.
+        @type name: string
+        @param name: the reserved name
+        """
+        self.lock.acquire()
+        try:
+            self.reserved_names.discard(name.upper())
+        finally:
+            self.lock.release()
+
+    def remove(self, uuid):
+        """
+        Remove a virtual machine from the registry.
+        @type uuid: string
+        @param uuid: the UUID of the virtual machine to remove
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the removed virtual machine or None
+        """
+        self.lock.acquire()
+        try:
+            return self._remove(uuid.lower())
+        finally:
+            self.lock.release()
+
+    def _remove(self, uuid):
+        vm = self.vms_by_uuid.pop(uuid, None)
+        if not vm:
+            return None
+        self.vms_by_jid.pop(vm.jid.getStripped().lower(), None)
+        name = vm.name.upper()
+        homonyms = self.vms_by_name.get(name, {})
+        homonyms.pop(uuid, None)
+        if not homonyms:
+            self.vms_by_name.pop(name, None)
+        return vm
+
+    ### Lookups
+
+    def get_by_uuid(self, uuid):
+        """
+        Return the virtual machine with the given UUID.
+        @type uuid: string
+        @param uuid: the UUID of the virtual machine
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the virtual machine or None
+        """
+        return self.vms_by_uuid.get(uuid.lower())
+
+    def get_by_jid(self, jid):
+        """
+        Return the virtual machine with the given JID. The resource is ignored.
+        @type jid: xmpp.JID or string
+        @param jid: the JID of the virtual machine
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the virtual machine or None
+        """
+        return self.vms_by_jid.get(xmpp.JID(jid).getStripped().lower())
+
+    def get_by_name(self, name):
+        """
+        Return a virtual machine with the given name. Names are case insensitive.
+        @type name: string
+        @param name: the name of the virtual machine
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the virtual machine or None
+        """
+        self.lock.acquire()
+        try:
+            homonyms = self.vms_by_name.get(name.upper())
+            if not homonyms:
+                return None
+            return homonyms.itervalues().next()
+        finally:
+            self.lock.release()
+
+    def values(self):
+        """
+        Return a snapshot of the registered virtual machines.
+        @rtype: list
+        @return: list of L{TNArchipelVirtualMachine}
+        """
+        self.lock.acquire()
+        try:
+            return self.vms_by_uuid.values()
+        finally:
+            self.lock.release()
+
+    def iteritems(self):
+        """
+        Iterate over a snapshot of the (uuid, virtual machine) pairs.
+        """
+        self.lock.acquire()
+        try:
+            items = self.vms_by_uuid.items()
+        finally:
+            self.lock.release()
+        return iter(items)
+
+    def get_stats(self):
+        """
+        Return the sizes of the indexes.
+        @rtype: dict
+        @return: dict containing the number of virtual machines, JIDs and distinct names
+        """
+        return {"virtualmachines": len(self.vms_by_uuid), "jids": len(self.vms_by_jid), "names": len(self.vms_by_name), "reserved_names": len(self.reserved_names)}
+
+    def __len__(self):
+        return len(self.vms_by_uuid)
+
+    def __contains__(self, uuid):
+        return uuid.lower() in self.vms_by_uuid
+
+    def __getitem__(self, uuid):
+        return self.vms_by_uuid[uuid.lower()]
+
+    def __iter__(self):
+        return iter(self.vms_by_uuid.keys())
+
+
+class TNArchipelBulkAllocation (object):
+    """
+    This class follows the virtual machines of a bulk allocation until
+    they are all connected or failed.
+    """
+
+    def __init__(self, jids):
+        """
+        Initialize the allocation.
+        @type jids: list
+        @param jids: the bare JIDs of the allocated virtual machines
+        """
+        self.identifier = str(moduuid.uuid1())
+        self.jids       = jids
+        self.total      = len(jids)
+        self.statuses   = {}
+        self.counts     = {ARCHIPEL_ALLOC_STATUS_READY: 0, ARCHIPEL_ALLOC_STATUS_FAILED: 0}
+        self.start_time = time.time()
+        self.lock       = Lock()
+
+    def update(self, jid, status):
+        """
+        Set the status of a virtual machine. A failed virtual machine
+        can become ready later, if its connection is retried.
+        @type jid: string
+        @param jid: the bare JID of the virtual machine
+        @type status: string
+        @param status: the new status (ready or failed)
+        @rtype: dict
+        @return: the counts of ready and failed virtual machines, or None if the status didn't change
+        """
+        self.lock.acquire()
+        try:
+            previous = self.statuses.get(jid)
+            if previous == status or previous == ARCHIPEL_ALLOC_STATUS_READY:
+                return None
+            if previous:
+                self.counts[previous] -= 1
+            self.statuses[jid] = status
+            self.counts[status] += 1
+            return dict(self.counts)
+        finally:
+            self.lock.release()
+
+    def get_pending_jids(self):
+        """
+        Return the virtual machines without status yet.
+        @rtype: list
+        @return: the list of bare JIDs
+        """
+        self.lock.acquire()
+        try:
+            return [jid for jid in self.jids if not jid in self.statuses]
+        finally:
+            self.lock.release()
+
+
 class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLibvirtEntity, TNHookableEntity, TNAvatarControllableEntity, TNTaggableEntity):
     """
     This class represents an Hypervisor XMPP Capable. This is an XMPP client
@@ -130,16 +409,25 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         TNArchipelEntity.__init__(self, jid, password, configuration, name)
         archipelLibvirtEntity.TNArchipelLibvirtEntity.__init__(self, configuration)
 
-        self.virtualmachines            = {}
+        self.virtualmachines            = TNArchipelVirtualMachineRegistry()
         self.database_file              = database_file
         self.xmppserveraddr             = self.jid.getDomain()
         self.entity_type                = "hypervisor"
         self.default_avatar             = self.configuration.get("HYPERVISOR", "hypervisor_default_avatar")
-        self.libvirt_event_callback_id  = None
+        self.libvirt_event_dispatcher   = None
+        self.migration_index            = {}
 
         # libvirt connection
         self.connect_libvirt()
 
+        # shared libvirt connections for virtual machines
+        self.libvirt_connection_pool_for_vms = None
+        if self.configuration.has_option("VIRTUALMACHINE", "vm_libvirt_connection_pool_size"):
+            pool_size = self.configuration.getint("VIRTUALMACHINE", "vm_libvirt_connection_pool_size")
+            if pool_size > 0:
+                self.libvirt_connection_pool_for_vms = archipelLibvirtEntity.TNArchipelLibvirtConnectionPool(self, pool_size)
+                self.log.info("Virtual machines will share %d libvirt connection(s)" % pool_size)
+
         self.vcard_infos                = {}
         if (self.configuration.has_section("VCARD")):
             for key in ("orgname", "userid", "locality", "url"):
@@ -153,6 +441,25 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.permission_center          = TNArchipelPermissionCenter(permission_db_file, permission_admin_names)
         self.init_permissions()
 
+        # shared permission store for virtual machines
+        self.permission_store           = None
+        if self.configuration.has_option("VIRTUALMACHINE", "vm_permissions_shared_database_path"):
+            shared_permission_db_file   = self.configuration.get("VIRTUALMACHINE", "vm_permissions_shared_database_path")
+            self.permission_store       = TNArchipelSharedPermissionStore(shared_permission_db_file)
+            self.log.info("Virtual machines permissions will be stored in shared database %s" % shared_permission_db_file)
+
+        # shared XMPP transport for virtual machines
+        self.xmpp_transport             = None
+        if self.configuration.has_option("VIRTUALMACHINE", "xmpp_component_domain"):
+            self.xmpp_transport         = self.create_xmpp_transport()
+
+        # XMPP reactor for virtual machines using their own connection
+        self.xmpp_reactor               = None
+        if self.configuration.has_option("VIRTUALMACHINE", "xmpp_use_reactor") and self.configuration.getboolean("VIRTUALMACHINE", "xmpp_use_reactor"):
+            self.xmpp_reactor           = TNArchipelReactor()
+            self.xmpp_reactor.start()
+            self.log.info("Virtual machines XMPP connections will be processed by a single reactor")
+
         names_file = open(self.configuration.get("HYPERVISOR", "name_generation_file"), 'r')
         self.generated_names = names_file.readlines()
         names_file.close()
@@ -176,7 +483,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
 
         if self.is_hypervisor((archipelLibvirtEntity.ARCHIPEL_HYPERVISOR_TYPE_QEMU, archipelLibvirtEntity.ARCHIPEL_HYPERVISOR_TYPE_XEN)):
             try:
-                self.libvirt_event_callback_id = self.libvirt_connection.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.hypervisor_on_domain_event, None)
+                self.libvirt_event_dispatcher = archipelLibvirtEntity.TNArchipelLibvirtEventDispatcher(self.libvirt_connection, self.hypervisor_on_domain_event)
             except libvirt.libvirtError:
                 self.log.error("We are sorry. But your hypervisor doesn't support libvirt virConnectDomainEventRegisterAny. And this really bad. I'm sooo sorry")
         else:
@@ -269,13 +576,15 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         Initialize the permissions.
         """
         TNArchipelEntity.init_permissions(self)
-        self.permission_center.create_permission("alloc", "Authorizes users to allocate new virtual machines", False)
-        self.permission_center.create_permission("free", "Authorizes users to free allocated virtual machines", False)
-        self.permission_center.create_permission("rostervm", "Authorizes users to access the hypervisor's roster", False)
-        self.permission_center.create_permission("clone", "Authorizes users to clone virtual machines", False)
-        self.permission_center.create_permission("ip", "Authorizes users to get hypervisor's IP address", False)
-        self.permission_center.create_permission("uri", "Authorizes users to get the hypervisor's libvirt URI", False)
-        self.permission_center.create_permission("capabilities", "Authorizes users to access the hypervisor capabilities", False)
+        self.permission_center.create_permissions([
+            {"name": "alloc", "description": "Authorizes users to allocate new virtual machines", "default": False},
+            {"name": "free", "description": "Authorizes users to free allocated virtual machines", "default": False},
+            {"name": "rostervm", "description": "Authorizes users to access the hypervisor's roster", "default": False},
+            {"name": "clone", "description": "Authorizes users to clone virtual machines", "default": False},
+            {"name": "ip", "description": "Authorizes users to get hypervisor's IP address", "default": False},
+            {"name": "uri", "description": "Authorizes users to get the hypervisor's libvirt URI", "default": False},
+            {"name": "capabilities", "description": "Authorizes users to access the hypervisor capabilities", "default": False}
+        ])
 
     def manage_persistance(self):
         """
@@ -283,23 +592,179 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         this method will recreate all the old L{TNArchipelVirtualMachine}. If not, it will create a
         blank database file.
         """
+        journal_mode    = "wal"
+        synchronous     = "full"
+        commit_delay    = 0.0
+        if self.configuration.has_option("HYPERVISOR", "hypervisor_database_journal_mode"):
+            journal_mode = self.configuration.get("HYPERVISOR", "hypervisor_database_journal_mode")
+        if self.configuration.has_option("HYPERVISOR", "hypervisor_database_synchronous"):
+            synchronous = self.configuration.get("HYPERVISOR", "hypervisor_database_synchronous")
+        if self.configuration.has_option("HYPERVISOR", "hypervisor_database_commit_delay"):
+            commit_delay = self.configuration.getfloat("HYPERVISOR", "hypervisor_database_commit_delay")
         self.log.info("opening database file %s" % self.database_file)
-        self.database = sqlite3.connect(self.database_file, check_same_thread=False)
-        self.log.info("Populating database if not exists.")
-        self.database.execute("create table if not exists virtualmachines (jid text, password text, creation_date date, comment text, name text)")
-        c = self.database.cursor()
-        c.execute("select * from virtualmachines")
-        for vm in c:
-            string_jid, password, date, comment, name = vm
+        startup_time = time.time()
+        self.database = TNArchipelHypervisorDatabase(self.database_file, journal_mode, synchronous, commit_delay, log=self.log)
+        rows = self.database.get_virtual_machines()
+        self.startup_progress = {"total": len(rows), "constructed": 0, "connected": 0, "failed": 0}
+        self.startup_timings = {"database": time.time() - startup_time, "construction": 0.0, "connection": 0.0, "connection_average": 0.0}
+        self.startup_lock = Lock()
+        self.startup_start_time = startup_time
+        if not rows:
+            return
+
+        workers = self.get_startup_workers()
+        self.log.info("STARTUP: constructing %d virtual machines with %d workers" % (len(rows), workers))
+        construction_time = time.time()
+        pool = ThreadPool(workers)
+        try:
+            vm_threads = pool.map(self.create_persisted_vm, rows)
+        finally:
+            pool.close()
+            pool.join()
+        self.startup_timings["construction"] = time.time() - construction_time
+        self.log.info("STARTUP: %d virtual machines constructed in %.2fs" % (self.startup_progress["constructed"], self.startup_timings["construction"]))
+
+        self.startup_connection_time = time.time()
+        limiter = self.create_startup_limiter()
+        for vm_thread in vm_threads:
+            if not vm_thread:
+                continue
+            self.virtualmachines.add(vm_thread.get_instance())
+            vm_thread.startup_limiter = limiter
+            vm_thread.startup_callback = self.on_persisted_vm_connected
+            vm_thread.start()
+
+    def get_startup_workers(self):
+        """
+        Return the number of threads used to construct several virtual
+        machines, according to VIRTUALMACHINE:vm_startup_workers.
+        @rtype: integer
+        @return: the number of workers
+        """
+        workers = 4
+        if self.configuration.has_option("VIRTUALMACHINE", "vm_startup_workers"):
+            workers = self.configuration.getint("VIRTUALMACHINE", "vm_startup_workers")
+        return max(1, workers)
+
+    def create_startup_limiter(self):
+        """
+        Create the limiter used to connect several new virtual machines,
+        according to VIRTUALMACHINE:vm_startup_rate and VIRTUALMACHINE:vm_startup_concurrency.
+        @rtype: L{TNArchipelRateLimiter}
+        @return: the limiter
+        """
+        rate        = 10.0
+        concurrency = 10
+        if self.configuration.has_option("VIRTUALMACHINE", "vm_startup_rate"):
+            rate = self.configuration.getfloat("VIRTUALMACHINE", "vm_startup_rate")
+        if self.configuration.has_option("VIRTUALMACHINE", "vm_startup_concurrency"):
+            concurrency = self.configuration.getint("VIRTUALMACHINE", "vm_startup_concurrency")
+        return TNArchipelRateLimiter(rate=rate, burst=concurrency, concurrency=concurrency)
+
+    def create_persisted_vm(self, row):
+        """
+        Construct the threaded virtual machine of a row of the database.
+        This is run by the startup worker pool.
+        @type row: tuple
+        @param row: the row of the virtualmachines table
+        @rtype: L{TNThreadedVirtualMachine}
+        @return: the L{TNThreadedVirtualMachine} or None in case of error
+        """
+        string_jid, password, date, comment, name = row
+        try:
             jid = xmpp.JID(string_jid)
             jid.setResource(self.jid.getNode())
             vm_thread = self.create_threaded_vm(jid, password, name)
-            self.virtualmachines[vm_thread.jid.getNode()] = vm_thread.get_instance()
-            vm_thread.start()
+        except Exception as ex:
+            self.log.error("STARTUP: unable to construct virtual machine %s: %s" % (string_jid, str(ex)))
+            self.update_startup_progress("failed")
+            return None
+        self.update_startup_progress("constructed")
+        return vm_thread
+
+    def on_persisted_vm_connected(self, vm, duration, connected, error):
+        """
+        Called by a persisted virtual machine thread when its connection is done.
+        Only successful connections are counted in the average connection time.
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine
+        @type duration: float
+        @param duration: the time spent connecting
+        @type connected: Boolean
+        @param connected: True if the virtual machine is connected
+        @type error: Exception
+        @param error: the exception raised while connecting, if any
+        """
+        if error or not connected:
+            self.update_startup_progress("failed", connection=True)
+            return
+        self.startup_lock.acquire()
+        try:
+            self.startup_timings["connection_average"] += duration
+        finally:
+            self.startup_lock.release()
+        self.update_startup_progress("connected", connection=True)
+
+    def update_startup_progress(self, counter, connection=False):
+        """
+        Increment a startup counter and log the progress.
+        @type counter: string
+        @param counter: the counter to increment (constructed, connected or failed)
+        @type connection: Boolean
+        @param connection: True if the counter is updated by the connection of a virtual machine
+        """
+        self.startup_lock.acquire()
+        try:
+            progress = self.startup_progress
+            progress[counter] += 1
+            total = progress["total"]
+            step = max(1, total / 10)
+            if not connection:
+                if progress["constructed"] % step == 0:
+                    self.log.info("STARTUP: constructed %d/%d virtual machines (%d failed)" % (progress["constructed"], total, progress["failed"]))
+                return
+            if (progress["connected"] + progress["failed"]) % step == 0:
+                self.log.info("STARTUP: connected %d/%d virtual machines (%d failed)" % (progress["connected"], total, progress["failed"]))
+            if progress["connected"] + progress["failed"] < total:
+                return
+            timings = self.startup_timings
+            timings["connection"] = time.time() - self.startup_connection_time
+            timings["connection_average"] /= max(1, progress["connected"])
+        finally:
+            self.startup_lock.release()
+        self.log.info("STARTUP: all virtual machines started in %.2fs (database: %.2fs, construction: %.2fs, connection: %.2fs, average connection: %.2fs, failed: %d)"
+                        % (time.time() - self.startup_start_time, timings["database"], timings["construction"], timings["connection"], timings["connection_average"], progress["failed"]))
+
+    def create_xmpp_transport(self):
+        """
+        Create, connect and start the XEP-0114 component used by the virtual
+        machines of the component domain.
+        @rtype: L{TNArchipelComponentTransport}
+        @return: the started transport
+        """
+        domain          = self.configuration.get("VIRTUALMACHINE", "xmpp_component_domain")
+        secret          = self.configuration.get("VIRTUALMACHINE", "xmpp_component_secret")
+        server          = self.xmppserveraddr
+        port            = ARCHIPEL_COMPONENT_DEFAULT_PORT
+        roster_db_file  = None
+        debug           = self.configuration.has_option("LOGGING", "xmpppy_debug") and self.configuration.getboolean("LOGGING", "xmpppy_debug")
+        if self.configuration.has_option("VIRTUALMACHINE", "xmpp_component_server"):
+            server = self.configuration.get("VIRTUALMACHINE", "xmpp_component_server")
+        if self.configuration.has_option("VIRTUALMACHINE", "xmpp_component_port"):
+            port = self.configuration.getint("VIRTUALMACHINE", "xmpp_component_port")
+        if self.configuration.has_option("VIRTUALMACHINE", "xmpp_component_roster_database_path"):
+            roster_db_file = self.configuration.get("VIRTUALMACHINE", "xmpp_component_roster_database_path")
+        transport = TNArchipelComponentTransport(domain, secret, server, port, roster_db_file, debug)
+        transport.connect()
+        transport.start()
+        self.log.info("New virtual machines will use the XMPP component %s" % domain)
+        return transport
 
     def create_threaded_vm(self, jid, password, name):
         """
         This method creates a threaded L{TNArchipelVirtualMachine}, starts it and returns the Thread instance.
+        If the JID belongs to the XMPP component domain, the VM will use the shared transport,
+        otherwise its connection is processed by the reactor if any.
         @type jid: string
         @param jid: the JID of the L{TNArchipelVirtualMachine}
         @type password: string
@@ -307,22 +772,54 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @rtype: L{TNThreadedVirtualMachine}
         @return: a L{TNThreadedVirtualMachine} instance of the virtual machine
         """
-        return TNThreadedVirtualMachine(jid, password, self, self.configuration, name)
+        xmpp_transport = None
+        if self.xmpp_transport and jid.getDomain() == self.xmpp_transport.domain:
+            xmpp_transport = self.xmpp_transport
+        return TNThreadedVirtualMachine(jid, password, self, self.configuration, name, xmpp_transport, self.xmpp_reactor)
 
-    def generate_name(self):
+    def generate_name(self, reserve=True):
         """
         Get a random name from the names file.
+        @type reserve: Boolean
+        @param reserve: if True, the name is reserved for a new virtual machine
         @rtype: string
         @return: a generated name
         """
-        search = True
-        currentName = None
-        while search:
-            currentName = self.generated_names[random.randint(0, self.number_of_names)].replace("\n", "")
-            if not self.get_vm_by_name(currentName):
-                self.log.info("Trying to use generate name %s but it's already taken. Generating another one." % currentName)
-                search = False
-        return currentName
+        while True:
+            currentName = self.normalize_vm_name(self.generated_names[random.randint(0, self.number_of_names)].replace("\n", ""))
+            if reserve and self.virtualmachines.reserve_name(currentName):
+                return currentName
+            if not reserve and not self.get_vm_by_name(currentName):
+                return currentName
+            self.log.info("Trying to use generate name %s but it's already taken. Generating another one." % currentName)
+
+    def reserve_vm_name(self, requested_name):
+        """
+        Reserve the requested name for a new virtual machine.
+        @type requested_name: string
+        @param requested_name: the requested name. If None, a name is generated
+        @rtype: string
+        @return: the reserved name
+        """
+        if not requested_name:
+            return self.generate_name()
+        name = self.normalize_vm_name(requested_name)
+        if not self.virtualmachines.reserve_name(name):
+            raise Exception("This hypervisor already has virtual machine named %s. Please, choose another one." % name)
+        return name
+
+    def normalize_vm_name(self, name):
+        """
+        Replace the spaces of a virtual machine name if
+        VIRTUALMACHINE:allow_blank_space_in_vm_name is False.
+        @type name: string
+        @param name: the name
+        @rtype: string
+        @return: the normalized name
+        """
+        if self.configuration.has_option("VIRTUALMACHINE", "allow_blank_space_in_vm_name") and not self.configuration.getboolean("VIRTUALMACHINE", "allow_blank_space_in_vm_name"):
+            return name.replace(" ", "-")
+        return name
 
     def get_vm_by_name(self, name):
         """
@@ -332,10 +829,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @rtype: L{TNArchipelVirtualMachine}
         @return: the virtual machine or None
         """
-        for uuid, vm in self.virtualmachines.iteritems():
-            if vm.name.upper() == name.upper():
-                return vm
-        return None
+        return self.virtualmachines.get_by_name(name)
 
     def get_vm_by_uuid(self, uuid):
         """
@@ -345,9 +839,17 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @rtype: L{TNArchipelVirtualMachine}
         @return: the virtual machine or None
         """
-        if not uuid.lower() in self.virtualmachines:
-            return None
-        return self.virtualmachines[uuid.lower()]
+        return self.virtualmachines.get_by_uuid(uuid)
+
+    def get_vm_by_jid(self, jid):
+        """
+        Return the vm object by JID.
+        @type jid : xmpp.JID or string
+        @param jid: the JID of the vm
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the virtual machine or None
+        """
+        return self.virtualmachines.get_by_jid(jid)
 
     def get_vm_by_identifer(self, identifier):
         """
@@ -365,15 +867,33 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
 
     ### LIBVIRT events Processing
 
+    def get_migration_info(self, dom):
+        """
+        Return the JID, password and name of the VM of a domain. They come
+        from the running VM or from a cache, and the XML description of the
+        domain is only parsed for unknown domains.
+        @type dom: libvirt.virDomain
+        @param dom: the domain
+        @rtype: dict
+        @return: dict containing jid, password and name
+        """
+        uuid = dom.UUIDString().lower()
+        vm = self.virtualmachines.get_by_uuid(uuid)
+        if vm:
+            return {"jid": vm.jid.getStripped(), "password": vm.password, "name": vm.name}
+        if not uuid in self.migration_index:
+            desc        = xmpp.simplexml.NodeBuilder(data=dom.XMLDesc(0)).getDom()
+            vmjid, vmpass = desc.getTag(name="description").getCDATA().split("::::")[:2]
+            self.migration_index[uuid] = {"jid": vmjid, "password": vmpass, "name": desc.getTag(name="name").getCDATA()}
+        return self.migration_index[uuid]
+
     def hypervisor_on_domain_event(self, conn, dom, event, detail, opaque):
         """
         Trigger when a domain trigger vbent. We care only about RESUMED and SHUTDOWNED from MIGRATED.
         """
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED:
             try:
-                strdesc = dom.XMLDesc(0)
-                desc    = xmpp.simplexml.NodeBuilder(data=strdesc).getDom()
-                vmjid   = desc.getTag(name="description").getCDATA().split("::::")[0]
+                vmjid   = self.get_migration_info(dom)["jid"]
                 self.log.info("MIGRATION: Virtual machine %s stopped because of live migration. Freeing softly." % vmjid)
                 self.free_for_migration(xmpp.JID(vmjid))
                 self.perform_hooks("HOOK_HYPERVISOR_MIGRATEDVM_LEAVE", vmjid)
@@ -382,11 +902,11 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
 
         elif event == libvirt.VIR_DOMAIN_EVENT_RESUMED and detail == libvirt.VIR_DOMAIN_EVENT_RESUMED_MIGRATED:
             try:
-                strdesc = dom.XMLDesc(0)
-                desc    = xmpp.simplexml.NodeBuilder(data=strdesc).getDom()
-                vmjid   = desc.getTag(name="description").getCDATA().split("::::")[0]
-                vmpass  = desc.getTag(name="description").getCDATA().split("::::")[1]
-                vmname  = desc.getTag(name="name").getCDATA()
+                info    = self.get_migration_info(dom)
+                vmjid   = info["jid"]
+                vmpass  = info["password"]
+                vmname  = info["name"]
+                self.migration_index.pop(dom.UUIDString().lower(), None)
                 self.log.info("MIGRATION: Virtual machine %s resumed from live migration. Allocating softly." % vmjid)
                 self.alloc_for_migration(xmpp.JID(vmjid), vmname, vmpass)
                 self.perform_hooks("HOOK_HYPERVISOR_MIGRATEDVM_ARRIVE", vmjid)
@@ -450,23 +970,213 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @rtype: L{TNArchipelVirtualMachine} or L{TNThreadedVirtualMachine}
         @return: L{TNArchipelVirtualMachine} if start==True or L{TNThreadedVirtualMachine} if start==False
         """
-        vmuuid = str(moduuid.uuid1())
-        vm_password = ''.join([random.choice(string.letters + string.digits) for i in range(self.configuration.getint("VIRTUALMACHINE", "xmpp_password_size"))])
-        vm_jid = xmpp.JID(node=vmuuid.lower(), domain=self.xmppserveraddr.lower(), resource=self.jid.getNode().lower())
-        disallow_spaces_in_name = (self.configuration.has_option("VIRTUALMACHINE", "allow_blank_space_in_vm_name") and not self.configuration.getboolean("VIRTUALMACHINE", "allow_blank_space_in_vm_name"))
+        return self.alloc_many(requester, [requested_name], start)[0]
 
-        if not requested_name:
-            name = self.generate_name()
-        else:
-            if disallow_spaces_in_name:
-                requested_name = requested_name.replace(" ", "-")
-            if not self.get_vm_by_name(requested_name):
-                name = requested_name
+    def alloc_many(self, requester=None, requested_names=(None,), start=True):
+        """
+        Alloc several new XMPP entities. They are constructed by a pool of
+        VIRTUALMACHINE:vm_startup_workers threads and all persisted in the
+        same database transaction.
+        @type requester: xmpp.JID
+        @param requester: the JID of the requester
+        @type requested_names: list
+        @param requested_names: the requested names for the VMs. None items will be generated
+        @type start: Boolean
+        @param start: if True, start the vms immediatly
+        @rtype: list
+        @return: list of L{TNArchipelVirtualMachine} if start==True or of L{TNThreadedVirtualMachine} if start==False
+        """
+        # all the names are reserved before any VM is built, so a taken
+        # name doesn't leave VMs with a folder and permissions behind
+        names = []
+        try:
+            for requested_name in requested_names:
+                names.append(self.reserve_vm_name(requested_name))
+        except:
+            for name in names:
+                self.virtualmachines.release_name(name)
+            raise
+
+        vm_threads = []
+        try:
+            if len(names) == 1:
+                vm_threads.append(self.create_allocated_vm(requester, names[0]))
             else:
-                raise Exception("This hypervisor already has virtual machine named %s. Please, choose another one." % requested_name)
+                workers = min(len(names), self.get_startup_workers())
+                self.log.info("Constructing %d new VMs with %d workers." % (len(names), workers))
+                pool = ThreadPool(workers)
+                try:
+                    results = pool.map(lambda name: self.try_create_allocated_vm(requester, name), names)
+                finally:
+                    pool.close()
+                    pool.join()
+                vm_threads = [vm_thread for vm_thread, error in results if vm_thread]
+                errors = [error for vm_thread, error in results if error]
+                if errors:
+                    raise errors[0]
+            self.log.info("Registering %d new VM(s) in hypervisor's database." % len(vm_threads))
+            self.database.insert_virtual_machines([(vm_thread.jid.getStripped(), vm_thread.password, vm_thread.get_instance().name) for vm_thread in vm_threads])
+        except:
+            for vm_thread in vm_threads:
+                try:
+                    vm_thread.get_instance().terminate()
+                except Exception as ex:
+                    self.log.error("Unable to remove the aborted virtual machine %s: %s" % (vm_thread.jid, str(ex)))
+            for name in names:
+                self.virtualmachines.release_name(name)
+            raise
+
+        for vm_thread in vm_threads:
+            vm = vm_thread.get_instance()
+            self.virtualmachines.add(vm)
+            self.log.info("XMPP Virtual Machine instance %s sucessfully initialized." % vm.jid)
+            self.perform_hooks("HOOK_HYPERVISOR_ALLOC", vm)
+        self.update_presence()
+        self.push_change("hypervisor", "alloc")
+
+        if not start:
+            return vm_threads
+        for vm_thread in vm_threads:
+            vm_thread.start()
+        return [vm_thread.get_instance() for vm_thread in vm_threads]
+
+    def alloc_bulk(self, requester=None, requested_names=(), count=0, template=None):
+        """
+        Alloc several new XMPP entities in one request. They are persisted
+        together, then their threads are started through the startup limiter,
+        so the account registrations run concurrently. The progress of each
+        virtual machine is published in the events pubsub node.
+        @type requester: xmpp.JID
+        @param requester: the JID of the requester
+        @type requested_names: list
+        @param requested_names: the names of the VMs to alloc
+        @type count: integer
+        @param count: the number of VMs to alloc in addition to the named ones
+        @type template: string
+        @param template: if given, the additional VMs are named template-1, template-2... otherwise their names are generated
+        @rtype: tuple
+        @return: the L{TNArchipelBulkAllocation} and the list of allocated L{TNArchipelVirtualMachine}
+        """
+        if count < 0:
+            raise Exception("Invalid number of virtual machines %d." % count)
+        if len(requested_names) + count > ARCHIPEL_HYPERVISOR_ALLOC_MAX_COUNT:
+            raise Exception("Can't allocate more than %d virtual machines at once." % ARCHIPEL_HYPERVISOR_ALLOC_MAX_COUNT)
+        names = list(requested_names)
+        if template:
+            names.extend(["%s-%d" % (template, index) for index in range(1, count + 1)])
+        else:
+            names.extend([None] * count)
+        if not names:
+            raise Exception("Nothing to allocate.")
+
+        vm_threads = self.alloc_many(requester, names, start=False)
+        allocation = TNArchipelBulkAllocation([vm_thread.jid.getStripped() for vm_thread in vm_threads])
+        limiter = self.create_startup_limiter()
+        timer = Timer(ARCHIPEL_HYPERVISOR_ALLOC_TIMEOUT, self.expire_bulk_allocation, [allocation])
+        timer.setDaemon(True)
+        timer.start()
+        self.log.info("BULK ALLOC: starting %d virtual machines for allocation %s" % (allocation.total, allocation.identifier))
+        for vm_thread in vm_threads:
+            vm = vm_thread.get_instance()
+            vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.on_bulk_allocated_vm_authenticated, user_info=allocation, oneshot=True)
+            vm_thread.startup_limiter = limiter
+            vm_thread.startup_callback = lambda vm, duration, connected, error, allocation=allocation: self.on_bulk_allocated_vm_connected(allocation, vm, duration, connected, error)
+            vm_thread.start()
+        return allocation, [vm_thread.get_instance() for vm_thread in vm_threads]
+
+    def on_bulk_allocated_vm_connected(self, allocation, vm, duration, connected, error):
+        """
+        Called by a virtual machine thread of a bulk allocation when its first
+        connection attempt is done. A virtual machine that could not connect
+        or authenticate is reported as failed. A virtual machine that has just
+        registered its account will authenticate when it reconnects.
+        @type allocation: L{TNArchipelBulkAllocation}
+        @param allocation: the allocation
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine
+        @type duration: float
+        @param duration: the time spent connecting
+        @type connected: Boolean
+        @param connected: True if the virtual machine is connected
+        @type error: Exception
+        @param error: the exception raised while connecting, if any
+        """
+        if error or not connected or not vm.xmppclient or not vm.xmppclient.isConnected():
+            self.update_bulk_allocation(allocation, vm.jid.getStripped(), ARCHIPEL_ALLOC_STATUS_FAILED)
+        elif not vm.isAuth and not vm.loop_status == ARCHIPEL_XMPP_LOOP_RESTART:
+            self.update_bulk_allocation(allocation, vm.jid.getStripped(), ARCHIPEL_ALLOC_STATUS_FAILED)
+
+    def expire_bulk_allocation(self, allocation):
+        """
+        Report as failed the virtual machines of a bulk allocation that are
+        still not authenticated after ARCHIPEL_HYPERVISOR_ALLOC_TIMEOUT seconds.
+        @type allocation: L{TNArchipelBulkAllocation}
+        @param allocation: the allocation
+        """
+        for jid in allocation.get_pending_jids():
+            self.log.warning("BULK ALLOC: virtual machine %s of allocation %s is not ready in time" % (jid, allocation.identifier))
+            self.update_bulk_allocation(allocation, jid, ARCHIPEL_ALLOC_STATUS_FAILED)
+
+    def on_bulk_allocated_vm_authenticated(self, origin, user_info, parameters):
+        """
+        Hook called when a virtual machine of a bulk allocation is authenticated.
+        @type origin: L{TNArchipelVirtualMachine}
+        @param origin: the virtual machine
+        @type user_info: L{TNArchipelBulkAllocation}
+        @param user_info: the allocation
+        @type parameters: object
+        @param parameters: runtime arguments
+        """
+        self.update_bulk_allocation(user_info, origin.jid.getStripped(), ARCHIPEL_ALLOC_STATUS_READY)
 
-        if disallow_spaces_in_name:
-            name = name.replace(" ", "-")
+    def update_bulk_allocation(self, allocation, jid, status):
+        """
+        Update the status of a virtual machine of a bulk allocation and
+        publish the progress in the events pubsub node.
+        @type allocation: L{TNArchipelBulkAllocation}
+        @param allocation: the allocation
+        @type jid: string
+        @param jid: the bare JID of the virtual machine
+        @type status: string
+        @param status: the new status (ready or failed)
+        """
+        counts = allocation.update(jid, status)
+        if not counts:
+            return
+        ready   = counts[ARCHIPEL_ALLOC_STATUS_READY]
+        failed  = counts[ARCHIPEL_ALLOC_STATUS_FAILED]
+        if ready + failed == allocation.total:
+            self.log.info("BULK ALLOC: allocation %s done in %.2fs: %d ready, %d failed" % (allocation.identifier, time.time() - allocation.start_time, ready, failed))
+        if not self.pubsubs_ready.isSet():
+            return
+        push = xmpp.Node(tag="push", attrs={"date": datetime.datetime.now(),
+                                            "xmlns": ARCHIPEL_NS_IQ_PUSH + ":hypervisor",
+                                            "change": "allocprogress",
+                                            "allocation": allocation.identifier,
+                                            "jid": jid,
+                                            "status": status,
+                                            "ready": ready,
+                                            "failed": failed,
+                                            "total": allocation.total})
+        self.pubSubNodeEvent.add_item(push)
+
+    def create_allocated_vm(self, requester, name):
+        """
+        Create the threaded virtual machine of an allocation, with a new
+        JID and password. It is neither persisted nor registered.
+        @type requester: xmpp.JID
+        @param requester: the JID of the requester
+        @type name: string
+        @param name: the name of the VM, reserved with L{reserve_vm_name}
+        @rtype: L{TNThreadedVirtualMachine}
+        @return: the threaded virtual machine, not started
+        """
+        vmuuid = str(moduuid.uuid1())
+        vm_password = ''.join([random.choice(string.letters + string.digits) for i in range(self.configuration.getint("VIRTUALMACHINE", "xmpp_password_size"))])
+        vm_domain = self.xmppserveraddr
+        if self.xmpp_transport:
+            vm_domain = self.xmpp_transport.domain
+        vm_jid = xmpp.JID(node=vmuuid.lower(), domain=vm_domain.lower(), resource=self.jid.getNode().lower())
 
         self.log.info("Starting xmpp threaded virtual machine.")
         vm_thread = self.create_threaded_vm(vm_jid, vm_password, name)
@@ -477,20 +1187,24 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.add_jid_hook, user_info=xmpp.JID(requester), oneshot=True)
             vm.permission_center.grant_permission_to_user("all", requester.getStripped())
 
-        self.log.info("Registering the new VM in hypervisor's database.")
-        self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(vm_jid.getStripped()), vm_password, datetime.datetime.now(), '', name))
-        self.database.commit()
-        self.virtualmachines[vmuuid] = vm
+        return vm_thread
 
-        self.update_presence()
-        self.log.info("XMPP Virtual Machine instance sucessfully initialized.")
-        self.perform_hooks("HOOK_HYPERVISOR_ALLOC", vm)
-        self.push_change("hypervisor", "alloc")
-        if start:
-            vm_thread.start()
-            return vm
-        else:
-            return vm_thread
+    def try_create_allocated_vm(self, requester, name):
+        """
+        Create the threaded virtual machine of an allocation, catching the errors.
+        This is run by the worker pool of L{alloc_many}.
+        @type requester: xmpp.JID
+        @param requester: the JID of the requester
+        @type name: string
+        @param name: the name of the VM, reserved with L{reserve_vm_name}
+        @rtype: tuple
+        @return: the L{TNThreadedVirtualMachine} or None, and the exception raised or None
+        """
+        try:
+            return self.create_allocated_vm(requester, name), None
+        except Exception as ex:
+            self.log.error("Unable to construct virtual machine %s: %s" % (name, str(ex)))
+            return None, ex
 
     def alloc_for_migration(self, jid, name, password):
         """
@@ -510,9 +1224,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         vm = vm_thread.get_instance()
         vm_thread.start()
         self.log.info("Registering the new VM in hypervisor's database.")
-        self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(jid.getStripped()), password, datetime.datetime.now(), '', name))
-        self.database.commit()
-        self.virtualmachines[uuid] = vm
+        self.database.insert_virtual_machine(jid.getStripped(), password, name)
+        self.virtualmachines.add(vm, uuid)
 
         self.update_presence()
         self.log.info("Migrated XMPP VM is ready.")
@@ -524,29 +1237,38 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @type jid: xmpp.JID
         @param jid: the JID of the VM to free
         """
-        uuid    = jid.getNode()
-        vm      = self.virtualmachines[uuid]
+        self.free_many([jid])
 
-        if vm.is_migrating:
-            raise Exception("Virtual machine is migrating. Can't free.")
-        if vm.domain and (vm.domain.info()[0] == 1 or vm.domain.info()[0] == 2 or vm.domain.info()[0] == 3):
-            vm.domain.destroy()
-        if vm.domain:
-            vm.domain.undefine()
+    def free_many(self, jids):
+        """
+        Remove the XMPP containers of the VMs with given jids. They are all
+        removed from the database in the same transaction.
+        @type jids: list
+        @param jids: the JIDs of the VMs to free
+        """
+        vms = [self.virtualmachines[jid.getNode()] for jid in jids]
 
-        self.log.info("Launch %s's terminate method." % jid)
-        vm.terminate()
+        for vm in vms:
+            if vm.is_migrating:
+                raise Exception("Virtual machine %s is migrating. Can't free." % vm.jid.getStripped())
 
-        self.log.info("Unregistering the VM from hypervisor's database.")
-        self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
-        self.database.commit()
+        for vm in vms:
+            if vm.domain and (vm.domain.info()[0] == 1 or vm.domain.info()[0] == 2 or vm.domain.info()[0] == 3):
+                vm.domain.destroy()
+            if vm.domain:
+                vm.domain.undefine()
+            self.log.info("Launch %s's terminate method." % vm.jid)
+            vm.terminate()
 
-        del self.virtualmachines[uuid]
+        self.log.info("Unregistering %d VM(s) from hypervisor's database." % len(vms))
+        self.database.delete_virtual_machines([vm.jid.getStripped() for vm in vms])
 
-        self.log.info("Starting the vm removing procedure.")
-        vm.inband_unregistration()
-        self.perform_hooks("HOOK_HYPERVISOR_FREE", vm)
-        self.log.info("XMPP Virtual Machine %s sucessfully destroyed." % jid)
+        for vm in vms:
+            self.virtualmachines.remove(vm.jid.getNode())
+            self.log.info("Starting the vm removing procedure.")
+            vm.inband_unregistration()
+            self.perform_hooks("HOOK_HYPERVISOR_FREE", vm)
+            self.log.info("XMPP Virtual Machine %s sucessfully destroyed." % vm.jid)
         self.push_change("hypervisor", "free")
         self.update_presence()
 
@@ -562,9 +1284,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         vm.undefine_and_disconnect()
 
         self.log.info("Unregistering the VM from hypervisor's database.")
-        self.database.execute("delete from virtualmachines where jid='%s'" % jid.getStripped())
-        self.database.commit()
-        del self.virtualmachines[uuid]
+        self.database.delete_virtual_machine(jid.getStripped())
+        self.virtualmachines.remove(uuid)
         self.update_presence()
 
     def clone(self, uuid, requester, wanted_name=None):
@@ -586,7 +1307,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             raise Exception('The mother vm has to be stopped to be cloned.')
 
         if not wanted_name:
-            name = "%s (clone of %s)" % (self.generate_name(), xmppvm.name)
+            name = "%s (clone of %s)" % (self.generate_name(reserve=False), xmppvm.name)
         else:
             name = wanted_name
 
@@ -630,8 +1351,11 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @return: a ready-to-send IQ containing the results
         """
         try:
+            archipel_tag = iq.getTag("query").getTag("archipel")
+            if archipel_tag and (archipel_tag.getAttr("count") or archipel_tag.getTags("virtualmachine")):
+                return self.iq_alloc_bulk(iq, archipel_tag)
             try:
-                requested_name = iq.getTag("query").getTag("archipel").getAttr("name")
+                requested_name = archipel_tag.getAttr("name")
             except:
                 requested_name = None
             vm = self.alloc(iq.getFrom(), requested_name=requested_name)
@@ -645,6 +1369,37 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_ALLOC)
         return reply
 
+    def iq_alloc_bulk(self, iq, archipel_tag):
+        """
+        Alloc several virtual machines. The request contains a count
+        attribute, with an optional template attribute used to name them,
+        and/or virtualmachine children with a name attribute. The reply is
+        sent once all the VMs are allocated, and their connection progress
+        is published in the events pubsub node.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @type archipel_tag: xmpp.Node
+        @param archipel_tag: the archipel node of the request
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            count = int(archipel_tag.getAttr("count") or 0)
+            template = archipel_tag.getAttr("template")
+            names = [node.getAttr("name") for node in archipel_tag.getTags("virtualmachine")]
+            allocation, vms = self.alloc_bulk(iq.getFrom(), names, count, template)
+            reply = iq.buildReply("result")
+            payload = xmpp.Node("allocation", attrs={"id": allocation.identifier, "total": allocation.total})
+            for vm in vms:
+                payload.addChild("virtualmachine", attrs={"jid": str(vm.jid.getStripped()), "name": vm.name})
+            reply.setQueryPayload([payload])
+            self.shout("virtualmachine", "%d new Archipel Virtual Machines have been created by %s" % (len(vms), iq.getFrom()))
+        except libvirt.libvirtError as ex:
+            reply = build_error_iq(self, ex, iq, ex.get_error_code(), ns=ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_ALLOC)
+        return reply
+
     def message_alloc(self, msg):
         """
         Handle the allocation request message.
@@ -791,7 +1546,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         try:
             reply = iq.buildReply("result")
             nodes = []
-            for uuid, vm in self.virtualmachines.iteritems():
+            for vm in self.virtualmachines.values():
                 n = xmpp.Node("item")
                 n.addData(vm.jid.getStripped())
                 nodes.append(n)
@@ -810,7 +1565,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         """
         try:
             ret = "Here is the content of my roster:\n"
-            for uuid, vm in self.virtualmachines.iteritems():
+            for vm in self.virtualmachines.values():
                 ret += " - %s (%s)\n" % (vm.name, vm.jid)
             return ret
         except Exception as ex:
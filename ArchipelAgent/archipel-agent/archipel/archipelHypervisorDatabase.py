@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+#
+# archipelHypervisorDatabase.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNArchipelHypervisorDatabase}, the persistence of the virtual
+machines of the hypervisor. Writes are queued and performed by a single
+writer thread that commits all the pending writes in one transaction.
+"""
+
+import datetime
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+ARCHIPEL_HYPERVISOR_DATABASE_JOURNAL_MODES      = ("delete", "truncate", "persist", "memory", "wal", "off")
+ARCHIPEL_HYPERVISOR_DATABASE_SYNCHRONOUS_MODES  = ("off", "normal", "full")
+
+
+class TNArchipelDatabaseWrite (object):
+    """
+    A queued write. It holds one statement and one or several rows of
+    parameters, always performed in the same transaction.
+    """
+
+    def __init__(self, statement, rows):
+        """
+        Initialize the write.
+        @type statement: string
+        @param statement: the parameterized SQL statement
+        @type rows: list
+        @param rows: list of parameter tuples
+        """
+        self.statement  = statement
+        self.rows       = rows
+        self.error      = None
+        self.done       = threading.Event()
+
+    def wait(self):
+        """
+        Wait until the write is committed.
+        @raise Exception: if the write failed
+        """
+        self.done.wait()
+        if self.error:
+            raise self.error
+
+
+class TNArchipelHypervisorDatabase (object):
+    """
+    The virtualmachines table of the hypervisor, with group commit.
+    """
+
+    def __init__(self, path, journal_mode="wal", synchronous="full", commit_delay=0.0, batch_size=256, log=None):
+        """
+        Open the database, create the table if needed and start the writer thread.
+        @type path: string
+        @param path: the path of the sqlite3 file
+        @type journal_mode: string
+        @param journal_mode: the sqlite journal mode (wal by default)
+        @type synchronous: string
+        @param synchronous: the sqlite synchronous mode (off, normal or full)
+        @type commit_delay: float
+        @param commit_delay: seconds to wait for other writes before committing
+        @type batch_size: integer
+        @param batch_size: max number of queued writes committed in one transaction
+        @type log: TNArchipelLogger
+        @param log: the logger to use
+        """
+        if not journal_mode.lower() in ARCHIPEL_HYPERVISOR_DATABASE_JOURNAL_MODES:
+            raise Exception("Unknown sqlite journal mode %s" % journal_mode)
+        if not synchronous.lower() in ARCHIPEL_HYPERVISOR_DATABASE_SYNCHRONOUS_MODES:
+            raise Exception("Unknown sqlite synchronous mode %s" % synchronous)
+        self.path               = path
+        self.log                = log
+        self.commit_delay       = max(0.0, commit_delay)
+        self.batch_size         = max(1, batch_size)
+        self.connection         = sqlite3.connect(path, check_same_thread=False)
+        self.connection_lock    = threading.Lock()
+        self.journal_mode       = self.connection.execute("PRAGMA journal_mode=%s" % journal_mode.lower()).fetchone()[0]
+        self.connection.execute("PRAGMA synchronous=%s" % synchronous.upper())
+        if self.log and not self.journal_mode == journal_mode.lower():
+            self.log.warning("DATABASE: unable to use journal mode %s for %s, using %s" % (journal_mode, path, self.journal_mode))
+        self.connection.execute("create table if not exists virtualmachines (jid text, password text, creation_date date, comment text, name text)")
+        self.connection.commit()
+        self.queue              = deque()
+        self.queue_condition    = threading.Condition(threading.Lock())
+        self.written_rows       = 0
+        self.transactions       = 0
+        self.failed_writes      = 0
+        self.closing            = False
+        self.writer_thread      = threading.Thread(target=self._writer_loop, name="archipel-hypervisor-database")
+        self.writer_thread.setDaemon(True)
+        self.writer_thread.start()
+
+    ### Reads
+
+    def get_virtual_machines(self):
+        """
+        Return all the persisted virtual machines.
+        @rtype: list
+        @return: list of (jid, password, creation_date, comment, name)
+        """
+        self.connection_lock.acquire()
+        try:
+            return self.connection.execute("select * from virtualmachines").fetchall()
+        finally:
+            self.connection_lock.release()
+
+    ### Writes
+
+    def write(self, statement, rows, wait=True):
+        """
+        Queue a write. All its rows are written in the same transaction.
+        @type statement: string
+        @param statement: the parameterized SQL statement
+        @type rows: list
+        @param rows: list of parameter tuples
+        @type wait: Boolean
+        @param wait: if True, block until the write is committed
+        @rtype: L{TNArchipelDatabaseWrite}
+        @return: the queued write
+        """
+        write = TNArchipelDatabaseWrite(statement, rows)
+        self.queue_condition.acquire()
+        try:
+            if self.closing:
+                raise Exception("Database %s is closed" % self.path)
+            self.queue.append(write)
+            self.queue_condition.notifyAll()
+        finally:
+            self.queue_condition.release()
+        if wait:
+            write.wait()
+        return write
+
+    def insert_virtual_machines(self, vms, wait=True):
+        """
+        Persist several virtual machines in one transaction.
+        @type vms: list
+        @param vms: list of (jid, password, name)
+        @type wait: Boolean
+        @param wait: if True, block until the write is committed
+        @rtype: L{TNArchipelDatabaseWrite}
+        @return: the queued write
+        """
+        now = datetime.datetime.now()
+        rows = [(str(jid), password, now, '', name) for jid, password, name in vms]
+        return self.write("insert into virtualmachines values(?,?,?,?,?)", rows, wait)
+
+    def insert_virtual_machine(self, jid, password, name, wait=True):
+        """
+        Persist a virtual machine.
+        @type jid: string
+        @param jid: the bare JID of the virtual machine
+        @type password: string
+        @param password: its XMPP password
+        @type name: string
+        @param name: its name
+        @type wait: Boolean
+        @param wait: if True, block until the write is committed
+        @rtype: L{TNArchipelDatabaseWrite}
+        @return: the queued write
+        """
+        return self.insert_virtual_machines([(jid, password, name)], wait)
+
+    def delete_virtual_machines(self, jids, wait=True):
+        """
+        Remove several virtual machines in one transaction.
+        @type jids: list
+        @param jids: list of bare JIDs
+        @type wait: Boolean
+        @param wait: if True, block until the write is committed
+        @rtype: L{TNArchipelDatabaseWrite}
+        @return: the queued write
+        """
+        return self.write("delete from virtualmachines where jid=?", [(str(jid),) for jid in jids], wait)
+
+    def delete_virtual_machine(self, jid, wait=True):
+        """
+        Remove a virtual machine.
+        @type jid: string
+        @param jid: the bare JID of the virtual machine
+        @type wait: Boolean
+        @param wait: if True, block until the write is committed
+        @rtype: L{TNArchipelDatabaseWrite}
+        @return: the queued write
+        """
+        return self.delete_virtual_machines([jid], wait)
+
+    ### Writer
+
+    def _commit(self, batch):
+        """
+        Perform the writes of the batch in one transaction. If it fails, the
+        writes are retried one by one so only the faulty ones are reported.
+        @type batch: list
+        @param batch: the L{TNArchipelDatabaseWrite} to perform
+        """
+        self.connection_lock.acquire()
+        try:
+            try:
+                for write in batch:
+                    self.connection.executemany(write.statement, write.rows)
+                self.connection.commit()
+                self.transactions += 1
+                return
+            except Exception:
+                self.connection.rollback()
+            for write in batch:
+                try:
+                    self.connection.executemany(write.statement, write.rows)
+                    self.connection.commit()
+                    self.transactions += 1
+                except Exception as ex:
+                    self.connection.rollback()
+                    write.error = ex
+                    self.failed_writes += 1
+                    if self.log:
+                        self.log.error("DATABASE: unable to perform '%s': %s" % (write.statement, str(ex)))
+        finally:
+            self.connection_lock.release()
+
+    def _writer_loop(self):
+        """
+        Drain the queue until the database is closed.
+        """
+        while True:
+            self.queue_condition.acquire()
+            try:
+                while not self.queue and not self.closing:
+                    self.queue_condition.wait()
+                if not self.queue and self.closing:
+                    return
+            finally:
+                self.queue_condition.release()
+            if self.commit_delay and not self.closing:
+                time.sleep(self.commit_delay)
+            self.queue_condition.acquire()
+            try:
+                batch = []
+                while self.queue and len(batch) < self.batch_size:
+                    batch.append(self.queue.popleft())
+            finally:
+                self.queue_condition.release()
+            self._commit(batch)
+            for write in batch:
+                if not write.error:
+                    self.written_rows += len(write.rows)
+                write.done.set()
+
+    def get_stats(self):
+        """
+        Return the counters of the database.
+        @rtype: dict
+        @return: dict containing the number of queued writes, transactions and written rows
+        """
+        return {"queued": len(self.queue),
+                "transactions": self.transactions,
+                "rows": self.written_rows,
+                "failed": self.failed_writes,
+                "journal_mode": self.journal_mode}
+
+    def close(self):
+        """
+        Perform the remaining writes, stop the writer thread and close the database.
+        """
+        self.queue_condition.acquire()
+        try:
+            self.closing = True
+            self.queue_condition.notifyAll()
+        finally:
+            self.queue_condition.release()
+        if self.writer_thread.isAlive() and not threading.currentThread() is self.writer_thread:
+            self.writer_thread.join()
+        self.connection.close()
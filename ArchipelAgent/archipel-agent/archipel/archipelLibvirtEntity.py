@@ -21,8 +21,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import libvirt
+import Queue
 import random
 import sys
+from collections import deque
+from threading import Lock, Thread
+
+from archipelcore.utils import log
 
 ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR = "libvirt:error:generic"
 
@@ -49,6 +54,162 @@ def generate_mac_adress():
     return "%s:%s:%s:%s:%s:%s" % (digit1, digit2, digit3, digit4, digit5, digit6)
 
 
+class TNArchipelLibvirtConnectionPool (object):
+    """
+    Small pool of libvirt connections owned by the hypervisor and shared by
+    the virtual machines.
+    """
+
+    def __init__(self, entity, size=1):
+        """
+        Initialize the pool.
+        @type entity: L{TNArchipelLibvirtEntity}
+        @param entity: the entity used to open the connections (its own connection is the first one)
+        @type size: integer
+        @param size: the max number of connections
+        """
+        self.entity                 = entity
+        self.size                   = max(1, size)
+        self.connections            = [entity.libvirt_connection]
+        self.next_connection        = 0
+        self.lock                   = Lock()
+
+    def get_connection(self):
+        """
+        Return one of the connections of the pool, opening a new one if the
+        pool is not full yet.
+        @rtype: libvirt.virConnect
+        @return: a shared libvirt connection
+        """
+        self.lock.acquire()
+        try:
+            if len(self.connections) < self.size:
+                self.connections.append(self.entity.open_libvirt_connection())
+                return self.connections[-1]
+            self.next_connection = (self.next_connection + 1) % len(self.connections)
+            return self.connections[self.next_connection]
+        finally:
+            self.lock.release()
+
+class TNArchipelLibvirtEventDispatcher (object):
+    """
+    Owns the only libvirt lifecycle event subscription of the hypervisor.
+    Events are queued by the libvirt event loop thread. A worker thread only
+    routes them to the queue of their domain, which is drained by a thread of
+    its own, started when the queue gets an event and stopped when it is
+    empty. This thread calls the global callback, then the callback registered
+    for the UUID of the domain, so a slow domain never delays the others and
+    the events of a domain stay ordered.
+    """
+
+    def __init__(self, connection, global_callback=None):
+        """
+        Initialize the dispatcher and subscribe to lifecycle events.
+        @type connection: libvirt.virConnect
+        @param connection: the connection to use for the subscription
+        @type global_callback: function
+        @param global_callback: if given, called for every event before the domain callback
+        """
+        self.connection         = connection
+        self.global_callback    = global_callback
+        self.domain_callbacks   = {}
+        self.domain_queues      = {}
+        self.domain_queues_lock = Lock()
+        self.queue              = Queue.Queue()
+        self.worker             = Thread(target=self.process_events)
+        self.worker.setDaemon(True)
+        self.worker.start()
+        self.event_callback_id  = connection.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.on_domain_event, None)
+
+    def register_domain_callback(self, uuid, callback):
+        """
+        Register the lifecycle event callback of a domain.
+        @type uuid: string
+        @param uuid: the UUID of the domain
+        @type callback: function
+        @param callback: the function to call, with the arguments of libvirt callbacks
+        @rtype: string
+        @return: the identifier of the registration (the UUID)
+        """
+        self.domain_callbacks[uuid.lower()] = callback
+        return uuid
+
+    def unregister_domain_callback(self, uuid):
+        """
+        Unregister the lifecycle event callback of a domain.
+        @type uuid: string
+        @param uuid: the UUID of the domain
+        """
+        self.domain_callbacks.pop(uuid.lower(), None)
+
+    def on_domain_event(self, conn, dom, event, detail, opaque):
+        """
+        Called by libvirt. Queue the event for the worker thread.
+        """
+        self.queue.put((dom, (conn, dom, event, detail, opaque)))
+
+    def process_events(self):
+        """
+        Route the queued events to the queue of their domain until the
+        dispatcher is closed.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            dom, arguments = item
+            try:
+                uuid = dom.UUIDString().lower()
+            except Exception as ex:
+                log.error("Unable to get the UUID of the domain of libvirt event %d:%d: %s" % (arguments[2], arguments[3], str(ex)))
+                continue
+            self.domain_queues_lock.acquire()
+            try:
+                domain_queue = self.domain_queues.get(uuid)
+                start = domain_queue is None
+                if start:
+                    domain_queue = self.domain_queues[uuid] = deque()
+                domain_queue.append(arguments)
+            finally:
+                self.domain_queues_lock.release()
+            if start:
+                thread = Thread(target=self.process_domain_events, args=(uuid,))
+                thread.setDaemon(True)
+                thread.start()
+
+    def process_domain_events(self, uuid):
+        """
+        Deliver the queued events of a domain until its queue is empty.
+        @type uuid: string
+        @param uuid: the UUID of the domain
+        """
+        while True:
+            self.domain_queues_lock.acquire()
+            try:
+                domain_queue = self.domain_queues[uuid]
+                if not domain_queue:
+                    del self.domain_queues[uuid]
+                    return
+                conn, dom, event, detail, opaque = domain_queue.popleft()
+            finally:
+                self.domain_queues_lock.release()
+            for callback in (self.global_callback, self.domain_callbacks.get(uuid)):
+                if not callback:
+                    continue
+                try:
+                    callback(conn, dom, event, detail, opaque)
+                except Exception as ex:
+                    log.error("Exception while dispatching libvirt event %d:%d of domain %s: %s" % (event, detail, uuid, str(ex)))
+
+    def close(self):
+        """
+        Unsubscribe from libvirt events and stop the worker thread.
+        """
+        if not self.event_callback_id is None:
+            self.connection.domainEventDeregisterAny(self.event_callback_id)
+            self.event_callback_id = None
+        self.queue.put(None)
+
 
 class TNArchipelLibvirtEntity (object):
 
@@ -59,6 +220,7 @@ class TNArchipelLibvirtEntity (object):
         self.configuration = configuration
         self.local_libvirt_uri = self.configuration.get("GLOBAL", "libvirt_uri")
         self.libvirt_connection = None
+        self.libvirt_connection_pool = None
         if self.configuration.has_option("GLOBAL", "libvirt_need_authentication"):
             self.need_auth = self.configuration.getboolean("GLOBAL", "libvirt_need_authentication")
         else:
@@ -70,19 +232,34 @@ class TNArchipelLibvirtEntity (object):
         """
         self.manage_vcard()
 
-    def connect_libvirt(self):
+    def open_libvirt_connection(self):
         """
-        Connect to the libvirt according to parameters in configuration.
+        Open a new connection to the libvirt according to parameters in configuration.
+        @rtype: libvirt.virConnect
+        @return: the new connection
         """
         if self.need_auth:
             auth = [[libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE], self.libvirt_credential_callback, None]
-            self.libvirt_connection = libvirt.openAuth(self.local_libvirt_uri, auth, 0)
+            connection = libvirt.openAuth(self.local_libvirt_uri, auth, 0)
         else:
-            self.libvirt_connection = libvirt.open(self.local_libvirt_uri)
-            if self.libvirt_connection == None:
+            connection = libvirt.open(self.local_libvirt_uri)
+            if connection == None:
                 self.log.error("Unable to connect libvirt.")
                 sys.exit(-42)
         self.log.info("Connected to libvirt uri %s" % self.local_libvirt_uri)
+        return connection
+
+    def connect_libvirt(self, pool=None):
+        """
+        Connect to the libvirt according to parameters in configuration.
+        @type pool: L{TNArchipelLibvirtConnectionPool}
+        @param pool: if given, borrow a shared connection from this pool instead of opening one
+        """
+        self.libvirt_connection_pool = pool
+        if pool:
+            self.libvirt_connection = pool.get_connection()
+        else:
+            self.libvirt_connection = self.open_libvirt_connection()
 
     def libvirt_credential_callback(self, creds, cbdata):
         """
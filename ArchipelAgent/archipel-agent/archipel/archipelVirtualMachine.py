@@ -123,7 +123,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
         
         self.permfolder = "%s/%s" % (self.vm_perm_base_path, self.uuid)
 
-        self.connect_libvirt()
+        self.connect_libvirt(hypervisor.libvirt_connection_pool_for_vms)
 
         self.vcard_infos                = {}
         if (self.configuration.has_section("VCARD")):
@@ -143,7 +143,12 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
 
         self.permission_db_file = "%s/%s" % (self.permfolder, self.configuration.get("VIRTUALMACHINE", "vm_permissions_database_path"))
         permission_admin_names  = self.configuration.get("GLOBAL", "archipel_root_admins").split()
-        self.permission_center  = TNArchipelPermissionCenter(self.permission_db_file, permission_admin_names)
+        if self.hypervisor.permission_store:
+            if os.path.exists(self.permission_db_file):
+                self.migrate_permission_database()
+            self.permission_center  = self.hypervisor.permission_store.get_permission_center(self.uuid, permission_admin_names)
+        else:
+            self.permission_center  = TNArchipelPermissionCenter(self.permission_db_file, permission_admin_names)
         self.init_permissions()
 
         # hooks
@@ -252,23 +257,25 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
         Initialize the permissions.
         """
         TNArchipelEntity.init_permissions(self)
-        self.permission_center.create_permission("info", "Authorizes users to access virtual machine information", False)
-        self.permission_center.create_permission("create", "Authorizes users to create (start) virtual machine", False)
-        self.permission_center.create_permission("shutdown", "Authorizes users to shutdown virtual machine", False)
-        self.permission_center.create_permission("destroy", "Authorizes users to destroy virtual machine", False)
-        self.permission_center.create_permission("reboot", "Authorizes users to reboot virtual machine", False)
-        self.permission_center.create_permission("suspend", "Authorizes users to suspend virtual machine ", False)
-        self.permission_center.create_permission("resume", "Authorizes users to resume virtual machine", False)
-        self.permission_center.create_permission("xmldesc", "Authorizes users to access the XML description of the virtual machine", False)
-        self.permission_center.create_permission("migrate", "Authorizes users to perform live migration", False)
-        self.permission_center.create_permission("autostart", "Authorizes users to set the virtual machine autostart", False)
-        self.permission_center.create_permission("memory", "Authorizes users to change memory in live", False)
-        self.permission_center.create_permission("setvcpus", "Authorizes users to set the number of virtual CPU in live", False)
-        self.permission_center.create_permission("networkinfo", "Authorizes users to access virtual machine's network informations", False)
-        self.permission_center.create_permission("define", "Authorizes users to define virtual machine", False)
-        self.permission_center.create_permission("undefine", "Authorizes users to undefine virtual machine", False)
-        self.permission_center.create_permission("capabilities", "Authorizes users to access virtual machine's hypervisor capabilities", False)
-        self.permission_center.create_permission("free", "Authorizes users completly destroy the virtual machine", False)
+        self.permission_center.create_permissions([
+            {"name": "info", "description": "Authorizes users to access virtual machine information", "default": False},
+            {"name": "create", "description": "Authorizes users to create (start) virtual machine", "default": False},
+            {"name": "shutdown", "description": "Authorizes users to shutdown virtual machine", "default": False},
+            {"name": "destroy", "description": "Authorizes users to destroy virtual machine", "default": False},
+            {"name": "reboot", "description": "Authorizes users to reboot virtual machine", "default": False},
+            {"name": "suspend", "description": "Authorizes users to suspend virtual machine ", "default": False},
+            {"name": "resume", "description": "Authorizes users to resume virtual machine", "default": False},
+            {"name": "xmldesc", "description": "Authorizes users to access the XML description of the virtual machine", "default": False},
+            {"name": "migrate", "description": "Authorizes users to perform live migration", "default": False},
+            {"name": "autostart", "description": "Authorizes users to set the virtual machine autostart", "default": False},
+            {"name": "memory", "description": "Authorizes users to change memory in live", "default": False},
+            {"name": "setvcpus", "description": "Authorizes users to set the number of virtual CPU in live", "default": False},
+            {"name": "networkinfo", "description": "Authorizes users to access virtual machine's network informations", "default": False},
+            {"name": "define", "description": "Authorizes users to define virtual machine", "default": False},
+            {"name": "undefine", "description": "Authorizes users to undefine virtual machine", "default": False},
+            {"name": "capabilities", "description": "Authorizes users to access virtual machine's hypervisor capabilities", "default": False},
+            {"name": "free", "description": "Authorizes users completly destroy the virtual machine", "default": False}
+        ])
 
     def register_handlers(self):
         """
@@ -287,6 +294,16 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
         self.xmppclient.UnregisterHandler('iq', self.__process_iq_archipel_control, ns=ARCHIPEL_NS_VM_CONTROL)
         self.xmppclient.UnregisterHandler('iq', self.__process_iq_archipel_definition, ns=ARCHIPEL_NS_VM_DEFINITION)
 
+    def migrate_permission_database(self):
+        """
+        Import the legacy per virtual machine permission database into the
+        hypervisor shared permission store, and keep the old file as backup.
+        """
+        self.log.info("Migrating permission database %s into the shared permission store" % self.permission_db_file)
+        count = self.hypervisor.permission_store.import_database_file(self.uuid, self.permission_db_file)
+        os.rename(self.permission_db_file, "%s.migrated" % self.permission_db_file)
+        self.log.info("%d granted permissions have been migrated" % count)
+
     def remove_folder(self):
         """
         Remove the folder of the virtual with all its contents.
@@ -355,7 +372,10 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
         try:
             self.definition = xmpp.simplexml.NodeBuilder(data=str(self.domain.XMLDesc(0))).getDom()
             self.log.info("Successfully connect to domain uuid %s" % self.uuid)
-            self.libvirt_event_callback_id = self.libvirt_connection.domainEventRegisterAny(self.domain, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.on_domain_event, None)
+            if self.hypervisor.libvirt_event_dispatcher:
+                self.libvirt_event_callback_id = self.hypervisor.libvirt_event_dispatcher.register_domain_callback(self.uuid, self.on_domain_event)
+            else:
+                self.libvirt_event_callback_id = self.libvirt_connection.domainEventRegisterAny(self.domain, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.on_domain_event, None)
             self.set_presence_according_to_libvirt_info()
         except Exception as ex:
             self.log.error("Exception while connecting to domain : %s" % str(ex))
@@ -397,7 +417,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
                 self.perform_hooks("HOOK_VM_STOP")
             elif event == libvirt.VIR_DOMAIN_CRASHED:
                 self.change_presence("xa", ARCHIPEL_XMPP_SHOW_CRASHED)
-                self.push_change("virtualmachine:control", "crashed")
+                self.push_change("virtualmachine:control", "crashed", critical=True)
                 self.perform_hooks("HOOK_VM_CRASH")
             elif event == libvirt.VIR_DOMAIN_SHUTOFF:
                 self.change_presence("", ARCHIPEL_XMPP_SHOW_SHUTOFF)
@@ -430,7 +450,10 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
         """
         if not self.libvirt_event_callback_id is None:
             self.log.info("Removing the libvirt event listener for %s" % self.jid)
-            self.libvirt_connection.domainEventDeregisterAny(self.libvirt_event_callback_id)
+            if self.hypervisor.libvirt_event_dispatcher:
+                self.hypervisor.libvirt_event_dispatcher.unregister_domain_callback(self.libvirt_event_callback_id)
+            else:
+                self.libvirt_connection.domainEventDeregisterAny(self.libvirt_event_callback_id)
             self.libvirt_event_callback_id = None
 
     def disconnect(self):
@@ -439,9 +462,9 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
         """
         self.log.info("%s is disconnecting from everything" % self.jid)
         self.remove_libvirt_handler()
-        if self.libvirt_connection:
+        if self.libvirt_connection and not self.libvirt_connection_pool:
             self.libvirt_connection.close()
-            self.libvirt_connection = None
+        self.libvirt_connection = None
         self.perform_hooks("HOOK_XMPP_DISCONNECT")
         TNArchipelEntity.disconnect(self)
 
@@ -881,8 +904,11 @@ class TNArchipelVirtualMachine (TNArchipelEntity, archipelLibvirtEntity.TNArchip
         and remove own folder.
         """
         self.perform_hooks("HOOK_VM_TERMINATE")
-        self.permission_center.close_database()
-        os.unlink(self.permission_db_file)
+        if self.hypervisor.permission_store:
+            self.permission_center.delete_database()
+        else:
+            self.permission_center.close_database()
+            os.unlink(self.permission_db_file)
         self.remove_folder()
 
 
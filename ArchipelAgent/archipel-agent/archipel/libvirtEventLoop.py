@@ -7,19 +7,139 @@
 # Start off by implementing a general purpose event loop for anyones use
 #################################################################################
 
+import heapq
 import libvirt
 import os
 import select
+import sys
 import threading
 import time
 
 
+#
+# The backends used by the event loop to wait for file handle events.
+# They all take and return libvirt event constants, and a timeout in
+# milliseconds (-1 meaning infinite).
+#
+class virEventLoopPollBackend:
+    def __init__(self):
+        self.poll = select.poll()
+
+    def register(self, fd, events):
+        self.poll.register(fd, self.events_to_poll(events))
+
+    def modify(self, fd, events):
+        self.poll.unregister(fd)
+        self.poll.register(fd, self.events_to_poll(events))
+
+    def unregister(self, fd):
+        self.poll.unregister(fd)
+
+    def wait(self, timeout):
+        return [(fd, self.events_from_poll(revents)) for (fd, revents) in self.poll.poll(timeout)]
+
+    # Convert from libvirt event constants, to poll() events constants
+    def events_to_poll(self, events):
+        ret = 0
+        if events & libvirt.VIR_EVENT_HANDLE_READABLE:
+            ret |= select.POLLIN
+        if events & libvirt.VIR_EVENT_HANDLE_WRITABLE:
+            ret |= select.POLLOUT
+        if events & libvirt.VIR_EVENT_HANDLE_ERROR:
+            ret |= select.POLLERR
+        if events & libvirt.VIR_EVENT_HANDLE_HANGUP:
+            ret |= select.POLLHUP
+        return ret
+
+    # Convert from poll() event constants, to libvirt events constants
+    def events_from_poll(self, events):
+        ret = 0
+        if events & select.POLLIN:
+            ret |= libvirt.VIR_EVENT_HANDLE_READABLE
+        if events & select.POLLOUT:
+            ret |= libvirt.VIR_EVENT_HANDLE_WRITABLE
+        if events & select.POLLNVAL:
+            ret |= libvirt.VIR_EVENT_HANDLE_ERROR
+        if events & select.POLLERR:
+            ret |= libvirt.VIR_EVENT_HANDLE_ERROR
+        if events & select.POLLHUP:
+            ret |= libvirt.VIR_EVENT_HANDLE_HANGUP
+        return ret
+
+
+#
+# Linux only. Registrations are updated in place with epoll.modify(),
+# and events are retrieved by batches of maxevents. The epoll set is
+# level triggered, like poll(), as libvirt callbacks don't always
+# consume all the available data.
+#
+class virEventLoopEpollBackend:
+    def __init__(self, maxevents=256):
+        self.epoll = select.epoll()
+        self.maxevents = maxevents
+
+    def register(self, fd, events):
+        self.epoll.register(fd, self.events_to_epoll(events))
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, self.events_to_epoll(events))
+
+    # The kernel drops closed file descriptors from the epoll set by
+    # itself, so they can't be unregistered anymore
+    def unregister(self, fd):
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def wait(self, timeout):
+        if timeout >= 0:
+            timeout = timeout / 1000.0
+        return [(fd, self.events_from_epoll(revents)) for (fd, revents) in self.epoll.poll(timeout, self.maxevents)]
+
+    # Convert from libvirt event constants, to epoll events constants
+    def events_to_epoll(self, events):
+        ret = 0
+        if events & libvirt.VIR_EVENT_HANDLE_READABLE:
+            ret |= select.EPOLLIN | select.EPOLLPRI
+        if events & libvirt.VIR_EVENT_HANDLE_WRITABLE:
+            ret |= select.EPOLLOUT
+        if events & libvirt.VIR_EVENT_HANDLE_ERROR:
+            ret |= select.EPOLLERR
+        if events & libvirt.VIR_EVENT_HANDLE_HANGUP:
+            ret |= select.EPOLLHUP
+        return ret
+
+    # Convert from epoll event constants, to libvirt events constants.
+    # A peer shutdown (EPOLLRDHUP) is reported as a hangup
+    def events_from_epoll(self, events):
+        ret = 0
+        if events & (select.EPOLLIN | select.EPOLLPRI):
+            ret |= libvirt.VIR_EVENT_HANDLE_READABLE
+        if events & select.EPOLLOUT:
+            ret |= libvirt.VIR_EVENT_HANDLE_WRITABLE
+        if events & select.EPOLLERR:
+            ret |= libvirt.VIR_EVENT_HANDLE_ERROR
+        if events & (select.EPOLLHUP | getattr(select, "EPOLLRDHUP", 0)):
+            ret |= libvirt.VIR_EVENT_HANDLE_HANGUP
+        return ret
+
+
+virEventLoopBackends = {"poll": virEventLoopPollBackend}
+if hasattr(select, "epoll"):
+    virEventLoopBackends["epoll"] = virEventLoopEpollBackend
+
+
 #
 # This general purpose event loop will support waiting for file handle
 # I/O and errors events, as well as scheduling repeatable timers with
 # a fixed interval.
 #
-# It is a pure python implementation based around the poll() API
+# It is a pure python implementation based around the poll() API, or
+# epoll() on Linux.
+# Handles are indexed by ID and by file descriptor, and timer deadlines
+# are kept in a min-heap, so no operation has to walk all handles or
+# all timers.
 #
 class virEventLoopPure:
     # This class contains the data we need to track for a
@@ -60,6 +180,7 @@ class virEventLoopPure:
             self.cb = cb
             self.opaque = opaque
             self.lastfired = 0
+            self.deadline = None
 
         def get_id(self):
             return self.timer
@@ -82,15 +203,22 @@ class virEventLoopPure:
                     self.opaque[1])
 
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, backend="poll"):
+        if not backend in virEventLoopBackends:
+            raise Exception("Unsupported event loop backend %s" % backend)
         self.debugOn = debug
-        self.poll = select.poll()
+        self.backend = backend
+        self.poll = virEventLoopBackends[backend]()
         self.pipetrick = os.pipe()
         self.nextHandleID = 1
         self.nextTimerID = 1
-        self.handles = []
-        self.timers = []
+        self.handles = {}
+        self.handles_by_fd = {}
+        self.timers = {}
+        self.timers_heap = []
+        self.lock = threading.RLock()
         self.quit = False
+        self.wakeups = 0
 
         # The event loop can be used from multiple threads at once.
         # Specifically while the main thread is sleeping in poll()
@@ -106,41 +234,86 @@ class virEventLoopPure:
         # the main thread out of a poll() sleep, we simple write a
         # single byte of data to the other end of the pipe.
         self.debug("Self pipe watch %d write %d" %(self.pipetrick[0], self.pipetrick[1]))
-        self.poll.register(self.pipetrick[0], select.POLLIN)
+        self.poll.register(self.pipetrick[0], libvirt.VIR_EVENT_HANDLE_READABLE)
 
     def debug(self, msg):
         if self.debugOn:
             print msg
 
 
+    # Push the next deadline of the timer in the heap. Entries
+    # are never removed from the heap: an entry is stale if the
+    # timer has been removed, or if its deadline doesn't match
+    # the current one anymore (updated or fired).
+    def schedule_timer(self, t):
+        interval = t.get_interval()
+        if interval < 0:
+            t.deadline = None
+            return
+        t.deadline = t.get_last_fired() + interval
+        heapq.heappush(self.timers_heap, (t.deadline, t.get_id()))
+        # rebuild the heap if stale entries are piling up
+        if len(self.timers_heap) > 4 * len(self.timers) + 64:
+            self.timers_heap = [(timer.deadline, timer.get_id()) for timer in self.timers.values() if not timer.deadline is None]
+            heapq.heapify(self.timers_heap)
+
+    # Drop the stale entries at the top of the heap
+    def clean_timers_heap(self):
+        while self.timers_heap:
+            deadline, timerID = self.timers_heap[0]
+            t = self.timers.get(timerID)
+            if t and t.deadline == deadline:
+                return
+            heapq.heappop(self.timers_heap)
+
     # Calculate when the next timeout is due to occurr, returning
     # the absolute timestamp for the next timeout, or 0 if there is
     # no timeout due
     def next_timeout(self):
-        next = 0
-        for t in self.timers:
-            last = t.get_last_fired()
-            interval = t.get_interval()
-            if interval < 0:
-                continue
-            if next == 0 or (last + interval) < next:
-                next = last + interval
-
-        return next
+        self.lock.acquire()
+        try:
+            self.clean_timers_heap()
+            if not self.timers_heap:
+                return 0
+            return self.timers_heap[0][0]
+        finally:
+            self.lock.release()
 
     # Lookup a virEventLoopPureHandle object based on file descriptor
     def get_handle_by_fd(self, fd):
-        for h in self.handles:
-            if h.get_fd() == fd:
-                return h
-        return None
+        return self.handles_by_fd.get(fd)
 
     # Lookup a virEventLoopPureHandle object based on its event loop ID
     def get_handle_by_id(self, handleID):
-        for h in self.handles:
-            if h.get_id() == handleID:
-                return h
-        return None
+        return self.handles.get(handleID)
+
+    # Pop the timers that are due, and schedule their next expiry.
+    # Timers are rescheduled once the scan is done, so a timer with
+    # a short interval fires at most once per iteration
+    def pop_expired_timers(self, now):
+        expired = []
+        self.lock.acquire()
+        try:
+            while True:
+                self.clean_timers_heap()
+                if not self.timers_heap:
+                    break
+                deadline, timerID = self.timers_heap[0]
+                # Deduct 20ms, since schedular timeslice
+                # means we could be ever so slightly early
+                if now < (deadline - 20):
+                    break
+                heapq.heappop(self.timers_heap)
+                t = self.timers[timerID]
+                self.debug("Dispatch timer %d now %s want %s" % (timerID, str(now), str(deadline)))
+                t.deadline = None
+                expired.append(t)
+            for t in expired:
+                t.set_last_fired(now)
+                self.schedule_timer(t)
+        finally:
+            self.lock.release()
+        return expired
 
 
     # This is the heart of the event loop, performing one single
@@ -162,6 +335,8 @@ class virEventLoopPure:
     # back around the loop with a crazy 5ms sleep. So when checking
     # if timeouts are due, we allow a margin of 20ms, to avoid
     # these pointless repeated tiny sleeps.
+    #
+    # Note that the backends take their timeout in milliseconds.
     def run_once(self):
         sleep = -1
         next = self.next_timeout()
@@ -171,10 +346,11 @@ class virEventLoopPure:
             if now >= next:
                 sleep = 0
             else:
-                sleep = (next - now) / 1000.0
+                sleep = next - now
 
         self.debug("Poll with a sleep of %d" % sleep)
-        events = self.poll.poll(sleep)
+        events = self.poll.wait(sleep)
+        self.wakeups += 1
 
         # Dispatch any file handle events that occurred
         for (fd, revents) in events:
@@ -188,21 +364,12 @@ class virEventLoopPure:
             h = self.get_handle_by_fd(fd)
             if h:
                 self.debug("Dispatch fd %d handle %d events %d" % (fd, h.get_id(), revents))
-                h.dispatch(self.events_from_poll(revents))
+                h.dispatch(revents)
 
+        # Dispatch the timers that are due
         now = int(time.time() * 1000)
-        for t in self.timers:
-            interval = t.get_interval()
-            if interval < 0:
-                continue
-
-            want = t.get_last_fired() + interval
-            # Deduct 20ms, since schedular timeslice
-            # means we could be ever so slightly early
-            if now >= (want-20):
-                self.debug("Dispatch timer %d now %s want %s" % (t.get_id(), str(now), str(want)))
-                t.set_last_fired(now)
-                t.dispatch()
+        for t in self.pop_expired_timers(now):
+            t.dispatch()
 
 
     # Actually the event loop forever
@@ -224,9 +391,10 @@ class virEventLoopPure:
         self.nextHandleID = self.nextHandleID + 1
 
         h = self.virEventLoopPureHandle(handleID, fd, events, cb, opaque)
-        self.handles.append(h)
+        self.handles[handleID] = h
+        self.handles_by_fd[fd] = h
 
-        self.poll.register(fd, self.events_to_poll(events))
+        self.poll.register(fd, events)
         self.interrupt()
 
         self.debug("Add handle %d fd %d events %d" % (handleID, fd, events))
@@ -243,7 +411,12 @@ class virEventLoopPure:
         self.nextTimerID = self.nextTimerID + 1
 
         h = self.virEventLoopPureTimer(timerID, interval, cb, opaque)
-        self.timers.append(h)
+        self.lock.acquire()
+        try:
+            self.timers[timerID] = h
+            self.schedule_timer(h)
+        finally:
+            self.lock.release()
         self.interrupt()
 
         self.debug("Add timer %d interval %d" % (timerID, interval))
@@ -255,72 +428,47 @@ class virEventLoopPure:
         h = self.get_handle_by_id(handleID)
         if h:
             h.set_events(events)
-            self.poll.unregister(h.get_fd())
-            self.poll.register(h.get_fd(), self.events_to_poll(events))
+            self.poll.modify(h.get_fd(), events)
             self.interrupt()
 
             self.debug("Update handle %d fd %d events %d" % (handleID, h.get_fd(), events))
 
     # Change the periodic frequency of the timer
     def update_timer(self, timerID, interval):
-        for h in self.timers:
-            if h.get_id() == timerID:
-                h.set_interval(interval)
-                self.interrupt()
+        self.lock.acquire()
+        try:
+            h = self.timers.get(timerID)
+            if not h:
+                return
+            h.set_interval(interval)
+            self.schedule_timer(h)
+        finally:
+            self.lock.release()
+        self.interrupt()
 
-                self.debug("Update timer %d interval %d"  % (timerID, interval))
-                break
+        self.debug("Update timer %d interval %d"  % (timerID, interval))
 
     # Stop monitoring for events on the file handle
     def remove_handle(self, handleID):
-        handles = []
-        for h in self.handles:
-            if h.get_id() == handleID:
-                self.poll.unregister(h.get_fd())
-                self.debug("Remove handle %d fd %d" % (handleID, h.get_fd()))
-            else:
-                handles.append(h)
-        self.handles = handles
+        h = self.handles.pop(handleID, None)
+        if h:
+            if self.handles_by_fd.get(h.get_fd()) is h:
+                del self.handles_by_fd[h.get_fd()]
+            self.poll.unregister(h.get_fd())
+            self.debug("Remove handle %d fd %d" % (handleID, h.get_fd()))
         self.interrupt()
 
-    # Stop firing the periodic timer
+    # Stop firing the periodic timer. Its heap entries become stale
+    # and will be dropped when they reach the top of the heap
     def remove_timer(self, timerID):
-        timers = []
-        for h in self.timers:
-            if h.get_id() != timerID:
-                timers.append(h)
+        self.lock.acquire()
+        try:
+            if self.timers.pop(timerID, None):
                 self.debug("Remove timer %d" % timerID)
-        self.timers = timers
+        finally:
+            self.lock.release()
         self.interrupt()
 
-    # Convert from libvirt event constants, to poll() events constants
-    def events_to_poll(self, events):
-        ret = 0
-        if events & libvirt.VIR_EVENT_HANDLE_READABLE:
-            ret |= select.POLLIN
-        if events & libvirt.VIR_EVENT_HANDLE_WRITABLE:
-            ret |= select.POLLOUT
-        if events & libvirt.VIR_EVENT_HANDLE_ERROR:
-            ret |= select.POLLERR
-        if events & libvirt.VIR_EVENT_HANDLE_HANGUP:
-            ret |= select.POLLHUP
-        return ret
-
-    # Convert from poll() event constants, to libvirt events constants
-    def events_from_poll(self, events):
-        ret = 0
-        if events & select.POLLIN:
-            ret |= libvirt.VIR_EVENT_HANDLE_READABLE
-        if events & select.POLLOUT:
-            ret |= libvirt.VIR_EVENT_HANDLE_WRITABLE
-        if events & select.POLLNVAL:
-            ret |= libvirt.VIR_EVENT_HANDLE_ERROR
-        if events & select.POLLERR:
-            ret |= libvirt.VIR_EVENT_HANDLE_ERROR
-        if events & select.POLLHUP:
-            ret |= libvirt.VIR_EVENT_HANDLE_HANGUP
-        return ret
-
 
 
 
@@ -381,10 +529,114 @@ def virEventLoopPureRun():
     global eventLoop
     eventLoop.run_loop()
 
-# Spawn a background thread to run the event loop
-def virEventLoopPureStart():
+# Spawn a background thread to run the event loop, using the
+# given backend ("poll", or "epoll" on Linux)
+def virEventLoopPureStart(backend="poll"):
+    global eventLoop
     global eventLoopThread
+    if not eventLoop.backend == backend:
+        eventLoop = virEventLoopPure(debug=False, backend=backend)
     virEventLoopPureRegister()
     eventLoopThread = threading.Thread(target=virEventLoopPureRun, name="libvirtEventLoop")
     eventLoopThread.setDaemon(True)
-    eventLoopThread.start()
\ No newline at end of file
+    eventLoopThread.start()
+
+
+# Micro-benchmark of the event loop: registers a growing number of file
+# handles and timers, then reports the number of wakeups per second and the
+# latency between a write on a random handle and the dispatch of its event.
+#
+# Usage: python libvirtEventLoop.py [duration] [backend]
+# The short timers regression check is run first.
+def benchmark(sizes=((10, 10), (100, 100), (400, 1000)), duration=5.0, backends=None):
+    import random
+    results = []
+    for backend, nb_handles, nb_timers in [(b, h, t) for b in (backends or sorted(virEventLoopBackends.keys())) for (h, t) in sizes]:
+        loop = virEventLoopPure(backend=backend)
+        latencies = []
+        pipes = []
+        sent = {}
+
+        def on_handle(handleID, fd, events, opaque1, opaque2):
+            os.read(fd, 1)
+            if fd in sent:
+                latencies.append(time.time() - sent.pop(fd))
+
+        def on_timer(timerID, opaque1, opaque2):
+            pass
+
+        for i in range(nb_handles):
+            pipe = os.pipe()
+            pipes.append(pipe)
+            loop.add_handle(pipe[0], libvirt.VIR_EVENT_HANDLE_READABLE, on_handle, (None, None))
+        for i in range(nb_timers):
+            loop.add_timer(random.randint(1000, 5000), on_timer, (None, None))
+
+        thread = threading.Thread(target=loop.run_loop)
+        thread.setDaemon(True)
+        thread.start()
+        start = time.time()
+        while time.time() - start < duration:
+            read_fd, write_fd = random.choice(pipes)
+            sent[read_fd] = time.time()
+            os.write(write_fd, "x")
+            time.sleep(0.01)
+        loop.quit = True
+        loop.interrupt()
+        thread.join()
+        wakeups = loop.wakeups / (time.time() - start)
+
+        for read_fd, write_fd in pipes:
+            os.close(read_fd)
+            os.close(write_fd)
+        latencies.sort()
+        if latencies:
+            average = 1000 * sum(latencies) / len(latencies)
+            p99 = 1000 * latencies[int(len(latencies) * 0.99)]
+        else:
+            average = p99 = 0.0
+        results.append((backend, nb_handles, nb_timers, wakeups, average, p99))
+        print "backend: %-5s  handles: %5d  timers: %5d  wakeups/s: %8.1f  dispatch latency avg: %.3fms  p99: %.3fms" % results[-1]
+    return results
+
+
+# Regression check for the timers shorter than the 20ms scheduling margin:
+# a 0ms and a 10ms timer must fire while the loop keeps running, and
+# updating a timer from another thread must not block.
+def check_short_timers(duration=0.5, backends=None):
+    success = True
+    for backend in (backends or sorted(virEventLoopBackends.keys())):
+        loop = virEventLoopPure(backend=backend)
+        fired = {}
+
+        def on_timer(timerID, opaque1, opaque2):
+            fired[timerID] = fired.get(timerID, 0) + 1
+
+        timers = [loop.add_timer(interval, on_timer, (None, None)) for interval in (0, 10)]
+        thread = threading.Thread(target=loop.run_loop)
+        thread.setDaemon(True)
+        thread.start()
+        time.sleep(duration / 2)
+        updater = threading.Thread(target=loop.update_timer, args=(timers[1], 0))
+        updater.setDaemon(True)
+        updater.start()
+        updater.join(duration)
+        time.sleep(duration / 2)
+        loop.quit = True
+        loop.interrupt()
+        thread.join(duration)
+        ok = not thread.isAlive() and not updater.isAlive() and all([fired.get(timerID) for timerID in timers])
+        success = success and ok
+        print "backend: %-5s  short timers fired: %s  %s" % (backend, [fired.get(timerID, 0) for timerID in timers], ok and "OK" or "FAILED")
+    return success
+
+
+if __name__ == "__main__":
+    if not check_short_timers(backends=len(sys.argv) > 2 and [sys.argv[2]] or None):
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        benchmark(duration=float(sys.argv[1]), backends=[sys.argv[2]])
+    elif len(sys.argv) > 1:
+        benchmark(duration=float(sys.argv[1]))
+    else:
+        benchmark()
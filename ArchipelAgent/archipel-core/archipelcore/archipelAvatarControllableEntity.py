@@ -21,7 +21,9 @@
 
 import base64
 import glob
+import hashlib
 import os
+import threading
 import xmpp
 
 from archipelcore.utils import build_error_iq
@@ -32,6 +34,94 @@ ARCHIPEL_ERROR_CODE_SET_AVATAR          = -2
 
 ARCHIPEL_NS_AVATAR                              = "archipel:avatar"
 
+ARCHIPEL_AVATAR_EXTENSIONS              = ["png", "jpg", "jpeg", "gif"]
+
+
+class TNArchipelAvatar (object):
+    """
+    An encoded avatar, as stored in L{TNArchipelAvatarCache}.
+    """
+
+    def __init__(self, path, mtime, data):
+        """
+        Encode the avatar.
+        @type path: string
+        @param path: the path of the image
+        @type mtime: float
+        @param mtime: the modification time of the file
+        @type data: string
+        @param data: the content of the file
+        """
+        self.path           = path
+        self.mtime          = mtime
+        self.name           = os.path.basename(path)
+        extension           = os.path.splitext(path)[1][1:].lower()
+        self.content_type   = "image/%s" % {"jpg": "jpeg"}.get(extension, extension)
+        self.b64data        = base64.b64encode(data)
+        self.sha1           = hashlib.sha1(data).hexdigest()
+
+
+class TNArchipelAvatarCache (object):
+    """
+    Cache of the encoded avatars, shared by all entities. Entries are
+    keyed by path and revalidated with the file modification time, and
+    directory listings with the directory modification time.
+    """
+
+    def __init__(self):
+        """
+        Initialize the cache.
+        """
+        self.lock           = threading.Lock()
+        self.avatars        = {}
+        self.directories    = {}
+
+    def get(self, path):
+        """
+        Return the encoded avatar of given path, reading it if needed.
+        @type path: string
+        @param path: the path of the image
+        @rtype: L{TNArchipelAvatar}
+        @return: the avatar
+        """
+        mtime = os.stat(path).st_mtime
+        with self.lock:
+            avatar = self.avatars.get(path)
+        if avatar and avatar.mtime == mtime:
+            return avatar
+        f = open(path, 'r')
+        avatar = TNArchipelAvatar(path, mtime, f.read())
+        f.close()
+        with self.lock:
+            self.avatars[path] = avatar
+        return avatar
+
+    def list(self, directory, extensions=ARCHIPEL_AVATAR_EXTENSIONS):
+        """
+        Return the encoded avatars of a directory.
+        @type directory: string
+        @param directory: the avatar directory
+        @type extensions: list
+        @param extensions: the supported file extensions
+        @rtype: list
+        @return: list of L{TNArchipelAvatar}
+        """
+        mtime = os.stat(directory).st_mtime
+        key = (directory, tuple(extensions))
+        with self.lock:
+            entry = self.directories.get(key)
+        if not entry or not entry[0] == mtime:
+            paths = []
+            for ctype in extensions:
+                paths.extend(glob.glob(os.path.join(directory, "*.%s" % ctype)))
+            entry = (mtime, paths)
+            with self.lock:
+                self.directories[key] = entry
+        return [self.get(path) for path in entry[1]]
+
+
+avatar_cache = TNArchipelAvatarCache()
+
 
 class TNAvatarControllableEntity (object):
     """
@@ -53,6 +143,8 @@ class TNAvatarControllableEntity (object):
         """
         self.configuration          = configuration
         self.b64Avatar              = None
+        self.avatar_hash            = None
+        self.avatar_content_type    = "image/png"
         self.default_avatar         = "default.png"
         self.permission_center      = permission_center
         self.xmppclient             = xmppclient
@@ -102,8 +194,10 @@ class TNAvatarControllableEntity (object):
         """
         Initialize the Avatar permissions.
         """
-        self.permission_center.create_permission("getavatars", "Authorizes users to get entity avatars list", False)
-        self.permission_center.create_permission("setavatar", "Authorizes users to set entity's avatar", False)
+        self.permission_center.create_permissions([
+            {"name": "getavatars", "description": "Authorizes users to get entity avatars list", "default": False},
+            {"name": "setavatar", "description": "Authorizes users to set entity's avatar", "default": False}
+        ])
 
     def register_handlers(self):
         """
@@ -120,20 +214,25 @@ class TNAvatarControllableEntity (object):
 
     ### Avatars
 
-    def get_available_avatars(self, supported_file_extensions=["png", "jpg", "jpeg", "gif"]):
+    def get_available_avatars(self, supported_file_extensions=ARCHIPEL_AVATAR_EXTENSIONS, names_only=False, name=None):
         """
         Return a stanza with a list of availables avatars
         base64 encoded.
+        @type supported_file_extensions: list
+        @param supported_file_extensions: the extensions of the files to list
+        @type names_only: Boolean
+        @param names_only: if True, only give the names and SHA-1 hashes, clients will ask for each image with name
+        @type name: string
+        @param name: if set, only give this avatar
         """
         path = self.configuration.get("GLOBAL", "machine_avatar_directory")
         resp = xmpp.Node("avatars")
-        for ctype in supported_file_extensions:
-            for img in glob.glob(os.path.join(path, "*.%s" % ctype)):
-                f = open(img, 'r')
-                data = base64.b64encode(f.read())
-                f.close()
-                node_img = resp.addChild(name="avatar", attrs={"name": img.split("/")[-1], "content-type": "image/%s" % ctype})
-                node_img.setData(data)
+        for avatar in avatar_cache.list(path, supported_file_extensions):
+            if name and not avatar.name == name:
+                continue
+            node_img = resp.addChild(name="avatar", attrs={"name": avatar.name, "content-type": avatar.content_type, "hash": avatar.sha1})
+            if not names_only:
+                node_img.setData(avatar.b64data)
         return resp
 
     def set_avatar(self, name):
@@ -155,18 +254,19 @@ class TNAvatarControllableEntity (object):
         @return base64 encoded file content
         """
         avatar_dir  = self.configuration.get("GLOBAL", "machine_avatar_directory")
-        f = open(os.path.join(avatar_dir, image), "r")
-        photo_data = base64.b64encode(f.read())
-        f.close()
-        self.b64Avatar = photo_data
+        avatar = avatar_cache.get(os.path.join(avatar_dir, image))
+        self.b64Avatar = avatar.b64data
+        self.avatar_hash = avatar.sha1
+        self.avatar_content_type = avatar.content_type
         return self.b64Avatar
 
     def process_avatar_iq(self, conn, iq):
         """
         This method is invoked when a ARCHIPEL_NS_AVATAR IQ is received.
         It understands IQ of type:
-            - alloc
-            - free
+            - getavatars
+            - getavatar
+            - setavatar
         @type conn: xmpp.Dispatcher
         @param conn: ths instance of the current connection that send the stanza
         @type iq: xmpp.Protocol.Iq
@@ -174,8 +274,11 @@ class TNAvatarControllableEntity (object):
         """
         reply = None
         action = self.check_acp(conn, iq)
-        self.check_perm(conn, iq, action, -1)
-        if action == "getavatars":
+        if action == "getavatar":
+            self.check_perm(conn, iq, "getavatars", -1)
+        else:
+            self.check_perm(conn, iq, action, -1)
+        if action in ("getavatars", "getavatar"):
             reply = self.iq_get_available_avatars(iq)
         elif action == "setavatar":
             reply = self.iq_set_available_avatars(iq)
@@ -185,13 +288,19 @@ class TNAvatarControllableEntity (object):
 
     def iq_get_available_avatars(self, iq):
         """
-        Return a list of availables avatars.
+        Return a list of availables avatars. If the request has the attribute
+        namesonly set to "true", only the names and hashes are given. The
+        getavatar action gives the avatar with the requested name.
         @type iq: xmpp.Protocol.Iq
         @param iq: the IQ containing the request
         """
         try:
             reply = iq.buildReply("result")
-            reply.setQueryPayload([self.get_available_avatars()])
+            archipel = iq.getTag("query").getTag("archipel")
+            if archipel.getAttr("action") == "getavatar":
+                reply.setQueryPayload([self.get_available_avatars(name=archipel.getAttr("name"))])
+            else:
+                reply.setQueryPayload([self.get_available_avatars(names_only=(archipel.getAttr("namesonly") == "true"))])
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_AVATARS)
         return reply
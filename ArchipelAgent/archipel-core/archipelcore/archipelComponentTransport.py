@@ -0,0 +1,737 @@
+# -*- coding: utf-8 -*-
+#
+# archipelComponentTransport.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains the XEP-0114 external component transport. It allows to run a lot of
+L{TNArchipelEntity} over one single XMPP connection: the component owns a
+domain, and every stanza sent to a JID of this domain is routed to the
+registered entity by its bare JID.
+
+As a component doesn't have a server side roster nor vCard storage, they are
+managed here: rosters are kept in a sqlite3 database, vCards in memory, and
+presences are broadcasted by the transport to the subscribers.
+"""
+
+import sqlite3
+import threading
+import time
+import xmpp
+
+from archipelcore.utils import TNArchipelLogger
+
+
+ARCHIPEL_COMPONENT_DEFAULT_PORT     = 5347
+ARCHIPEL_COMPONENT_RECONNECT_DELAY  = 5.0
+ARCHIPEL_COMPONENT_RESPONSE_TIMEOUT = 25
+
+
+class TNArchipelComponentRoster (object):
+    """
+    Roster of an entity connected through the component transport. It
+    implements the subset of xmpp.roster.Roster used by the entities.
+    """
+
+    def __init__(self, transport, owner):
+        """
+        Initialize the roster.
+        @type transport: L{TNArchipelComponentTransport}
+        @param transport: the transport that stores the roster
+        @type owner: string
+        @param owner: the bare JID of the owner of the roster
+        """
+        self.transport  = transport
+        self.owner      = owner
+        self.session    = None
+        self.items      = {}
+
+    def _bare(self, jid):
+        return xmpp.JID(jid).getStripped()
+
+    def _send(self, jid, typ):
+        self.session.send(xmpp.Presence(to=self._bare(jid), typ=typ))
+
+    def update_item(self, jid, subscription=None, name=None, groups=None, add=None, remove=None):
+        """
+        Update the item and save it.
+        @type jid: string
+        @param jid: the bare JID of the contact
+        @type subscription: string
+        @param subscription: set the subscription to this value
+        @type add: string
+        @param add: add "to" or "from" to the subscription
+        @type remove: string
+        @param remove: remove "to" or "from" from the subscription
+        """
+        item = self.items.setdefault(jid, {"subscription": "none", "name": None, "groups": [], "resources": {}})
+        if subscription:
+            item["subscription"] = subscription
+        if name:
+            item["name"] = name
+        if not groups is None:
+            item["groups"] = groups
+        states = set(item["subscription"] == "both" and ("to", "from") or (item["subscription"],))
+        states.discard("none")
+        if add:
+            states.add(add)
+        if remove:
+            states.discard(remove)
+        if len(states) == 2:
+            item["subscription"] = "both"
+        elif len(states) == 1:
+            item["subscription"] = states.pop()
+        else:
+            item["subscription"] = "none"
+        self.transport.save_roster_item(self.owner, jid, item)
+
+    def remove_item(self, jid):
+        """
+        Remove the item and delete it from database.
+        @type jid: string
+        @param jid: the bare JID of the contact
+        """
+        if jid in self.items:
+            del self.items[jid]
+        self.transport.delete_roster_item(self.owner, jid)
+
+    def subscribers(self):
+        """
+        Return the contacts that receive the presence of the owner.
+        @rtype: list
+        @return: list of bare JIDs
+        """
+        return [jid for jid, item in self.items.items() if item["subscription"] in ("from", "both")]
+
+    def subscriptions(self):
+        """
+        Return the contacts the owner receives the presence from.
+        @rtype: list
+        @return: list of bare JIDs
+        """
+        return [jid for jid, item in self.items.items() if item["subscription"] in ("to", "both")]
+
+    def getItems(self):
+        return self.items.keys()
+
+    def getSubscription(self, jid):
+        return self.items[self._bare(jid)]["subscription"]
+
+    def getName(self, jid):
+        return self.items[self._bare(jid)]["name"]
+
+    def getGroups(self, jid):
+        return self.items[self._bare(jid)]["groups"]
+
+    def getResources(self, jid):
+        return self.items[self._bare(jid)]["resources"].keys()
+
+    def setItem(self, jid, name=None, groups=[]):
+        self.update_item(self._bare(jid), name=name, groups=groups)
+
+    def delItem(self, jid):
+        jid = self._bare(jid)
+        if not jid in self.items:
+            return
+        subscription = self.items[jid]["subscription"]
+        if subscription in ("to", "both"):
+            self._send(jid, "unsubscribe")
+        if subscription in ("from", "both"):
+            self._send(jid, "unsubscribed")
+        self.remove_item(jid)
+
+    def Subscribe(self, jid):
+        self._send(jid, "subscribe")
+
+    def Unsubscribe(self, jid):
+        self._send(jid, "unsubscribe")
+
+    def Authorize(self, jid):
+        self._send(jid, "subscribed")
+
+    def Unauthorize(self, jid):
+        self._send(jid, "unsubscribed")
+
+
+class TNArchipelComponentSession (object):
+    """
+    The connection object given to an entity using the component transport.
+    It implements the subset of xmpp.Client used by the entities, so
+    handlers keep receiving it as their conn argument.
+    """
+
+    def __init__(self, transport, entity, roster):
+        """
+        Initialize the session.
+        @type transport: L{TNArchipelComponentTransport}
+        @param transport: the transport to use
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity using the session
+        @type roster: L{TNArchipelComponentRoster}
+        @param roster: the roster of the entity
+        """
+        self.transport          = transport
+        self.entity             = entity
+        self.jid                = str(entity.jid)
+        self.bare_jid           = entity.jid.getStripped()
+        self.roster             = roster
+        self.roster.session     = self
+        self.handlers           = {"iq": [], "message": [], "presence": []}
+        self.expected           = {}
+        self.expected_condition = threading.Condition()
+        self.last_presence      = None
+        self.attached           = True
+
+    ### Client API
+
+    def isConnected(self):
+        return self.attached and self.transport.isConnected()
+
+    def getRoster(self):
+        return self.roster
+
+    def RegisterHandler(self, name, handler, typ="", ns="", xmlns=None, makefirst=0, system=0):
+        entry = {"func": handler, "typ": typ, "ns": ns}
+        if makefirst:
+            self.handlers.setdefault(name, []).insert(0, entry)
+        else:
+            self.handlers.setdefault(name, []).append(entry)
+
+    def UnregisterHandler(self, name, handler, typ="", ns="", xmlns=None):
+        for entry in self.handlers.get(name, []):
+            if entry["func"] == handler and entry["typ"] == typ and entry["ns"] == ns:
+                self.handlers[name].remove(entry)
+                return
+
+    def send(self, stanza):
+        """
+        Send a stanza from the entity. Presences without recipient are
+        broadcasted to the subscribers, and vCard requests addressed to the
+        own account are answered locally.
+        @type stanza: xmpp.Protocol
+        @param stanza: the stanza to send
+        @rtype: string
+        @return: the ID of the stanza
+        """
+        if not stanza.getAttr("from"):
+            stanza.setFrom(self.jid)
+        if not stanza.getID():
+            stanza.setID(self.transport.next_id())
+        name = stanza.getName()
+        if name == "iq" and self._is_own_vcard_request(stanza):
+            self._process_own_vcard_request(stanza)
+            return stanza.getID()
+        if name == "presence":
+            if not stanza.getTo():
+                self._broadcast_presence(stanza)
+                return stanza.getID()
+            self._track_outgoing_subscription(stanza)
+        self.transport.send(stanza)
+        return stanza.getID()
+
+    def SendAndCallForResponse(self, stanza, func, args={}):
+        self.expected_condition.acquire()
+        try:
+            ID = stanza.getID() or self.transport.next_id()
+            stanza.setID(ID)
+            self.expected[ID] = (func, args)
+        finally:
+            self.expected_condition.release()
+        self.send(stanza)
+
+    def SendAndWaitForResponse(self, stanza, timeout=ARCHIPEL_COMPONENT_RESPONSE_TIMEOUT):
+        self.expected_condition.acquire()
+        try:
+            ID = stanza.getID() or self.transport.next_id()
+            stanza.setID(ID)
+            self.expected[ID] = None
+        finally:
+            self.expected_condition.release()
+        self.send(stanza)
+        return self.WaitForResponse(ID, timeout)
+
+    def WaitForResponse(self, ID, timeout=ARCHIPEL_COMPONENT_RESPONSE_TIMEOUT):
+        """
+        Wait for the response of the stanza with the given ID. If called
+        from the reactor thread, the reactor is processed until the response
+        arrives, like xmpp.Dispatcher does.
+        """
+        abort_time = time.time() + timeout
+        in_reactor = threading.currentThread() is self.transport
+        self.expected_condition.acquire()
+        try:
+            while self.expected.get(ID) is None and time.time() < abort_time:
+                if in_reactor:
+                    self.expected_condition.release()
+                    try:
+                        if not self.transport.process(0.04):
+                            break
+                    finally:
+                        self.expected_condition.acquire()
+                else:
+                    self.expected_condition.wait(min(1.0, max(0.0, abort_time - time.time())))
+            return self.expected.pop(ID, None)
+        finally:
+            self.expected_condition.release()
+
+    def disconnect(self):
+        """
+        Send the unavailable presence and detach the entity from the transport.
+        """
+        if not self.attached:
+            return
+        self._broadcast_presence(xmpp.Presence(frm=self.jid, typ="unavailable"))
+        self.attached = False
+        self.transport.detach(self)
+
+    ### Routing
+
+    def announce(self):
+        """
+        Probe the presence of the contacts and send back the last presence to the subscribers.
+        """
+        for jid in self.roster.subscriptions():
+            self.transport.send(xmpp.Presence(to=jid, frm=self.jid, typ="probe"))
+        if self.last_presence:
+            self._broadcast_presence(self.last_presence)
+
+    def dispatch(self, stanza):
+        """
+        Dispatch an incoming stanza to the entity handlers.
+        @type stanza: xmpp.Protocol
+        @param stanza: the incoming stanza
+        """
+        name = stanza.getName()
+        typ = stanza.getType() or ""
+        if name == "iq" and typ in ("result", "error") and self._process_expected(stanza):
+            return
+        if name == "presence" and self._process_incoming_presence(stanza):
+            return
+        if name == "iq" and typ == "get" and stanza.getQueryNS() == xmpp.NS_VCARD:
+            self.transport.send(self._build_vcard_reply(stanza))
+            return
+        props = stanza.getProperties()
+        processed = False
+        for entry in list(self.handlers.get(name, [])):
+            if entry["typ"] and not entry["typ"] == typ:
+                continue
+            if entry["ns"] and not entry["ns"] in props:
+                continue
+            try:
+                entry["func"](self, stanza)
+            except xmpp.protocol.NodeProcessed:
+                processed = True
+                break
+        if not processed and name == "iq" and typ in ("get", "set"):
+            self.transport.send(xmpp.Error(stanza, xmpp.ERR_FEATURE_NOT_IMPLEMENTED))
+
+    def _process_expected(self, stanza):
+        ID = stanza.getID()
+        self.expected_condition.acquire()
+        try:
+            if not ID in self.expected:
+                return False
+            waiter = self.expected[ID]
+            if waiter is None:
+                self.expected[ID] = stanza
+                self.expected_condition.notifyAll()
+                return True
+            del self.expected[ID]
+        finally:
+            self.expected_condition.release()
+        func, args = waiter
+        try:
+            func(self, stanza, **args)
+        except xmpp.protocol.NodeProcessed:
+            pass
+        return True
+
+    def _process_incoming_presence(self, presence):
+        """
+        Update the roster according to the presence. Returns True if
+        the presence has been fully processed here.
+        """
+        jid = presence.getFrom()
+        bare = jid.getStripped()
+        typ = presence.getType()
+        if typ == "probe":
+            if bare in self.roster.subscribers() and self.last_presence:
+                reply = xmpp.Presence(node=self.last_presence)
+                reply.setTo(jid)
+                self.transport.send(reply)
+            return True
+        if typ == "subscribe":
+            if not bare in self.roster.items:
+                self.roster.update_item(bare)
+        elif typ == "subscribed":
+            self.roster.update_item(bare, add="to")
+        elif typ == "unsubscribe":
+            if bare in self.roster.items:
+                self.roster.update_item(bare, remove="from")
+        elif typ == "unsubscribed":
+            if bare in self.roster.items:
+                self.roster.update_item(bare, remove="to")
+        elif bare in self.roster.items:
+            resources = self.roster.items[bare]["resources"]
+            if typ == "unavailable":
+                resources.pop(jid.getResource(), None)
+            elif not typ:
+                resources[jid.getResource()] = {"show": presence.getShow(), "status": presence.getStatus(), "priority": presence.getPriority()}
+        return False
+
+    def _track_outgoing_subscription(self, presence):
+        bare = presence.getTo().getStripped()
+        typ = presence.getType()
+        if typ == "subscribe":
+            if not bare in self.roster.items:
+                self.roster.update_item(bare)
+        elif typ == "subscribed":
+            self.roster.update_item(bare, add="from")
+            if self.last_presence:
+                reply = xmpp.Presence(node=self.last_presence)
+                reply.setTo(bare)
+                self.transport.send(reply)
+        elif typ == "unsubscribed" and bare in self.roster.items:
+            self.roster.update_item(bare, remove="from")
+        elif typ == "unsubscribe" and bare in self.roster.items:
+            self.roster.update_item(bare, remove="to")
+
+    def _broadcast_presence(self, presence):
+        if not presence.getType():
+            self.last_presence = presence
+        for jid in self.roster.subscribers():
+            copy = xmpp.Presence(node=presence)
+            copy.setTo(jid)
+            copy.setID(self.transport.next_id())
+            self.transport.send(copy)
+
+    ### vCard
+
+    def _is_own_vcard_request(self, iq):
+        if not iq.getTag("vCard", namespace=xmpp.NS_VCARD):
+            return False
+        return not iq.getTo() or iq.getTo().getStripped() == self.bare_jid
+
+    def _process_own_vcard_request(self, iq):
+        if iq.getType() == "set":
+            self.transport.vcards[self.bare_jid] = iq.getTag("vCard")
+            reply = self._build_result(iq)
+        else:
+            reply = self._build_vcard_reply(iq)
+        reply.setFrom(self.bare_jid)
+        reply.setTo(self.jid)
+        self._process_expected(reply)
+
+    def _build_result(self, iq):
+        reply = xmpp.Iq(typ="result", to=iq.getFrom(), frm=iq.getTo())
+        if iq.getID():
+            reply.setID(iq.getID())
+        return reply
+
+    def _build_vcard_reply(self, iq):
+        reply = self._build_result(iq)
+        vcard = self.transport.vcards.get(self.bare_jid)
+        if vcard:
+            reply.addChild(node=vcard)
+        else:
+            reply.addChild(name="vCard", namespace=xmpp.NS_VCARD)
+        return reply
+
+
+class TNArchipelComponentTransport (threading.Thread):
+    """
+    XEP-0114 external component connection shared by several entities.
+    The thread is the reactor: it reads the socket and dispatches every
+    stanza to the session of the entity it is addressed to.
+    """
+
+    def __init__(self, domain, secret, server, port=ARCHIPEL_COMPONENT_DEFAULT_PORT, roster_database_file=None, debug=False):
+        """
+        Initialize the transport.
+        @type domain: string
+        @param domain: the domain of the component
+        @type secret: string
+        @param secret: the shared secret of the component
+        @type server: string
+        @param server: the address of the XMPP server
+        @type port: integer
+        @param port: the component port of the XMPP server
+        @type roster_database_file: string
+        @param roster_database_file: the sqlite3 file to store rosters (if None, rosters are kept in memory)
+        @type debug: Boolean
+        @param debug: if True, xmpppy will be in debug mode
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.domain         = domain
+        self.secret         = secret
+        self.server         = server
+        self.port           = port
+        self.debug          = debug
+        self.jid            = xmpp.JID(domain)
+        self.log            = TNArchipelLogger(self)
+        self.component      = None
+        self.running        = False
+        self.entities       = {}
+        self.sessions       = {}
+        self.rosters        = {}
+        self.vcards         = {}
+        self.send_lock      = threading.RLock()
+        self.entities_lock  = threading.RLock()
+        self.id_lock        = threading.Lock()
+        self.id_counter     = 0
+        self.stanzas_in     = 0
+        self.stanzas_out    = 0
+        self.database       = None
+        if roster_database_file:
+            self.database = sqlite3.connect(roster_database_file, check_same_thread=False)
+            self.database.execute("create table if not exists rosters (entity text, jid text, subscription text, name text, groups text, primary key (entity, jid))")
+            self.database.commit()
+        self.database_lock  = threading.Lock()
+
+    ### Connection
+
+    def connect(self):
+        """
+        Connect and authenticate the component.
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        debug_mode = []
+        if self.debug:
+            debug_mode = ['always', 'nodebuilder']
+        component = xmpp.Component(self.domain, port=self.port, debug=debug_mode)
+        if not component.connect(server=(self.server, self.port)):
+            self.log.error("Unable to connect component %s to %s:%s", self.domain, self.server, self.port)
+            return False
+        if not component.auth(self.domain, self.secret):
+            self.log.error("Unable to authenticate component %s", self.domain)
+            return False
+        for name in ("iq", "message", "presence"):
+            component.RegisterHandler(name, self.route)
+        self.component = component
+        self.log.info("Component %s connected to %s:%s", self.domain, self.server, self.port)
+        return True
+
+    def isConnected(self):
+        return bool(self.component and self.component.isConnected())
+
+    def reconnect_entities(self):
+        """
+        Give a new session to all attached entities and authenticate them again.
+        """
+        self.entities_lock.acquire()
+        try:
+            entities = self.entities.values()
+        finally:
+            self.entities_lock.release()
+        for entity in entities:
+            try:
+                entity.xmppclient = None
+                entity.connect()
+            except Exception as ex:
+                self.log.error("Unable to reconnect entity %s: %s", entity.jid, ex)
+
+    def stop(self):
+        """
+        Stop the reactor and close the connection.
+        """
+        self.running = False
+        if self.isConnected():
+            self.component.disconnect()
+        if self.database:
+            self.database.close()
+
+    ### Reactor
+
+    def process(self, timeout):
+        """
+        Process incoming data for the given time.
+        @type timeout: float
+        @param timeout: the max time to wait for data
+        @rtype: Boolean
+        @return: False if the connection is lost
+        """
+        if not self.isConnected():
+            return False
+        return bool(self.component.Process(timeout))
+
+    def run(self):
+        """
+        The reactor loop. Reconnects and re-authenticates all the entities
+        if the connection is lost.
+        """
+        self.running = True
+        while self.running:
+            try:
+                if not self.isConnected():
+                    if not self.connect():
+                        time.sleep(ARCHIPEL_COMPONENT_RECONNECT_DELAY)
+                        continue
+                    self.reconnect_entities()
+                self.process(1)
+            except Exception as ex:
+                self.log.error("COMPONENT LOOP EXCEPTION: %s. Reconnecting in %s seconds.", ex, ARCHIPEL_COMPONENT_RECONNECT_DELAY)
+                self.component = None
+                time.sleep(ARCHIPEL_COMPONENT_RECONNECT_DELAY)
+
+    def route(self, conn, stanza):
+        """
+        Route a stanza to the session of its recipient.
+        """
+        self.stanzas_in += 1
+        to = stanza.getTo()
+        session = self.sessions.get(to and to.getStripped())
+        if session:
+            try:
+                session.dispatch(stanza)
+            except Exception as ex:
+                self.log.error("Exception while dispatching %s stanza to %s: %s", stanza.getName(), to, ex)
+        elif stanza.getName() == "iq" and stanza.getType() in ("get", "set"):
+            self.send(xmpp.Error(stanza, xmpp.ERR_ITEM_NOT_FOUND))
+        raise xmpp.protocol.NodeProcessed
+
+    def send(self, stanza):
+        """
+        Send a stanza over the component connection. Thread safe.
+        @type stanza: xmpp.Protocol
+        @param stanza: the stanza to send
+        """
+        if not self.isConnected():
+            self.log.warning("Component not connected. Dropping stanza sent to %s", stanza.getTo())
+            return
+        self.send_lock.acquire()
+        try:
+            self.component.send(stanza)
+            self.stanzas_out += 1
+        finally:
+            self.send_lock.release()
+
+    def next_id(self):
+        self.id_lock.acquire()
+        try:
+            self.id_counter += 1
+            return "archipel-%d" % self.id_counter
+        finally:
+            self.id_lock.release()
+
+    ### Entities
+
+    def attach(self, entity):
+        """
+        Attach an entity to the transport and return its session.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to attach
+        @rtype: L{TNArchipelComponentSession}
+        @return: the connection object to use as xmppclient
+        """
+        bare = entity.jid.getStripped()
+        if not entity.jid.getDomain() == self.domain:
+            raise Exception("JID %s is not in component domain %s" % (entity.jid, self.domain))
+        self.entities_lock.acquire()
+        try:
+            session = TNArchipelComponentSession(self, entity, self.get_roster(bare))
+            self.entities[bare] = entity
+            self.sessions[bare] = session
+        finally:
+            self.entities_lock.release()
+        self.log.info("Entity %s attached to component", bare)
+        return session
+
+    def detach(self, session):
+        """
+        Detach the entity of the given session.
+        @type session: L{TNArchipelComponentSession}
+        @param session: the session to detach
+        """
+        self.entities_lock.acquire()
+        try:
+            if self.sessions.get(session.bare_jid) is session:
+                del self.sessions[session.bare_jid]
+                del self.entities[session.bare_jid]
+        finally:
+            self.entities_lock.release()
+        self.log.info("Entity %s detached from component", session.bare_jid)
+
+    def remove_entity(self, bare_jid):
+        """
+        Forget everything about an entity (roster and vCard).
+        @type bare_jid: string
+        @param bare_jid: the bare JID of the entity
+        """
+        self.rosters.pop(bare_jid, None)
+        self.vcards.pop(bare_jid, None)
+        if self.database:
+            self.database_lock.acquire()
+            try:
+                self.database.execute("delete from rosters where entity=?", (bare_jid,))
+                self.database.commit()
+            finally:
+                self.database_lock.release()
+
+    ### Rosters
+
+    def get_roster(self, bare_jid):
+        """
+        Return the roster of the entity, loading it from database if needed.
+        @type bare_jid: string
+        @param bare_jid: the bare JID of the entity
+        @rtype: L{TNArchipelComponentRoster}
+        @return: the roster
+        """
+        if bare_jid in self.rosters:
+            return self.rosters[bare_jid]
+        roster = TNArchipelComponentRoster(self, bare_jid)
+        if self.database:
+            self.database_lock.acquire()
+            try:
+                for jid, subscription, name, groups in self.database.execute("select jid, subscription, name, groups from rosters where entity=?", (bare_jid,)):
+                    roster.items[jid] = {"subscription": subscription, "name": name, "groups": groups and groups.split("\n") or [], "resources": {}}
+            finally:
+                self.database_lock.release()
+        self.rosters[bare_jid] = roster
+        return roster
+
+    def save_roster_item(self, owner, jid, item):
+        if not self.database:
+            return
+        self.database_lock.acquire()
+        try:
+            self.database.execute("insert or replace into rosters values(?,?,?,?,?)", (owner, jid, item["subscription"], item["name"], "\n".join(item["groups"])))
+            self.database.commit()
+        finally:
+            self.database_lock.release()
+
+    def delete_roster_item(self, owner, jid):
+        if not self.database:
+            return
+        self.database_lock.acquire()
+        try:
+            self.database.execute("delete from rosters where entity=? and jid=?", (owner, jid))
+            self.database.commit()
+        finally:
+            self.database_lock.release()
+
+    def get_stats(self):
+        """
+        Return the counters of the transport.
+        @rtype: dict
+        @return: dict containing the number of entities and routed stanzas
+        """
+        return {"entities": len(self.sessions), "stanzas_in": self.stanzas_in, "stanzas_out": self.stanzas_out}
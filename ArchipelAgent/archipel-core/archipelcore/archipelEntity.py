@@ -25,9 +25,13 @@ Contains archipelEntity, the root class of any Archipel XMPP capable entities
 This provides basic XMPP features, like connecting, auth...
 """
 
+import Queue
+import base64
 import datetime
+import hashlib
 import socket
 import sys
+import threading
 import time
 import traceback
 import xmpp
@@ -37,7 +41,7 @@ from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEn
 from archipelcore.archipelHookableEntity import TNHookableEntity
 from archipelcore.archipelRosterQueryableEntity import TNRosterQueryableEntity
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
-from archipelcore.utils import TNArchipelLogger, build_error_iq
+from archipelcore.utils import TNArchipelCoalescer, TNArchipelLogger, TNArchipelRateLimiter, build_error_iq
 
 import archipelcore.archipelPermissionCenter
 import archipelcore.pubsub
@@ -65,6 +69,15 @@ ARCHIPEL_XMPP_LOOP_ON                       = 1
 ARCHIPEL_XMPP_LOOP_RESTART                  = 2
 ARCHIPEL_XMPP_LOOP_REMOVE_USER              = 3
 
+# Shout modes
+ARCHIPEL_SHOUT_MODE_MESSAGE                 = "message"
+ARCHIPEL_SHOUT_MODE_PUBSUB                  = "pubsub"
+ARCHIPEL_SHOUT_DEFAULT_RATE                 = 20
+ARCHIPEL_SHOUT_IDLE_TIMEOUT                 = 5
+
+# Max number of changes kept while the pubsub nodes are not ready
+ARCHIPEL_PUSH_MAX_PENDING_CHANGES           = 1000
+
 
 ARCHIPEL_MESSAGING_HELP_MESSAGE = """
 You can communicate with me using text commands, just like if you were chatting with your friends. \
@@ -104,6 +117,8 @@ class TNArchipelEntity (object):
         self.xmppstatus             = None
         self.xmppstatusshow         = None
         self.xmppclient             = None
+        self.xmpp_transport         = None
+        self.xmpp_reactor           = None
         self.vCard                  = None
         self.password               = password
         self.jid                    = jid
@@ -114,6 +129,9 @@ class TNArchipelEntity (object):
         self.auto_register          = auto_register
         self.auto_reconnect         = auto_reconnect
         self.messages_registrar     = []
+        self.messages_commands      = {}
+        self.help_cache             = {}
+        self.help_cache_generation  = None
         self.isAuth                 = False
         self.loop_status            = ARCHIPEL_XMPP_LOOP_OFF
         self.pubsubserver           = self.configuration.get("GLOBAL", "xmpp_pubsub_server")
@@ -124,9 +142,35 @@ class TNArchipelEntity (object):
         self.permission_center      = None
         self.plugins                = [];
         self.is_unregistering       = False
+        self.push_coalescer         = None
+        self.pubsub_page_size       = 0
+        self.pubsubs_ready          = threading.Event()
+        self.pubsubs_lock           = threading.Lock()
+        self.pubsubs_pending        = 0
+        self.pubsubs_status         = {}
+        self.pending_changes        = []
+        self.shout_mode             = ARCHIPEL_SHOUT_MODE_MESSAGE
+        self.shout_queue            = Queue.Queue()
+        self.shout_thread           = None
+        self.shout_lock             = threading.Lock()
+        shout_rate                  = ARCHIPEL_SHOUT_DEFAULT_RATE
+
+        if self.configuration.has_option("GLOBAL", "shout_mode"):
+            self.shout_mode = self.configuration.get("GLOBAL", "shout_mode")
+        if self.configuration.has_option("GLOBAL", "shout_rate"):
+            shout_rate = self.configuration.getfloat("GLOBAL", "shout_rate")
+        self.shout_limiter          = TNArchipelRateLimiter(rate=shout_rate, burst=max(1, int(shout_rate)))
+
+        if self.configuration.has_option("GLOBAL", "xmpp_pubsub_page_size"):
+            self.pubsub_page_size = self.configuration.getint("GLOBAL", "xmpp_pubsub_page_size")
+
+        if self.configuration.has_option("GLOBAL", "push_change_coalescing_window"):
+            window = self.configuration.getfloat("GLOBAL", "push_change_coalescing_window")
+            if window > 0:
+                self.push_coalescer = TNArchipelCoalescer(window, self.publish_changes)
 
         if isinstance(self, TNHookableEntity):
-            TNHookableEntity.__init__(self, self.log)
+            TNHookableEntity.__init__(self, self.log, self.configuration)
         if isinstance(self, TNAvatarControllableEntity):
             TNAvatarControllableEntity.__init__(self, configuration, self.permission_center, self.xmppclient, self.log)
         if isinstance(self, TNTaggableEntity):
@@ -143,9 +187,13 @@ class TNArchipelEntity (object):
             self.create_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED")
             self.create_hook("HOOK_ARCHIPELENTITY_XMPP_LOOP_STARTED")
             self.create_hook("HOOK_ARCHIPELENTITY_XMPP_LOOP_STOPPED")
+            self.create_hook("HOOK_ARCHIPELENTITY_PUBSUBS_READY")
 
             ## recover/create pubsub after connection
             self.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", self.recover_pubsubs)
+            if isinstance(self, TNTaggableEntity):
+                self.register_hook("HOOK_ARCHIPELENTITY_XMPP_DISCONNECTED", self.release_tag_store)
+                self.register_hook("HOOK_ARCHIPELENTITY_XMPP_LOOP_STOPPED", self.release_tag_store)
 
         self.log.info("jid defined as %s" % (str(self.jid)))
 
@@ -223,7 +271,7 @@ class TNArchipelEntity (object):
         """
         try:
             action = iq.getTag("query").getTag("archipel").getAttr("action")
-            self.log.info("acp received: from: %s, type: %s, namespace: %s, action: %s" % (iq.getFrom(), iq.getType(), iq.getQueryNS(), action))
+            self.log.info("acp received: from: %s, type: %s, namespace: %s, action: %s", iq.getFrom(), iq.getType(), iq.getQueryNS(), action)
             return action
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_NS_ERROR_QUERY_NOT_WELL_FORMED)
@@ -253,16 +301,18 @@ class TNArchipelEntity (object):
             TNTaggableEntity.init_permissions(self)
         if isinstance(self, TNAvatarControllableEntity):
             TNAvatarControllableEntity.init_permissions(self)
-        self.permission_center.create_permission("all", "All permissions are granted", False)
-        self.permission_center.create_permission("presence", "Authorizes users to request presences", False)
-        self.permission_center.create_permission("message", "Authorizes users to send messages", False)
-        self.permission_center.create_permission("permission_get", "Authorizes users to get all permissions", True)
-        self.permission_center.create_permission("permission_getown", "Authorizes users to get only own permissions", False)
-        self.permission_center.create_permission("permission_list", "Authorizes users to list existing", False)
-        self.permission_center.create_permission("permission_set", "Authorizes users to set all permissions", False)
-        self.permission_center.create_permission("permission_setown", "Authorizes users to set only own permissions", False)
-        self.permission_center.create_permission("subscription_add", "Authorizes users add others in entity roster", False)
-        self.permission_center.create_permission("subscription_remove", "Authorizes users remove others in entity roster", False)
+        self.permission_center.create_permissions([
+            {"name": "all", "description": "All permissions are granted", "default": False},
+            {"name": "presence", "description": "Authorizes users to request presences", "default": False},
+            {"name": "message", "description": "Authorizes users to send messages", "default": False},
+            {"name": "permission_get", "description": "Authorizes users to get all permissions", "default": True},
+            {"name": "permission_getown", "description": "Authorizes users to get only own permissions", "default": False},
+            {"name": "permission_list", "description": "Authorizes users to list existing", "default": False},
+            {"name": "permission_set", "description": "Authorizes users to set all permissions", "default": False},
+            {"name": "permission_setown", "description": "Authorizes users to set only own permissions", "default": False},
+            {"name": "subscription_add", "description": "Authorizes users add others in entity roster", "default": False},
+            {"name": "subscription_remove", "description": "Authorizes users remove others in entity roster", "default": False}
+        ])
         self.log.info("permissions of %s initialized" % self.jid)
 
     def check_perm(self, conn, stanza, action_name, error_code=-1, prefix=""):
@@ -279,7 +329,7 @@ class TNArchipelEntity (object):
         @type prefix: string
         @param prefix: the prefix of action_name (for example if permission if health_get and action is get, you can give 'health_' as prefix)
         """
-        self.log.info("Checking permission for action %s%s asked by %s" % (prefix, action_name, stanza.getFrom()))
+        self.log.info("Checking permission for action %s%s asked by %s", prefix, action_name, stanza.getFrom())
         if not self.permission_center.check_permission(str(stanza.getFrom().getStripped()), "%s%s" % (prefix, action_name)):
             conn.send(build_error_iq(self, "Cannot use '%s': permission denied" % action_name, stanza, code=error_code, ns=ARCHIPEL_NS_PERMISSION_ERROR))
             raise xmpp.protocol.NodeProcessed
@@ -294,6 +344,8 @@ class TNArchipelEntity (object):
         @rtype: Boolean
         @return: True in case of success
         """
+        if self.xmpp_transport:
+            return self.connect_xmpp_transport()
         debug_mode = []
         if self.configuration.has_option("LOGGING", "xmpppy_debug") and self.configuration.getboolean("LOGGING", "xmpppy_debug"):
             debug_mode = ['always', 'nodebuilder']
@@ -310,12 +362,29 @@ class TNArchipelEntity (object):
         self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_CONNECTED")
         return True
 
+    def connect_xmpp_transport(self):
+        """
+        Attach the entity to its shared XMPP transport instead of opening
+        its own connection. If the transport is not connected yet, it will
+        connect the entity again as soon as it is.
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        self.xmppclient = self.xmpp_transport.attach(self)
+        if not self.xmppclient.isConnected():
+            self.log.warning("XMPP transport is not connected yet. Waiting for it.")
+            return False
+        self.loop_status = ARCHIPEL_XMPP_LOOP_ON
+        self.log.info("Sucessfully attached to XMPP transport with JID %s" % str(self.jid))
+        self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_CONNECTED")
+        return True
+
     def auth_xmpp(self):
         """
         Authentify the client to the XMPP server.
         """
         self.log.info("Trying to authentify the client.")
-        if self.xmppclient.auth(self.jid.getNode(), self.password, self.resource) == None:
+        if not self.xmpp_transport and self.xmppclient.auth(self.jid.getNode(), self.password, self.resource) == None:
             self.isAuth = False
             if (self.auto_register):
                 self.log.info("Starting registration, according to propertie auto_register.")
@@ -333,12 +402,16 @@ class TNArchipelEntity (object):
     def connect(self):
         """
         Connect and auth to XMPP Server.
+        @rtype: Boolean
+        @return: True if the entity is connected to the XMPP server
         """
         if self.xmppclient and self.xmppclient.isConnected():
             self.log.warning("Trying to connect, but already connected. Ignoring.")
-            return
-        if self.connect_xmpp():
-            self.auth_xmpp()
+            return True
+        if not self.connect_xmpp():
+            return False
+        self.auth_xmpp()
+        return True
 
     def disconnect(self):
         """
@@ -348,6 +421,11 @@ class TNArchipelEntity (object):
             self.isAuth = False
             self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
             self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_DISCONNECTED")
+            if self.xmpp_transport:
+                self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_LOOP_STOPPED")
+                self.xmppclient.disconnect()
+            elif self.xmpp_reactor:
+                self.xmpp_reactor.watch(self)
         else:
             self.log.warning("Trying to disconnect, but not connected. Ignoring.")
 
@@ -356,28 +434,33 @@ class TNArchipelEntity (object):
     def recover_pubsubs(self, origin, user_info, arguments):
         """
         Create or get the current hypervisor pubsub node.
+        The tags, events and log nodes are recovered at the same time, and
+        the existing nodes are only configured if needed. When all of them
+        are done, if the events node is usable, pubsubs_ready is set and
+        HOOK_ARCHIPELENTITY_PUBSUBS_READY is performed.
         Arguments here are used to be HOOK compliant see @register_hook
         """
-        TNTaggableEntity.recover_pubsubs(self, origin, user_info, arguments)
-        # creating/getting the event pubsub node
+        self.pubsubs_ready.clear()
+        with self.pubsubs_lock:
+            self.pubsubs_pending = 3
+            self.pubsubs_status = {}
+        TNTaggableEntity.recover_pubsubs(self, origin, user_info, arguments, callback=lambda success: self.did_recover_pubsub("tags", success))
+        # creating/getting the event pubsub node. The entity only publishes
+        # in its events and log nodes, so there is no need to get their items
         eventNodeName = "/archipel/" + self.jid.getStripped() + "/events"
         self.pubSubNodeEvent = archipelcore.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, eventNodeName)
-        if not self.pubSubNodeEvent.recover(wait=True):
-            self.pubSubNodeEvent.create(wait=True)
-        self.pubSubNodeEvent.configure({
+        self.pubSubNodeEvent.recover_or_create({
             archipelcore.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL: archipelcore.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL_OPEN,
             archipelcore.pubsub.XMPP_PUBSUB_VAR_DELIVER_NOTIFICATION: 1,
             archipelcore.pubsub.XMPP_PUBSUB_VAR_PERSIST_ITEMS: 0,
             archipelcore.pubsub.XMPP_PUBSUB_VAR_NOTIFY_RECTRACT: 0,
             archipelcore.pubsub.XMPP_PUBSUB_VAR_DELIVER_PAYLOADS: 1,
             archipelcore.pubsub.XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM: archipelcore.pubsub.XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM_NEVER
-        }, wait=True)
+        }, max_items=1, callback=lambda success: self.did_recover_pubsub("events", success))
         # creating/getting the log pubsub node
         logNodeName = "/archipel/" + self.jid.getStripped() + "/logs"
         self.pubSubNodeLog = archipelcore.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, logNodeName)
-        if not self.pubSubNodeLog.recover(wait=True):
-            self.pubSubNodeLog.create(wait=True)
-        self.pubSubNodeLog.configure({
+        self.pubSubNodeLog.recover_or_create({
                 archipelcore.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL: archipelcore.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL_OPEN,
                 archipelcore.pubsub.XMPP_PUBSUB_VAR_DELIVER_NOTIFICATION: 1,
                 archipelcore.pubsub.XMPP_PUBSUB_VAR_MAX_ITEMS: self.configuration.get("LOGGING", "log_pubsub_max_items"),
@@ -385,7 +468,35 @@ class TNArchipelEntity (object):
                 archipelcore.pubsub.XMPP_PUBSUB_VAR_NOTIFY_RECTRACT: 0,
                 archipelcore.pubsub.XMPP_PUBSUB_VAR_DELIVER_PAYLOADS: 1,
                 archipelcore.pubsub.XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM: archipelcore.pubsub.XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM_NEVER
-        }, wait=True)
+        }, max_items=1, callback=lambda success: self.did_recover_pubsub("logs", success))
+
+    def did_recover_pubsub(self, node, success):
+        """
+        Called when one of the pubsub nodes of recover_pubsubs is ready.
+        If the events node failed, the pubsub nodes are not marked as ready
+        and the pending changes are kept until the next recovery.
+        @type node: string
+        @param node: the node (tags, events or logs)
+        @type success: Boolean
+        @param success: False if the node could not be recovered or created
+        """
+        if not success:
+            self.log.error("PUBSUB: unable to recover the %s pubsub node of %s", node, self.jid)
+        with self.pubsubs_lock:
+            self.pubsubs_status[node] = success
+            self.pubsubs_pending -= 1
+            if self.pubsubs_pending > 0:
+                return
+            if not self.pubsubs_status.get("events"):
+                self.log.error("PUBSUB: events node of %s is not available, changes won't be published", self.jid)
+                return
+            changes = self.pending_changes
+            self.pending_changes = []
+        self.log.info("PUBSUB: pubsub nodes of %s are ready", self.jid)
+        self.pubsubs_ready.set()
+        if changes:
+            self.publish_changes(changes)
+        self.perform_hooks("HOOK_ARCHIPELENTITY_PUBSUBS_READY")
 
     def remove_pubsubs(self):
         """
@@ -560,41 +671,118 @@ class TNArchipelEntity (object):
         pres = xmpp.Presence(status=self.xmppstatus, show=self.xmppstatusshow)
         self.xmppclient.send(pres)
 
-    def push_change(self, namespace, change):
+    def push_change(self, namespace, change, critical=False):
         """
         Push a change using archipel push system.
         This system will change with inclusion of pubsub.
+        If GLOBAL:push_change_coalescing_window is set, the changes are
+        published at the end of the window, and the same change pushed
+        several times during the window is published once.
         @type namespace: string
         @param namespace: the namespace of the push. it will be prefixed with @ARCHIPEL_NS_IQ_PUSH
         @type change: string
         @param change: the change value (can be anything, like 'newvm' in the context of the namespace)
+        @type critical: boolean
+        @param critical: if True, the change and the pending ones are published right away
         """
         ns = ARCHIPEL_NS_IQ_PUSH + ":" + namespace
-        self.log.info("PUSH : pushing %s->%s" % (ns, change))
-        push = xmpp.Node(tag="push", attrs={"date": datetime.datetime.now(), "xmlns": ns, "change": change})
-        self.pubSubNodeEvent.add_item(push)
+        if self.push_coalescer:
+            self.log.debug("PUSH : queuing %s->%s", ns, change)
+            self.push_coalescer.add((ns, change), critical=critical)
+        else:
+            self.publish_changes([(ns, change)])
+
+    def publish_changes(self, changes):
+        """
+        Publish changes in the event pubsub node.
+        @type changes: list
+        @param changes: list of tuples (namespace, change)
+        """
+        if not self.pubsubs_ready.isSet():
+            with self.pubsubs_lock:
+                if not self.pubsubs_ready.isSet():
+                    self.log.debug("PUSH : pubsub nodes are not ready, delaying %d changes", len(changes))
+                    self.pending_changes.extend(changes)
+                    if len(self.pending_changes) > ARCHIPEL_PUSH_MAX_PENDING_CHANGES:
+                        self.log.warning("PUSH : too many delayed changes, dropping the %d oldest ones", len(self.pending_changes) - ARCHIPEL_PUSH_MAX_PENDING_CHANGES)
+                        del self.pending_changes[:-ARCHIPEL_PUSH_MAX_PENDING_CHANGES]
+                    return
+        pushes = []
+        for ns, change in changes:
+            self.log.info("PUSH : pushing %s->%s", ns, change)
+            pushes.append(xmpp.Node(tag="push", attrs={"date": datetime.datetime.now(), "xmlns": ns, "change": change}))
+        if len(pushes) == 1:
+            self.pubSubNodeEvent.add_item(pushes[0])
+        else:
+            self.pubSubNodeEvent.add_items(pushes)
+
+    def get_push_stats(self):
+        """
+        Return the counters of the push coalescer.
+        @rtype: dict
+        @return: dict as returned by TNArchipelCoalescer.get_stats(), or None if changes are not coalesced
+        """
+        if self.push_coalescer:
+            return self.push_coalescer.get_stats()
+        return None
 
     def shout(self, subject, message):
         """
-        Send a message to everybody in roster.
+        Send a message to everybody online in roster. The messages are queued
+        and sent by a thread at the rate given by GLOBAL:shout_rate. If
+        GLOBAL:shout_mode is "pubsub", the message is published once in the
+        events pubsub node instead.
         @type subject: string
         @param subject: the xmpp subject of the message
         @type message: string
         @param message: the content of the message
         """
+        if self.shout_mode == ARCHIPEL_SHOUT_MODE_PUBSUB and self.pubsubs_ready.isSet():
+            self.log.info("SHOUTING : publishing message %s", subject)
+            push = xmpp.Node(tag="push", attrs={"date": datetime.datetime.now(), "xmlns": ARCHIPEL_NS_IQ_PUSH + ":shout", "change": subject})
+            push.setData(message)
+            self.pubSubNodeEvent.add_item(push)
+            return
+        # headline messages sent to a bare JID are delivered by the server
+        # to all the available resources, so one message per contact is enough
+        recipients = set()
         for barejid in self.roster.getItems():
             if self.jid.getStripped() == barejid:
                 continue
-            resources = self.roster.getResources(barejid)
-            if len(resources) == 0:
-                broadcast = xmpp.Message(body=message, typ="headline", to=barejid)
-                self.log.info("SHOUTING : shouting message to %s" % (barejid))
+            if not self.roster.getResources(barejid):
+                continue
+            recipients.add(barejid)
+        self.log.info("SHOUTING : shouting message to %d contacts", len(recipients))
+        with self.shout_lock:
+            for barejid in recipients:
+                self.shout_queue.put(xmpp.Message(body=message, typ="headline", to=barejid))
+            if recipients and not self.shout_thread:
+                self.shout_thread = threading.Thread(target=self.send_shouts)
+                self.shout_thread.setDaemon(True)
+                self.shout_thread.start()
+
+    def send_shouts(self):
+        """
+        Send the queued shout messages, according to the shout rate limiter.
+        The thread stops when there is nothing to send anymore.
+        """
+        while True:
+            try:
+                broadcast = self.shout_queue.get(timeout=ARCHIPEL_SHOUT_IDLE_TIMEOUT)
+            except Queue.Empty:
+                with self.shout_lock:
+                    if self.shout_queue.empty():
+                        self.shout_thread = None
+                        return
+                continue
+            self.shout_limiter.acquire()
+            try:
+                self.log.debug("SHOUTING : shouting message to %s", broadcast.getTo())
                 self.xmppclient.send(broadcast)
-            else:
-                for resource in resources:
-                    broadcast = xmpp.Message(body=message, typ="headline", to=barejid + "/" + resource)
-                    self.log.info("SHOUTING : shouting message to %s" % (barejid))
-                    self.xmppclient.send(broadcast)
+            except Exception as ex:
+                self.log.error("SHOUTING : unable to shout message to %s: %s" % (broadcast.getTo(), str(ex)))
+            finally:
+                self.shout_limiter.release()
 
 
     ### XMPP Roster
@@ -708,6 +896,9 @@ class TNArchipelEntity (object):
         self.vCard = vcard.getTag("vCard")
         if self.vCard and self.vCard.getTag("PHOTO"):
             self.b64Avatar = self.vCard.getTag("PHOTO").getTag("BINVAL").getCDATA()
+            self.avatar_hash = hashlib.sha1(base64.b64decode(self.b64Avatar)).hexdigest()
+            if self.vCard.getTag("PHOTO").getTag("TYPE"):
+                self.avatar_content_type = self.vCard.getTag("PHOTO").getTag("TYPE").getData()
         self.log.info("Own vcard retrieved")
         self.set_vcard()
 
@@ -743,13 +934,16 @@ class TNArchipelEntity (object):
                     else:
                         self.b64avatar_from_filename(self.default_avatar)
                 node_photo_content_type = xmpp.Node(tag="TYPE")
-                node_photo_content_type.setData("image/png")
+                node_photo_content_type.setData(self.avatar_content_type)
                 node_photo_data = xmpp.Node(tag="BINVAL")
                 node_photo_data.setData(self.b64Avatar)
                 node_photo = xmpp.Node(tag="PHOTO", payload=[node_photo_content_type, node_photo_data])
                 payload.append(node_photo)
             node_iq.addChild(name="vCard", payload=payload, namespace="vcard-temp")
-            self.xmppclient.SendAndCallForResponse(stanza=node_iq, func=self.send_update_vcard)
+            photo_hash = None
+            if self.configuration.getboolean("GLOBAL", "use_avatar"):
+                photo_hash = self.avatar_hash
+            self.xmppclient.SendAndCallForResponse(stanza=node_iq, func=self.send_update_vcard, args={"photo_hash": photo_hash})
             self.log.info("vCard information sent with type: %s" % self.entity_type)
         except Exception as ex:
             self.log.error("Error during setting vCard (set_vcard) using stanza: %s EXCEPTION IS: %s" % (str(node_iq), str(ex)))
@@ -767,10 +961,9 @@ class TNArchipelEntity (object):
         @param photo_hash: the SHA-1 hash of the photo that changes (optionnal)
         """
         node_presence = xmpp.Presence(status=self.xmppstatus, show=self.xmppstatusshow)
+        node_update = node_presence.addChild(name="x", namespace='vcard-temp:x:update')
         if photo_hash:
-            node_photo_sha1 = xmpp.Node(tag="photo")
-            node_photo_sha1.setData(photo_hash)
-        node_presence.addChild(name="x", namespace='vcard-temp:x:update')
+            node_update.addChild(name="photo").setData(photo_hash)
         self.xmppclient.send(node_presence)
         self.log.info("vCard update presence sent.")
 
@@ -805,6 +998,11 @@ class TNArchipelEntity (object):
         Do a in-band unregistration.
         """
         self.loop_status = ARCHIPEL_XMPP_LOOP_REMOVE_USER
+        if self.xmpp_transport:
+            self.process_inband_unregistration()
+            self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_LOOP_STOPPED")
+        elif self.xmpp_reactor:
+            self.xmpp_reactor.watch(self)
 
     def process_inband_unregistration(self):
         """
@@ -814,6 +1012,12 @@ class TNArchipelEntity (object):
         self.is_unregistering = True
         self.remove_pubsubs()
         self.unregister_handlers()
+        if self.xmpp_transport:
+            self.log.info("Detaching from XMPP transport.")
+            self.xmppclient.disconnect()
+            self.xmpp_transport.remove_entity(self.jid.getStripped())
+            self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+            return
         self.log.info("Trying to unregister.")
         iq = (xmpp.Iq(typ='set', to=self.jid.getDomain()))
         iq.setQueryNS("jabber:iq:register")
@@ -839,7 +1043,7 @@ class TNArchipelEntity (object):
         @param msg: the received message
         """
         try:
-            self.log.info("Chat message received from %s to %s: %s" % (msg.getFrom(), str(self.jid), msg.getBody()))
+            self.log.info("Chat message received from %s to %s: %s", msg.getFrom(), self.jid, msg.getBody())
             reply_stanza = self.filter_message(msg)
             reply = None
             if reply_stanza:
@@ -868,8 +1072,39 @@ class TNArchipelEntity (object):
         @type item: dictionnary
         @param item: the dictionnary describing the registrar item
         """
-        self.log.debug("Plugin have registred a method %s for commands %s" % (str(item["method"]), str(item["commands"])))
+        self.log.debug("Plugin have registred a method %s for commands %s", item["method"], item["commands"])
         self.messages_registrar.append(item)
+        for index, cmd in enumerate(item["commands"]):
+            node = self.messages_commands
+            for c in cmd:
+                node = node.setdefault(c, {})
+            if not None in node:
+                node[None] = ((len(self.messages_registrar), index), item)
+        self.help_cache = {}
+
+    def get_message_registrar_item(self, body):
+        """
+        Find the registrar item of the command the body starts with. The
+        commands are stored in a prefix tree, so the lookup cost only
+        depends on the length of the commands. If several commands match,
+        the first registered one wins.
+        @type body: string
+        @param body: the lowercased body of the message
+        @rtype: dict
+        @return: the registrar item or None
+        """
+        node = self.messages_commands
+        found = None
+        for c in body:
+            node = node.get(c)
+            if node is None:
+                break
+            entry = node.get(None)
+            if entry and (not found or entry[0] < found[0]):
+                found = entry
+        if found:
+            return found[1]
+        return None
 
     def add_message_registrar_items(self, items):
         """
@@ -887,14 +1122,14 @@ class TNArchipelEntity (object):
         @param msg: the received message
         """
         if not msg.getType() == ARCHIPEL_NS_SERVICE_MESSAGE and not msg.getType() == ARCHIPEL_NS_IQ_PUSH and not msg.getType() == "error" and msg.getBody():
-            self.log.info("Message received from %s (%s)" % (msg.getFrom(), msg.getType()))
+            self.log.info("Message received from %s (%s)", msg.getFrom(), msg.getType())
             reply = msg.buildReply("not prepared")
             me = reply.getFrom()
             me.setResource(self.resource)
             reply.setType("chat")
             return reply
         else:
-            self.log.info("Message ignored from %s (%s)" % (msg.getFrom(), msg.getType()))
+            self.log.info("Message ignored from %s (%s)", msg.getFrom(), msg.getType())
             return False
 
     def build_reply(self, reply_stanza, msg):
@@ -910,38 +1145,46 @@ class TNArchipelEntity (object):
         if body.find("help", 0, len("help")) >= 0:
             reply_stanza.setBody(self.build_help(msg))
         else:
-            loop = True
-            for registrar_item in self.messages_registrar:
-                for cmd in registrar_item["commands"]:
-                    if body.find(cmd, 0, len(cmd)) >= 0:
-                        granted = True
-                        if "permissions" in registrar_item:
-                            granted = self.permission_center.check_permissions(msg.getFrom().getStripped(), registrar_item["permissions"])
-                        if granted:
-                            m = registrar_item["method"]
-                            resp = m(msg)
-                            reply_stanza.setBody(resp)
-                        else:
-                            reply_stanza.setBody("Sorry, you do not have the needed permission to execute this command.")
-                        loop = False
-                        break
-                if not loop:
-                    break
+            registrar_item = self.get_message_registrar_item(body)
+            if registrar_item:
+                granted = True
+                if "permissions" in registrar_item:
+                    granted = self.permission_center.check_permissions(msg.getFrom().getStripped(), registrar_item["permissions"])
+                if granted:
+                    m = registrar_item["method"]
+                    resp = m(msg)
+                    reply_stanza.setBody(resp)
+                else:
+                    reply_stanza.setBody("Sorry, you do not have the needed permission to execute this command.")
         return reply_stanza
 
     def build_help(self, msg):
         """
         Build the help message according to the current registrar.
+        The messages are cached by permission set, until a permission
+        or the registrar changes.
         @type msg: xmpp.Protocol.Message
         @param msg: the received message
         @return the string containing the help message
         """
+        user = msg.getFrom().getStripped()
+        if not self.help_cache_generation == self.permission_center.cache_generation:
+            self.help_cache = {}
+            self.help_cache_generation = self.permission_center.cache_generation
+        key = self.permission_center.get_permission_set_key(user)
+        resp = self.help_cache.get(key)
+        if resp is None:
+            resp = self._build_help(user)
+            self.help_cache[key] = resp
+        return resp
+
+    def _build_help(self, user):
         resp = ARCHIPEL_MESSAGING_HELP_MESSAGE
         for registrar_item in self.messages_registrar:
             if not "ignore" in registrar_item:
                 granted = True
                 if "permissions" in registrar_item:
-                    granted = self.permission_center.check_permissions(msg.getFrom().getStripped(), registrar_item["permissions"])
+                    granted = self.permission_center.check_permissions(user, registrar_item["permissions"])
                 if granted:
                     cmds = str(registrar_item["commands"])
                     desc = registrar_item["description"]
@@ -1089,10 +1332,16 @@ class TNArchipelEntity (object):
 
     def loop(self):
         """
-        This is the main loop of the client.
+        This is the main loop of the client. If the entity uses a shared
+        XMPP transport or a reactor, they are the loop, so this returns immediately.
         """
         if self.loop_status == ARCHIPEL_XMPP_LOOP_ON:
             self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_LOOP_STARTED")
+        if self.xmpp_transport:
+            return
+        if self.xmpp_reactor:
+            self.xmpp_reactor.watch(self)
+            return
         while not self.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
             try:
                 if self.loop_status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
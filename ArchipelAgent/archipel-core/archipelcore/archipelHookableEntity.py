@@ -19,20 +19,240 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import Queue
+import threading
+import time
+from collections import OrderedDict
+
+
+ARCHIPEL_HOOK_MODE_INLINE           = "inline"
+ARCHIPEL_HOOK_MODE_POOLED           = "pooled"
+ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET  = "fire-and-forget"
+
+ARCHIPEL_HOOK_DEFAULT_PRIORITY          = 0
+ARCHIPEL_HOOK_POOL_DEFAULT_WORKERS      = 8
+ARCHIPEL_HOOK_POOL_DEFAULT_QUEUE_SIZE   = 1024
+ARCHIPEL_HOOK_LATENCY_BUCKETS           = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class TNHookWorkerPool (object):
+    """
+    A bounded pool of worker threads shared by all hookable entities
+    to run the pooled and fire-and-forget hooks.
+    """
+
+    def __init__(self, workers=ARCHIPEL_HOOK_POOL_DEFAULT_WORKERS, queue_size=ARCHIPEL_HOOK_POOL_DEFAULT_QUEUE_SIZE):
+        """
+        Initialize the pool. Workers are started on first submission.
+        @type workers: int
+        @param workers: the number of worker threads
+        @type queue_size: int
+        @param queue_size: the max number of pending jobs
+        """
+        self.workers    = workers
+        self.queue      = Queue.Queue(queue_size)
+        self.threads    = []
+        self.lock       = threading.Lock()
+        self.local      = threading.local()
+        self.rejected   = 0
+
+    def _start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                t = threading.Thread(target=self._work)
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+
+    def _work(self):
+        self.local.is_worker = True
+        while True:
+            job = self.queue.get()
+            try:
+                job()
+            except Exception:
+                pass
+
+    def submit(self, job):
+        """
+        Queue a job.
+        @type job: function
+        @param job: the function to run
+        @rtype: boolean
+        @return: False if the queue is full and the job has been rejected
+        """
+        if len(self.threads) < self.workers:
+            self._start()
+        try:
+            self.queue.put_nowait(job)
+            return True
+        except Queue.Full:
+            self.rejected += 1
+            return False
+
+    def in_worker(self):
+        """
+        Return True if the current thread is one of the workers.
+        @rtype: boolean
+        @return: True if called from a worker
+        """
+        return getattr(self.local, "is_worker", False)
+
+    def get_stats(self):
+        """
+        Return the counters of the pool.
+        @rtype: dict
+        @return: dict containing the number of workers, pending and rejected jobs
+        """
+        return {"workers": len(self.threads), "pending": self.queue.qsize(), "rejected": self.rejected}
+
+
+class TNHookHandle (object):
+    """
+    A method registered in a hook, returned by L{TNHookableEntity.register_hook}.
+    """
+
+    def __init__(self, hookname, method, user_info, oneshot, mode, timeout, priority):
+        """
+        Initialize the handle.
+        """
+        self.hookname   = hookname
+        self.method     = method
+        self.user_info  = user_info
+        self.oneshot    = oneshot
+        self.mode       = mode
+        self.timeout    = timeout
+        self.priority   = priority
+
+    def __repr__(self):
+        return "<TNHookHandle %s:%s>" % (self.hookname, self.method.__name__)
+
+
+class TNHook (object):
+    """
+    The registered methods of a hook. The handles are stored by priority
+    in ordered dicts, so they can be removed in constant time, and the
+    ordered list used to perform the hook is only rebuilt after a change.
+    """
+
+    def __init__(self, name):
+        """
+        Initialize the hook.
+        @type name: string
+        @param name: the name of the hook
+        """
+        self.name       = name
+        self.priorities = {}
+        self.by_method  = {}
+        self.snapshot   = ()
+        self.lock       = threading.Lock()
+
+    def add(self, handle):
+        """
+        Add a handle after the others of the same priority.
+        @type handle: L{TNHookHandle}
+        @param handle: the handle to add
+        """
+        with self.lock:
+            self.priorities.setdefault(handle.priority, OrderedDict())[handle] = True
+            self.by_method.setdefault(handle.method, OrderedDict())[handle] = True
+            self.snapshot = None
+
+    def remove(self, handle):
+        """
+        Remove a handle.
+        @type handle: L{TNHookHandle}
+        @param handle: the handle to remove
+        @rtype: boolean
+        @return: False if the handle was not registered
+        """
+        with self.lock:
+            handles = self.priorities.get(handle.priority)
+            if not handles or handles.pop(handle, None) is None:
+                return False
+            if not handles:
+                del self.priorities[handle.priority]
+            handles = self.by_method[handle.method]
+            del handles[handle]
+            if not handles:
+                del self.by_method[handle.method]
+            self.snapshot = None
+            return True
+
+    def find(self, method):
+        """
+        Return the first handle registered for the method.
+        @type method: function
+        @param method: the registered method
+        @rtype: L{TNHookHandle}
+        @return: the handle or None
+        """
+        with self.lock:
+            handles = self.by_method.get(method)
+            if handles:
+                return next(iter(handles))
+            return None
+
+    def handles(self):
+        """
+        Return the handles, highest priority first, then by registration order.
+        @rtype: tuple
+        @return: the registered handles
+        """
+        with self.lock:
+            if self.snapshot is None:
+                snapshot = []
+                for priority in sorted(self.priorities.keys(), reverse=True):
+                    snapshot.extend(self.priorities[priority].keys())
+                self.snapshot = tuple(snapshot)
+            return self.snapshot
+
+    def __len__(self):
+        return len(self.handles())
+
+
+hook_worker_pool = None
+hook_worker_pool_lock = threading.Lock()
+
+def get_hook_worker_pool(workers=ARCHIPEL_HOOK_POOL_DEFAULT_WORKERS, queue_size=ARCHIPEL_HOOK_POOL_DEFAULT_QUEUE_SIZE):
+    """
+    Return the shared hook worker pool, creating it with the given
+    sizes if needed.
+    @rtype: L{TNHookWorkerPool}
+    @return: the shared pool
+    """
+    global hook_worker_pool
+    with hook_worker_pool_lock:
+        if not hook_worker_pool:
+            hook_worker_pool = TNHookWorkerPool(workers, queue_size)
+        return hook_worker_pool
+
+
 
 class TNHookableEntity (object):
     """
     This class make a TNArchipelEntity hooking capable.
     """
 
-    def __init__(self, log):
+    def __init__(self, log, configuration=None):
         """
         Initialize the TNHookableEntity.
         @type log: TNArchipelLog
         @param log: the logger of the entity
+        @type configuration: ConfigParser
+        @param configuration: the configuration, used to size the shared hook worker pool
         """
-        self.hooks  = {}
-        self.log    = log
+        self.hooks          = {}
+        self.hooks_stats    = {}
+        self.hooks_lock     = threading.Lock()
+        self.log            = log
+        workers = ARCHIPEL_HOOK_POOL_DEFAULT_WORKERS
+        queue_size = ARCHIPEL_HOOK_POOL_DEFAULT_QUEUE_SIZE
+        if configuration and configuration.has_option("GLOBAL", "hooks_pool_workers"):
+            workers = configuration.getint("GLOBAL", "hooks_pool_workers")
+        if configuration and configuration.has_option("GLOBAL", "hooks_pool_queue_size"):
+            queue_size = configuration.getint("GLOBAL", "hooks_pool_queue_size")
+        self.hooks_pool     = get_hook_worker_pool(workers, queue_size)
 
 
     ### Hooks management
@@ -43,7 +263,7 @@ class TNHookableEntity (object):
         @type hookname: string
         @param hookname: the name of the new hook
         """
-        self.hooks[hookname] = []
+        self.hooks[hookname] = TNHook(hookname)
         self.log.info("HOOK: creating hook with name %s" % hookname)
         return True
 
@@ -57,17 +277,21 @@ class TNHookableEntity (object):
         @return: True in case of success
         """
         if hookname in self.hooks:
-            for hook in self.hooks[hookname]:
-                self.hooks[hookname].remove(hook)
             del self.hooks[hookname]
             self.log.info("HOOK: removing hook with name %s" % hookname)
             return True
         return False
 
-    def register_hook(self, hookname, method, user_info=None, oneshot=False):
+    def register_hook(self, hookname, method, user_info=None, oneshot=False, mode=ARCHIPEL_HOOK_MODE_INLINE, timeout=None, priority=ARCHIPEL_HOOK_DEFAULT_PRIORITY):
         """
         Register a method that will be triggered by a hook. The methood must use
         the following prototype: method(origin, user_info, arguments).
+        Methods are performed by decreasing priority, then in registration order.
+        The mode tells how the method is performed:
+            - inline: in the thread performing the hook
+            - pooled: in the shared worker pool. perform_hooks waits for it,
+              at most timeout seconds, after having started all the other methods
+            - fire-and-forget: in the shared worker pool, without waiting
         @type hookname: string
         @param hookname: the name of the hook
         @type method: function
@@ -76,29 +300,46 @@ class TNHookableEntity (object):
         @param user_info: user info you want to pass to the method when it'll be peformed
         @type oneshot: boolean
         @param oneshot: if True, the method will be unregistered after first performing
+        @type mode: string
+        @param mode: ARCHIPEL_HOOK_MODE_INLINE, ARCHIPEL_HOOK_MODE_POOLED or ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET. Pooled methods run inline when the hook is performed by a pool worker
+        @type timeout: float
+        @param timeout: the max time in seconds to wait for a pooled method. Inline methods going over it are logged
+        @type priority: int
+        @param priority: the priority of the method
+        @rtype: L{TNHookHandle}
+        @return: the handle of the registration, that can be given to L{unregister_hook}
         """
+        if not mode in (ARCHIPEL_HOOK_MODE_INLINE, ARCHIPEL_HOOK_MODE_POOLED, ARCHIPEL_HOOK_MODE_FIRE_AND_FORGET):
+            raise Exception("Unknown hook mode %s" % mode)
         # If the hook is not existing, we create it.
         if not hookname in self.hooks:
             self.create_hook(hookname)
-        self.hooks[hookname].append({"method": method, "oneshot": oneshot, "user_info": user_info})
-        self.log.info("HOOK: registering hook method %s for hook name %s (oneshot: %s)" % (method.__name__, hookname, str(oneshot)))
+        handle = TNHookHandle(hookname, method, user_info, oneshot, mode, timeout, priority)
+        self.hooks[hookname].add(handle)
+        self.log.info("HOOK: registering hook method %s for hook name %s (oneshot: %s, mode: %s, priority: %s)", method.__name__, hookname, oneshot, mode, priority)
+        return handle
 
     def unregister_hook(self, hookname, method):
         """
-        Unregister a method from a hook.
+        Unregister a method from a hook. If a method has been registered
+        several times, only its first registration is removed, unless
+        the handle of the registration is given.
         @type hookname: string
         @param hookname: the name of the hook
-        @type method: function
-        @param method: the method to unregister from the hook
+        @type method: function or L{TNHookHandle}
+        @param method: the method or the registration handle to unregister from the hook
         @rtype: boolean
         @return: True in case of success
         """
         if hookname in self.hooks:
-            for hook in self.hooks[hookname]:
-                if hook["method"] == method:
-                    self.hooks[hookname].remove(hook)
-                    break
-            self.log.info("HOOK: unregistering hook method %s for hook name %s" % (method.__name__, hookname))
+            hook = self.hooks[hookname]
+            if isinstance(method, TNHookHandle):
+                handle = method
+            else:
+                handle = hook.find(method)
+            if handle:
+                hook.remove(handle)
+                self.log.info("HOOK: unregistering hook method %s for hook name %s", handle.method.__name__, hookname)
             return True
         return False
 
@@ -110,21 +351,97 @@ class TNHookableEntity (object):
         @type arguments: object
         @param arguments: random object that will be given to the registered methods as "argument" kargs
         """
-        self.log.info("HOOK: going to run methods for hook %s" % hookname)
-        hook_to_remove = []
-        for info in self.hooks[hookname]:
-            m           = info["method"]
-            oneshot     = info["oneshot"]
-            user_info   = info["user_info"]
-            try:
-                self.log.debug("HOOK: performing method %s registered in hook with name %s and user_info: %s (oneshot: %s)" % (m.__name__, hookname, str(user_info), str(oneshot)))
-                m(self, user_info, arguments)
-                if oneshot:
-                    self.log.info("HOOK: this hook was oneshot. registering for deletion.")
-                    hook_to_remove.append(m)
-            except Exception as ex:
-                self.log.error("HOOK: error during performing method %s for hookname %s: %s" % (m.__name__, hookname, str(ex)))
-
-            for hook_method in hook_to_remove:
-                self.log.info("HOOK: removing registred hook for deletion %s" % (hook_method.__name__))
-                self.unregister_hook(hookname, hook_method)
\ No newline at end of file
+        self.log.info("HOOK: going to run methods for hook %s", hookname)
+        hook = self.hooks[hookname]
+        waiting = []
+        # a worker waiting for pooled jobs could deadlock the pool,
+        # so pooled methods are run inline when a worker fires a hook
+        in_worker = self.hooks_pool.in_worker()
+        for handle in hook.handles():
+            # Removing a oneshot handle before performing it ensures it's
+            # performed only once, even if the hook is fired concurrently.
+            if handle.oneshot:
+                if not hook.remove(handle):
+                    continue
+                self.log.info("HOOK: this hook was oneshot. removing %s", handle.method.__name__)
+            self.log.debug("HOOK: performing method %s registered in hook with name %s and user_info: %s (oneshot: %s, mode: %s)", handle.method.__name__, hookname, handle.user_info, handle.oneshot, handle.mode)
+            if handle.mode == ARCHIPEL_HOOK_MODE_INLINE or (in_worker and handle.mode == ARCHIPEL_HOOK_MODE_POOLED):
+                self._perform_hook_method(hookname, handle, arguments)
+            else:
+                done = threading.Event()
+                def job(handle=handle, done=done):
+                    try:
+                        self._perform_hook_method(hookname, handle, arguments)
+                    finally:
+                        done.set()
+                if not self.hooks_pool.submit(job):
+                    self.log.warning("HOOK: worker pool is full, performing method %s for hookname %s inline", handle.method.__name__, hookname)
+                    job()
+                if handle.mode == ARCHIPEL_HOOK_MODE_POOLED:
+                    waiting.append((handle, done))
+
+        for handle, done in waiting:
+            done.wait(handle.timeout)
+            if not done.isSet():
+                self.log.warning("HOOK: method %s for hookname %s did not finish in %ss, not waiting for it anymore", handle.method.__name__, hookname, handle.timeout)
+                self._record_hook_timeout(hookname, handle.method)
+
+    def _perform_hook_method(self, hookname, handle, arguments):
+        """
+        Run a registered method and record its latency.
+        """
+        m = handle.method
+        error = False
+        start = time.time()
+        try:
+            m(self, handle.user_info, arguments)
+        except Exception as ex:
+            error = True
+            self.log.error("HOOK: error during performing method %s for hookname %s: %s" % (m.__name__, hookname, str(ex)))
+        latency = time.time() - start
+        if handle.mode == ARCHIPEL_HOOK_MODE_INLINE and handle.timeout and latency > handle.timeout:
+            self.log.warning("HOOK: inline method %s for hookname %s took %.3fs (timeout: %ss)", m.__name__, hookname, latency, handle.timeout)
+        with self.hooks_lock:
+            stats = self._hook_method_stats(hookname, m)
+            stats["count"] += 1
+            stats["total"] += latency
+            stats["max"] = max(stats["max"], latency)
+            if error:
+                stats["errors"] += 1
+            for i, bucket in enumerate(ARCHIPEL_HOOK_LATENCY_BUCKETS):
+                if latency <= bucket:
+                    stats["histogram"][i] += 1
+                    break
+            else:
+                stats["histogram"][-1] += 1
+
+    def _record_hook_timeout(self, hookname, method):
+        with self.hooks_lock:
+            self._hook_method_stats(hookname, method)["timeouts"] += 1
+
+    def _hook_method_stats(self, hookname, method):
+        owner = getattr(method, "im_class", None)
+        if owner:
+            owner = owner.__name__
+        else:
+            owner = getattr(method, "__module__", None)
+        key = "%s:%s.%s" % (hookname, owner, method.__name__)
+        if not key in self.hooks_stats:
+            self.hooks_stats[key] = {"count": 0, "errors": 0, "timeouts": 0, "total": 0.0, "max": 0.0,
+                                     "histogram": [0] * (len(ARCHIPEL_HOOK_LATENCY_BUCKETS) + 1)}
+        return self.hooks_stats[key]
+
+    def get_hooks_stats(self):
+        """
+        Return the latency statistics of the hook methods. The histogram
+        gives the number of runs for each bucket of ARCHIPEL_HOOK_LATENCY_BUCKETS
+        (upper bounds, in seconds), the last one counting the slower runs.
+        @rtype: dict
+        @return: dict of "hookname:class.method" -> dict containing count, errors, timeouts, total, max and histogram
+        """
+        with self.hooks_lock:
+            ret = {}
+            for key, stats in self.hooks_stats.items():
+                ret[key] = dict(stats, histogram=list(stats["histogram"]))
+            ret["pool"] = self.hooks_pool.get_stats()
+            return ret
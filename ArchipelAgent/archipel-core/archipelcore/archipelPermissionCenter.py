@@ -20,13 +20,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, create_engine
+import threading
+
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, ForeignKeyConstraint, create_engine
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, backref
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.pool import QueuePool
 
 Base = declarative_base()
+SharedBase = declarative_base()
 
 
 users_have_permissions = Table('users_have_permissions', Base.metadata,
@@ -63,6 +67,50 @@ class TNArchipelPermission (Base):
         return "<TNArchipelPermission('%s', '%s', '%s')>" % (self.name, self.description, self.defaultValue)
 
 
+entities_users_have_permissions = Table('entities_users_have_permissions', SharedBase.metadata,
+    Column('entity', String),
+    Column('user', String),
+    Column('permission', String),
+    ForeignKeyConstraint(['entity', 'user'], ['entities_users.entity', 'entities_users.name']),
+    ForeignKeyConstraint(['entity', 'permission'], ['entities_permissions.entity', 'entities_permissions.name'])
+)
+
+
+class TNArchipelScopedUser (SharedBase):
+    __tablename__ = 'entities_users'
+
+    entity = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+    permissions = relationship('TNArchipelScopedPermission', secondary=entities_users_have_permissions,
+        primaryjoin="and_(TNArchipelScopedUser.entity == foreign(entities_users_have_permissions.c.entity), TNArchipelScopedUser.name == foreign(entities_users_have_permissions.c.user))",
+        secondaryjoin="and_(TNArchipelScopedPermission.entity == entities_users_have_permissions.c.entity, TNArchipelScopedPermission.name == foreign(entities_users_have_permissions.c.permission))",
+        backref=backref('users', lazy='dynamic'))
+
+    def __init__(self, entity, name):
+        self.entity = entity
+        self.name = name
+
+    def __repr__(self):
+        return "<TNArchipelScopedUser('%s', '%s')>" % (self.entity, self.name)
+
+class TNArchipelScopedPermission (SharedBase):
+    __tablename__ = 'entities_permissions'
+
+    entity = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+    description = Column(String)
+    defaultValue = Column(Integer)
+
+    def __init__(self, entity, name, description, default_value):
+        self.entity = entity
+        self.name = name
+        self.description = description
+        self.defaultValue = default_value
+
+    def __repr__(self):
+        return "<TNArchipelScopedPermission('%s', '%s', '%s', '%s')>" % (self.entity, self.name, self.description, self.defaultValue)
+
+
 class TNArchipelPermissionCenter:
 
     def __init__(self, database_file, root_admins):
@@ -79,6 +127,7 @@ class TNArchipelPermissionCenter:
         self.metadata = Base.metadata
         self.metadata.create_all(self.engine)
         self.session = sessionmaker(bind=self.engine)
+        self.init_cache()
 
     def create_session(self):
         """
@@ -88,6 +137,189 @@ class TNArchipelPermissionCenter:
         """
         return self.session()
 
+    def query_permissions(self, session):
+        """
+        Return the base query on permissions.
+        @type session: Session
+        @param session: the session to use
+        @rtype: Query
+        @return: the query
+        """
+        return session.query(TNArchipelPermission)
+
+    def query_users(self, session):
+        """
+        Return the base query on users.
+        @type session: Session
+        @param session: the session to use
+        @rtype: Query
+        @return: the query
+        """
+        return session.query(TNArchipelUser)
+
+    def new_permission(self, name, description, default_value):
+        """
+        Instanciate a new permission object.
+        @rtype: L{TNArchipelPermission}
+        @return: the new permission
+        """
+        return TNArchipelPermission(name, description, default_value)
+
+    def new_user(self, name):
+        """
+        Instanciate a new user object.
+        @rtype: L{TNArchipelUser}
+        @return: the new user
+        """
+        return TNArchipelUser(name)
+
+    def permission_row(self, name, description, default_value):
+        """
+        Return the values of a permission row, used for bulk insertion.
+        @rtype: tuple
+        @return: the table and the dict of column values
+        """
+        return (TNArchipelPermission.__table__, {"name": name, "description": description, "defaultValue": default_value})
+
+
+    ### Cache management
+
+    def init_cache(self):
+        """
+        Initialize the cache counters and load the index.
+        """
+        self.cache_lock = threading.RLock()
+        self.cache_loaded = False
+        self.cache_users = {}
+        self.cache_permissions = {}
+        self.cache_loads = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_generation = 0
+        self.load_cache()
+
+    def load_cache(self):
+        """
+        Load the whole user -> permissions and permission -> default value
+        index from the database. The index is then kept up to date by every
+        write method of the permission center.
+        """
+        with self.cache_lock:
+            session = self.create_session()
+            permissions = {}
+            users = {}
+            for p in self.query_permissions(session).all():
+                permissions[p.name] = p.defaultValue
+            for u in self.query_users(session).all():
+                users[u.name] = set([p.name for p in u.permissions])
+            session.close()
+            self.cache_permissions = permissions
+            self.cache_users = users
+            self.cache_loaded = True
+            self.cache_loads += 1
+            self.cache_generation += 1
+
+    def invalidate_cache(self):
+        """
+        Drop the in-memory index. It will be reloaded from the database
+        on next permission check.
+        """
+        with self.cache_lock:
+            self.cache_loaded = False
+            self.cache_users = {}
+            self.cache_permissions = {}
+            self.cache_generation += 1
+
+    def get_permission_set_key(self, user_name):
+        """
+        Return a key identifying the permission set of the user. Users with
+        the same key get the same results from L{check_permission} until the
+        cache generation changes.
+        @type user_name: string
+        @param user_name: the name of the user
+        @rtype: tuple
+        @return: the key of the permission set of the user
+        """
+        if user_name in self.root_admins:
+            return ("root",)
+        if not self.cache_loaded:
+            self.load_cache()
+        user_permissions = self.cache_users.get(user_name)
+        if user_permissions is None:
+            return ("default",)
+        return ("user", frozenset(user_permissions))
+
+    def get_cache_stats(self):
+        """
+        Return the statistics of the permission cache. A permission check is
+        a hit when both the user and the permission are in the cache.
+        @rtype: dict
+        @return: dict containing the number of hits, misses and loads from the database, of users and of permissions, and the cache generation
+        """
+        with self.cache_lock:
+            return {"hits": self.cache_hits,
+                    "misses": self.cache_misses,
+                    "loads": self.cache_loads,
+                    "users": len(self.cache_users),
+                    "permissions": len(self.cache_permissions),
+                    "generation": self.cache_generation}
+
+    def _cache_set_permission(self, name, default_value):
+        """
+        Write-through update of the index after a permission creation.
+        """
+        with self.cache_lock:
+            if self.cache_loaded:
+                self.cache_permissions[name] = default_value
+            self.cache_generation += 1
+
+    def _cache_remove_permission(self, name):
+        """
+        Write-through update of the index after a permission deletion.
+        """
+        with self.cache_lock:
+            if self.cache_loaded:
+                self.cache_permissions.pop(name, None)
+                for permissions in self.cache_users.values():
+                    permissions.discard(name)
+            self.cache_generation += 1
+
+    def _cache_set_user(self, name):
+        """
+        Write-through update of the index after a user creation.
+        """
+        with self.cache_lock:
+            if self.cache_loaded and not name in self.cache_users:
+                self.cache_users[name] = set()
+            self.cache_generation += 1
+
+    def _cache_remove_user(self, name):
+        """
+        Write-through update of the index after a user deletion.
+        """
+        with self.cache_lock:
+            if self.cache_loaded:
+                self.cache_users.pop(name, None)
+            self.cache_generation += 1
+
+    def _cache_grant(self, permission_name, user_name):
+        """
+        Write-through update of the index after a grant.
+        """
+        with self.cache_lock:
+            if self.cache_loaded:
+                self.cache_users.setdefault(user_name, set()).add(permission_name)
+            self.cache_generation += 1
+
+    def _cache_revoke(self, permission_name, user_name):
+        """
+        Write-through update of the index after a revocation.
+        """
+        with self.cache_lock:
+            if self.cache_loaded and user_name in self.cache_users:
+                self.cache_users[user_name].discard(permission_name)
+            self.cache_generation += 1
+
 
     ### Permission management
 
@@ -103,17 +335,53 @@ class TNArchipelPermissionCenter:
         @rtype: Boolean
         @return: True in case of success
         """
+        if self.cache_loaded and name in self.cache_permissions:
+            return False
         try:
             if currentsession: session = currentsession
             else: session = self.create_session()
-            p = TNArchipelPermission(name, description, default_permission)
+            p = self.new_permission(name, description, default_permission)
             session.add(p)
             session.commit()
             if not currentsession: session.close()
+            self._cache_set_permission(name, default_permission)
             return True
         except IntegrityError:
             return False
 
+    def create_permissions(self, permissions, currentsession=None):
+        """
+        Create several permissions in a single transaction. Already
+        existing permissions are ignored.
+        The permissions use the following form:
+            [   {"name": "perm1", "description": "the description of perm1", "default": False},
+                {"name": "perm2", "description": "the description of perm2", "default": True}]
+        @type permissions: array
+        @param permissions: the list of permissions to create
+        @rtype: int
+        @return: the number of new permissions
+        """
+        table = None
+        rows = []
+        defaults = {}
+        for perm in permissions:
+            name = perm["name"]
+            if name in defaults or (self.cache_loaded and name in self.cache_permissions):
+                continue
+            defaults[name] = perm.get("default", False)
+            table, row = self.permission_row(name, perm.get("description", ""), defaults[name])
+            rows.append(row)
+        if not rows:
+            return 0
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        session.execute(table.insert().prefix_with("OR IGNORE"), rows)
+        session.commit()
+        if not currentsession: session.close()
+        for name, default_value in defaults.items():
+            self._cache_set_permission(name, default_value)
+        return len(rows)
+
     def get_permission(self, name, currentsession=None):
         """
         Get the permission by name.
@@ -125,7 +393,7 @@ class TNArchipelPermissionCenter:
         try:
             if currentsession: session = currentsession
             else: session = self.create_session()
-            p = session.query(TNArchipelPermission).filter(TNArchipelPermission.name == name).one()
+            p = self.query_permissions(session).filter_by(name=name).one()
             if not currentsession: session.close()
             return p
         except NoResultFound:
@@ -146,6 +414,7 @@ class TNArchipelPermissionCenter:
             session.delete(p)
             session.commit()
             if not currentsession: session.close()
+            self._cache_remove_permission(name)
             return True
         except NoResultFound:
             return False
@@ -157,7 +426,7 @@ class TNArchipelPermissionCenter:
         """
         if currentsession: session = currentsession
         else: session = self.create_session()
-        permissions = session.query(TNArchipelPermission).all()
+        permissions = self.query_permissions(session).all()
         if not currentsession: session.close()
         return permissions
 
@@ -175,10 +444,11 @@ class TNArchipelPermissionCenter:
         try:
             if currentsession: session = currentsession
             else: session = self.create_session()
-            u = TNArchipelUser(name)
+            u = self.new_user(name)
             session.add(u)
             session.commit()
             if not currentsession: session.close()
+            self._cache_set_user(name)
             return u
         except IntegrityError:
             return None
@@ -194,7 +464,7 @@ class TNArchipelPermissionCenter:
         try:
             if currentsession: session = currentsession
             else: session = self.create_session()
-            u = session.query(TNArchipelUser).filter(TNArchipelUser.name == name).one()
+            u = self.query_users(session).filter_by(name=name).one()
             if not currentsession: session.close()
             return u
         except NoResultFound:
@@ -211,10 +481,11 @@ class TNArchipelPermissionCenter:
         try:
             if currentsession: session = currentsession
             else: session = self.create_session()
-            u = session.query(TNArchipelUser).filter(TNArchipelUser.name == name).one()
+            u = self.query_users(session).filter_by(name=name).one()
             session.delete(u)
             session.commit()
             if not currentsession: session.close()
+            self._cache_remove_user(name)
             return True
         except NoResultFound:
             return False
@@ -239,6 +510,8 @@ class TNArchipelPermissionCenter:
             u.permissions.append(p)
             session.commit()
         if not currentsession: session.close()
+        if p:
+            self._cache_grant(permission_name, user_name)
         return True
 
     def revoke_permission_to_user(self, permission_name, user_name, currentsession=None):
@@ -262,6 +535,7 @@ class TNArchipelPermissionCenter:
         u.permissions.remove(p)
         session.commit()
         if not currentsession: session.close()
+        self._cache_revoke(permission_name, user_name)
         return True
 
     def user_has_permission(self, user_name, permission_name, currentsession=None):
@@ -316,21 +590,24 @@ class TNArchipelPermissionCenter:
         @rtype: Boolean
         @return: True in case of success
         """
-        permObject = self.get_permission(permission_name)
         if user_name in self.root_admins:
             return True
-        if self.user_has_permission(user_name, "all"):
-            return True
-        if not self.get_user(user_name):
-            if permObject and permObject.defaultValue == 1:
-                return True
+        with self.cache_lock:
+            if not self.cache_loaded:
+                self.load_cache()
+            user_permissions = self.cache_users.get(user_name)
+            known_permission = permission_name in self.cache_permissions
+            if user_permissions is None or not known_permission:
+                self.cache_misses += 1
             else:
+                self.cache_hits += 1
+            if user_permissions is None:
+                return self.cache_permissions.get(permission_name) == 1
+            if "all" in user_permissions:
+                return True
+            if not known_permission:
                 return False
-        if not permObject:
-            return False
-        if self.user_has_permission(user_name, permission_name):
-            return True
-        return False
+            return permission_name in user_permissions
 
     def check_permissions(self, user_name, permissions):
         """
@@ -354,4 +631,176 @@ class TNArchipelPermissionCenter:
         self.session.close_all()
         self.engine.dispose()
         del self.session
-        del self.engine
\ No newline at end of file
+        del self.engine
+
+
+class TNArchipelScopedPermissionCenter (TNArchipelPermissionCenter):
+    """
+    A permission center storing its data in a L{TNArchipelSharedPermissionStore}.
+    It exposes the same API as L{TNArchipelPermissionCenter}, but every
+    permission and user is scoped to the given entity.
+    """
+
+    def __init__(self, store, entity, root_admins):
+        """
+        Initialize the scoped permission center.
+        @type store: L{TNArchipelSharedPermissionStore}
+        @param store: the shared store
+        @type entity: string
+        @param entity: the identifier of the entity owning the permissions
+        @type root_admins: array
+        @param root_admins: the root users JID
+        """
+        self.root_admins = root_admins
+        self.store = store
+        self.entity = entity
+        self.engine = store.engine
+        self.metadata = store.metadata
+        self.session = store.session
+        self.init_cache()
+
+    def query_permissions(self, session):
+        """
+        Return the base query on permissions of the entity.
+        """
+        return session.query(TNArchipelScopedPermission).filter_by(entity=self.entity)
+
+    def query_users(self, session):
+        """
+        Return the base query on users of the entity.
+        """
+        return session.query(TNArchipelScopedUser).filter_by(entity=self.entity)
+
+    def new_permission(self, name, description, default_value):
+        """
+        Instanciate a new permission object for the entity.
+        """
+        return TNArchipelScopedPermission(self.entity, name, description, default_value)
+
+    def new_user(self, name):
+        """
+        Instanciate a new user object for the entity.
+        """
+        return TNArchipelScopedUser(self.entity, name)
+
+    def permission_row(self, name, description, default_value):
+        """
+        Return the values of a permission row of the entity.
+        """
+        return (TNArchipelScopedPermission.__table__, {"entity": self.entity, "name": name, "description": description, "defaultValue": default_value})
+
+    def close_database(self):
+        """
+        The connection pool belongs to the store, so only drop the cache.
+        """
+        self.invalidate_cache()
+
+    def delete_database(self):
+        """
+        Remove all the permissions and users of the entity from the store.
+        """
+        self.store.remove_entity(self.entity)
+        self.invalidate_cache()
+
+
+class TNArchipelSharedPermissionStore:
+    """
+    A single permission database shared by several entities. It owns one
+    engine and one connection pool, and gives to each entity a
+    L{TNArchipelScopedPermissionCenter}.
+    """
+
+    def __init__(self, database_file, pool_size=5):
+        """
+        Initialize the shared permission store.
+        @type database_file: string
+        @param database_file: the path to the db file
+        @type pool_size: int
+        @param pool_size: the size of the connection pool
+        """
+        connection_string = 'sqlite:///%s' % database_file
+        self.engine = create_engine(connection_string, poolclass=QueuePool, pool_size=pool_size, connect_args={"check_same_thread": False, "timeout": 30})
+        self.metadata = SharedBase.metadata
+        self.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)
+
+    def get_permission_center(self, entity, root_admins):
+        """
+        Return a permission center scoped to the given entity.
+        @type entity: string
+        @param entity: the identifier of the entity
+        @type root_admins: array
+        @param root_admins: the root users JID
+        @rtype: L{TNArchipelScopedPermissionCenter}
+        @return: the scoped permission center
+        """
+        return TNArchipelScopedPermissionCenter(self, entity, root_admins)
+
+    def remove_entity(self, entity):
+        """
+        Delete all permissions, users and grants of the given entity.
+        @type entity: string
+        @param entity: the identifier of the entity
+        """
+        users = TNArchipelScopedUser.__table__
+        permissions = TNArchipelScopedPermission.__table__
+        connection = self.engine.connect()
+        transaction = connection.begin()
+        connection.execute(entities_users_have_permissions.delete().where(entities_users_have_permissions.c.entity == entity))
+        connection.execute(users.delete().where(users.c.entity == entity))
+        connection.execute(permissions.delete().where(permissions.c.entity == entity))
+        transaction.commit()
+        connection.close()
+
+    def import_database_file(self, entity, database_file):
+        """
+        Import the content of a legacy per entity permission database into
+        the store, in a single transaction. Already existing rows are kept.
+        @type entity: string
+        @param entity: the identifier of the entity
+        @type database_file: string
+        @param database_file: the path of the legacy db file
+        @rtype: int
+        @return: the number of imported grants
+        """
+        legacy = TNArchipelPermissionCenter(database_file, [])
+        descriptions = dict([(p.name, p.description) for p in legacy.get_permissions()])
+        legacy_permissions = legacy.cache_permissions
+        legacy_users = legacy.cache_users
+        legacy.close_database()
+
+        current = self.get_permission_center(entity, [])
+        permission_rows = []
+        user_rows = []
+        grant_rows = []
+        for name, default_value in legacy_permissions.items():
+            if not name in current.cache_permissions:
+                permission_rows.append({"entity": entity, "name": name, "description": descriptions.get(name, ""), "defaultValue": default_value})
+        for user_name, user_permissions in legacy_users.items():
+            current_permissions = current.cache_users.get(user_name)
+            if current_permissions is None:
+                user_rows.append({"entity": entity, "name": user_name})
+                current_permissions = set()
+            for permission_name in user_permissions - current_permissions:
+                grant_rows.append({"entity": entity, "user": user_name, "permission": permission_name})
+
+        connection = self.engine.connect()
+        transaction = connection.begin()
+        if permission_rows:
+            connection.execute(TNArchipelScopedPermission.__table__.insert(), permission_rows)
+        if user_rows:
+            connection.execute(TNArchipelScopedUser.__table__.insert(), user_rows)
+        if grant_rows:
+            connection.execute(entities_users_have_permissions.insert(), grant_rows)
+        transaction.commit()
+        connection.close()
+        return len(grant_rows)
+
+    def close_database(self):
+        """
+        Close the db connection pool.
+        """
+        self.session.close_all()
+        self.engine.dispose()
+        del self.session
+        del self.engine
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# archipelReactor.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains the XMPP reactor. It replaces the main loop of L{TNArchipelEntity}:
+one thread polls the sockets of all registered entities and runs their
+xmpppy dispatcher when data is available. Restarts and reconnection
+backoffs are timers instead of sleeps, so idle entities cost nothing.
+"""
+
+import heapq
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+
+from archipelcore.archipelEntity import ARCHIPEL_XMPP_LOOP_OFF, ARCHIPEL_XMPP_LOOP_ON, ARCHIPEL_XMPP_LOOP_RESTART, ARCHIPEL_XMPP_LOOP_REMOVE_USER
+from archipelcore.utils import log
+
+
+ARCHIPEL_REACTOR_RESTART_DELAY      = 1.0
+ARCHIPEL_REACTOR_RECONNECT_DELAY    = 5.0
+ARCHIPEL_REACTOR_MAX_READS          = 64
+
+if hasattr(select, "epoll"):
+    ARCHIPEL_REACTOR_POLLIN         = select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | select.EPOLLHUP
+else:
+    ARCHIPEL_REACTOR_POLLIN         = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP
+
+
+class TNArchipelReactor (threading.Thread):
+    """
+    Single thread event loop for the XMPP connections of several entities.
+    """
+
+    def __init__(self):
+        """
+        Initialize the reactor.
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        if hasattr(select, "epoll"):
+            self.poller     = select.epoll()
+            self.poll_scale = 1.0
+        else:
+            self.poller     = select.poll()
+            self.poll_scale = 1000.0
+        self.lock           = threading.RLock()
+        self.managed        = set()
+        self.entities       = {}
+        self.fds            = {}
+        self.timers         = []
+        self.timer_counter  = 0
+        self.running        = False
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.poller.register(self.wakeup_read, ARCHIPEL_REACTOR_POLLIN)
+
+    ### Scheduling
+
+    def call_later(self, delay, func, *args):
+        """
+        Schedule a call in the reactor thread.
+        @type delay: float
+        @param delay: the delay in seconds
+        @type func: function
+        @param func: the function to call
+        """
+        self.lock.acquire()
+        try:
+            self.timer_counter += 1
+            heapq.heappush(self.timers, (time.time() + delay, self.timer_counter, func, args))
+        finally:
+            self.lock.release()
+        self.wakeup()
+
+    def call_soon(self, func, *args):
+        """
+        Schedule a call in the reactor thread as soon as possible.
+        @type func: function
+        @param func: the function to call
+        """
+        self.call_later(0, func, *args)
+
+    def wakeup(self):
+        """
+        Interrupt the current poll.
+        """
+        if not threading.currentThread() is self:
+            os.write(self.wakeup_write, "x")
+
+    def _next_timeout(self):
+        self.lock.acquire()
+        try:
+            if not self.timers:
+                return -1
+            return max(0, self.timers[0][0] - time.time()) * self.poll_scale
+        finally:
+            self.lock.release()
+
+    def _run_timers(self):
+        now = time.time()
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                deadline, counter, func, args = heapq.heappop(self.timers)
+            finally:
+                self.lock.release()
+            try:
+                func(*args)
+            except Exception as ex:
+                log.error("REACTOR: exception in scheduled call %s: %s" % (func, ex))
+
+    ### Entities
+
+    def watch(self, entity):
+        """
+        Ask the reactor to look at the loop status of the entity. This must be
+        called when the entity is connected, and each time its loop status
+        is changed from outside of the reactor.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to manage
+        """
+        self.lock.acquire()
+        try:
+            self.managed.add(entity)
+        finally:
+            self.lock.release()
+        self.call_soon(self._manage, entity)
+
+    def _add_fd(self, entity):
+        self._remove_fd(entity)
+        fd = entity.xmppclient.Connection._sock.fileno()
+        self.poller.register(fd, ARCHIPEL_REACTOR_POLLIN)
+        self.fds[fd] = entity
+        self.entities[entity] = fd
+
+    def _remove_fd(self, entity):
+        fd = self.entities.pop(entity, None)
+        if fd is None:
+            return
+        del self.fds[fd]
+        try:
+            self.poller.unregister(fd)
+        except Exception:
+            pass
+
+    def _in_thread(self, entity, func):
+        """
+        Run a blocking operation (connection, unregistration) of the entity
+        in a short lived thread, then manage the entity again.
+        """
+        def run():
+            try:
+                func()
+            except Exception as ex:
+                log.error("REACTOR: exception while running %s for %s: %s" % (func.__name__, entity.jid, ex))
+            self.watch(entity)
+        threading.Thread(target=run).start()
+
+    def _manage(self, entity):
+        """
+        Act according to the loop status of the entity, like
+        L{TNArchipelEntity.loop} does.
+        """
+        status = entity.loop_status
+        if status == ARCHIPEL_XMPP_LOOP_ON:
+            if entity.xmppclient and entity.xmppclient.isConnected():
+                if not entity in self.entities:
+                    self._add_fd(entity)
+                return
+            entity.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+            status = ARCHIPEL_XMPP_LOOP_RESTART
+        self._remove_fd(entity)
+        if status == ARCHIPEL_XMPP_LOOP_RESTART:
+            entity.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_LOOP_STARTED")
+            if entity.xmppclient and entity.xmppclient.isConnected():
+                entity.xmppclient.disconnect()
+            self.call_later(ARCHIPEL_REACTOR_RESTART_DELAY, self._in_thread, entity, entity.connect)
+        elif status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
+            self._in_thread(entity, entity.process_inband_unregistration)
+        elif status == ARCHIPEL_XMPP_LOOP_OFF:
+            self.lock.acquire()
+            try:
+                if not entity in self.managed:
+                    return
+                self.managed.discard(entity)
+            finally:
+                self.lock.release()
+            entity.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_LOOP_STOPPED")
+            if entity.xmppclient and entity.xmppclient.isConnected():
+                entity.xmppclient.disconnect()
+
+    def _process(self, entity):
+        """
+        Process the incoming data of the entity. If data is still buffered
+        after ARCHIPEL_REACTOR_MAX_READS reads, the processing is rescheduled,
+        as buffered TLS data will not make the socket readable again.
+        """
+        try:
+            reads = 0
+            while entity.loop_status == ARCHIPEL_XMPP_LOOP_ON and entity.xmppclient.isConnected():
+                entity.xmppclient.Process(0)
+                if not entity.xmppclient.Connection.pending_data(0):
+                    break
+                reads += 1
+                if reads >= ARCHIPEL_REACTOR_MAX_READS:
+                    self.call_soon(self._process, entity)
+                    break
+        except Exception as ex:
+            self._remove_fd(entity)
+            if str(ex).find('User removed') > -1: # ok, weird.
+                entity.log.info("LOOP EXCEPTION: Account has been removed from server.")
+                entity.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+            elif entity.auto_reconnect:
+                entity.log.error("LOOP EXCEPTION : Disconnected from server. Trying to reconnect in %s seconds." % ARCHIPEL_REACTOR_RECONNECT_DELAY)
+                t, v, tr = sys.exc_info()
+                entity.log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
+                entity.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+                self.call_later(ARCHIPEL_REACTOR_RECONNECT_DELAY, self._manage, entity)
+                return
+            else:
+                entity.log.error("LOOP EXCEPTION : End of loop forced by exception: %s" % str(ex))
+                t, v, tr = sys.exc_info()
+                entity.log.error("TRACEBACK: %s" % traceback.format_exception(t, v, tr))
+                entity.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+        if not entity.loop_status == ARCHIPEL_XMPP_LOOP_ON:
+            self._manage(entity)
+
+    ### Loop
+
+    def run(self):
+        """
+        The reactor loop.
+        """
+        self.running = True
+        while self.running:
+            try:
+                events = self.poller.poll(self._next_timeout())
+            except (IOError, select.error) as ex:
+                if ex.args[0] == 4: # EINTR
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.wakeup_read:
+                    os.read(self.wakeup_read, 4096)
+                    continue
+                entity = self.fds.get(fd)
+                if entity:
+                    self._process(entity)
+            self._run_timers()
+
+    def stop(self):
+        """
+        Stop the reactor.
+        """
+        self.running = False
+        os.write(self.wakeup_write, "x")
+
+    def get_stats(self):
+        """
+        Return the counters of the reactor.
+        @rtype: dict
+        @return: dict containing the number of watched entities and pending timers
+        """
+        return {"entities": len(self.managed), "sockets": len(self.entities), "timers": len(self.timers)}
@@ -97,7 +97,9 @@ class TNRosterQueryableEntity (object):
         """
         Initialize the permissions.
         """
-        self.permission_center.create_permission("roster", "Authorizes users to get the content of my roster", False)
+        self.permission_center.create_permissions([
+            {"name": "roster", "description": "Authorizes users to get the content of my roster", "default": False}
+        ])
 
     def register_handlers(self):
         """
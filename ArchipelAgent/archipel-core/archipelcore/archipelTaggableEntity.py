@@ -19,6 +19,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
 import xmpp
 
 from archipelcore.pubsub import TNPubSubNode
@@ -27,6 +28,203 @@ from archipelcore.utils import build_error_iq
 
 ARCHIPEL_ERROR_CODE_SET_TAGS            = -7
 ARCHIPEL_NS_TAGS                                = "archipel:tags"
+ARCHIPEL_TAGS_NODE                      = "/archipel/tags"
+ARCHIPEL_TAGS_SEPARATOR                 = ";;"
+
+
+class TNArchipelTagStore (object):
+    """
+    Local index of the /archipel/tags pubsub node, shared by all the
+    entities of the process using the same pubsub server. One entity, the
+    hypervisor if possible, owns the store: it loads the node and keeps it
+    up to date from the pubsub notifications. The others only read it.
+    When the owner is disconnected, another entity takes over.
+    """
+
+    def __init__(self):
+        """
+        Initialize the store.
+        """
+        self.lock           = threading.Lock()
+        self.owner          = None
+        self.members        = set()
+        self.loaded         = False
+        self.tags_by_jid    = {}
+        self.jids_by_tag    = {}
+        self.jid_by_item    = {}
+        self.items_by_jid   = {}
+
+    def claim(self, entity):
+        """
+        Register an entity using the store, and make it the owner if there
+        is none, or if the entity is the hypervisor and the owner isn't.
+        @type entity: L{TNTaggableEntity}
+        @param entity: the entity
+        @rtype: tuple
+        @return: (True if the entity is the owner, the previous owner it replaces or None)
+        """
+        with self.lock:
+            self.members.add(entity)
+            previous = None
+            if not self.owner or (self._is_hypervisor(entity) and not self._is_hypervisor(self.owner)):
+                if not self.owner is entity:
+                    previous = self.owner
+                    self.loaded = False
+                self.owner = entity
+            return (self.owner is entity, previous)
+
+    def release(self, entity):
+        """
+        Unregister an entity. If it was the owner, another connected
+        entity, the hypervisor if possible, is chosen to own the store.
+        @type entity: L{TNTaggableEntity}
+        @param entity: the entity
+        @rtype: L{TNTaggableEntity}
+        @return: the new owner if the owner changed, or None
+        """
+        with self.lock:
+            self.members.discard(entity)
+            if not self.owner is entity:
+                return None
+            self.owner = None
+            self.loaded = False
+            for member in self.members:
+                if not member.xmppclient or not member.xmppclient.isConnected():
+                    continue
+                if not self.owner or self._is_hypervisor(member):
+                    self.owner = member
+            return self.owner
+
+    def _is_hypervisor(self, entity):
+        return getattr(entity, "entity_type", None) == "hypervisor"
+
+    def load(self, items):
+        """
+        Rebuild the indexes from the items of the node.
+        @type items: list
+        @param items: the list of pubsub items
+        """
+        with self.lock:
+            self.tags_by_jid    = {}
+            self.jids_by_tag    = {}
+            self.jid_by_item    = {}
+            self.items_by_jid   = {}
+            for item in items:
+                self._update(item)
+            self.loaded = True
+
+    def _update(self, item):
+        tag = item.getTag("tag")
+        if not tag:
+            return
+        self._remove(item.getAttr("id"))
+        jid = tag.getAttr("jid")
+        tags = [t for t in (tag.getAttr("tags") or "").split(ARCHIPEL_TAGS_SEPARATOR) if t]
+        self.jid_by_item[item.getAttr("id")] = jid
+        self.items_by_jid.setdefault(jid, set()).add(item.getAttr("id"))
+        for t in self.tags_by_jid.get(jid, []):
+            self.jids_by_tag[t].discard(jid)
+            if not self.jids_by_tag[t]:
+                del self.jids_by_tag[t]
+        self.tags_by_jid[jid] = tags
+        for t in tags:
+            self.jids_by_tag.setdefault(t, set()).add(jid)
+
+    def _remove(self, item_id):
+        jid = self.jid_by_item.pop(item_id, None)
+        if not jid:
+            return
+        self.items_by_jid[jid].discard(item_id)
+        if self.items_by_jid[jid]:
+            return
+        del self.items_by_jid[jid]
+        for t in self.tags_by_jid.pop(jid, []):
+            self.jids_by_tag[t].discard(jid)
+            if not self.jids_by_tag[t]:
+                del self.jids_by_tag[t]
+
+    def update_item(self, item):
+        """
+        Index a published item.
+        @type item: xmpp.Node
+        @param item: the pubsub item
+        """
+        with self.lock:
+            self._update(item)
+
+    def remove_item(self, item_id):
+        """
+        Forget a retracted item.
+        @type item_id: string
+        @param item_id: the id of the item
+        """
+        with self.lock:
+            self._remove(item_id)
+
+    def on_pubsub_event(self, event):
+        """
+        Update the indexes from a pubsub notification.
+        @type event: xmpp.Message
+        @param event: the pubsub event message
+        """
+        items = event.getTag("event").getTag("items")
+        for item in items.getTags("item"):
+            self.update_item(item)
+        for retract in items.getTags("retract"):
+            self.remove_item(retract.getAttr("id"))
+
+    def get_tags(self, jid):
+        """
+        Return the tags of an entity.
+        @type jid: string
+        @param jid: the bare JID of the entity
+        @rtype: list
+        @return: the list of tags
+        """
+        with self.lock:
+            return list(self.tags_by_jid.get(jid, []))
+
+    def get_entities(self, tag):
+        """
+        Return the entities having a tag.
+        @type tag: string
+        @param tag: the tag
+        @rtype: list
+        @return: the list of bare JIDs
+        """
+        with self.lock:
+            return list(self.jids_by_tag.get(tag, []))
+
+    def get_legacy_item_ids(self, jid):
+        """
+        Return the ids of the items of the entity that don't use its
+        JID as id, as published by older versions.
+        @type jid: string
+        @param jid: the bare JID of the entity
+        @rtype: list
+        @return: the list of item ids, or None if the store is not loaded yet
+        """
+        with self.lock:
+            if not self.loaded:
+                return None
+            return [i for i in self.items_by_jid.get(jid, []) if not i == jid]
+
+
+tag_stores = {}
+tag_stores_lock = threading.Lock()
+
+def get_tag_store(pubsubserver):
+    """
+    Return the tag store of the given pubsub server.
+    @type pubsubserver: string
+    @param pubsubserver: the JID of the pubsub server
+    @rtype: L{TNArchipelTagStore}
+    @return: the shared tag store
+    """
+    with tag_stores_lock:
+        if not pubsubserver in tag_stores:
+            tag_stores[pubsubserver] = TNArchipelTagStore()
+        return tag_stores[pubsubserver]
 
 
 class TNTaggableEntity (object):
@@ -49,6 +247,7 @@ class TNTaggableEntity (object):
         @param log: the logger of the entity
         """
         self.pubSubNodeTags     = None
+        self.tag_store          = get_tag_store(pubsubserver)
         self.pubsubserver       = pubsubserver
         self.xmppclient         = xmppclient
         self.permission_center  = permission_center
@@ -88,22 +287,63 @@ class TNTaggableEntity (object):
 
     ### Pubsub
 
-    def recover_pubsubs(self, origin, user_info, arguments):
+    def recover_pubsubs(self, origin, user_info, arguments, callback=None):
         """
-        Get the global tag pubsub node.
+        Get the global tag pubsub node. Only the entity owning the tag store
+        retrieves all the items and subscribes to the node. The others only
+        check it exists, as they publish their tags with their JID as item id.
         Arguments here are used to be HOOK compliant see register_hook of L{TNHookableEntity}
+        @type callback: function
+        @param callback: if not None, callback(success) will be called when the node is recovered
         """
         # getting the tags pubsub node
-        tagsNodeName = "/archipel/tags"
-        self.pubSubNodeTags = TNPubSubNode(self.xmppclient, self.pubsubserver, tagsNodeName)
-        if not self.pubSubNodeTags.recover(wait=True):
-            Exception("The pubsub node /archipel/tags must have been created. You can use archipel-tagnode tool to create it.")
+        self.pubSubNodeTags = TNPubSubNode(self.xmppclient, self.pubsubserver, ARCHIPEL_TAGS_NODE, page_size=self.pubsub_page_size)
+        owner, previous = self.tag_store.claim(self)
+        if previous:
+            previous.log.info("TAGS: %s now owns the tag store." % self.jid)
+            previous.pubSubNodeTags.unsubscribe(previous.jid.getStripped())
+        self.recover_tags_node(owner, callback)
+
+    def recover_tags_node(self, owner, callback=None):
+        """
+        Recover the tag pubsub node. If the entity owns the tag store, the
+        store is loaded from the node items and the entity subscribes to it.
+        @type owner: Boolean
+        @param owner: True if the entity owns the tag store
+        @type callback: function
+        @param callback: if not None, callback(success) will be called when the node is recovered
+        """
+        def did_recover(success):
+            if not success:
+                self.log.error("The pubsub node /archipel/tags must have been created. You can use archipel-tagnode tool to create it.")
+            elif owner and self.tag_store.owner is self:
+                self.tag_store.load(self.pubSubNodeTags.get_items())
+                self.pubSubNodeTags.subscribe(self.jid.getStripped(), self.tag_store.on_pubsub_event)
+            if callback:
+                callback(success)
+        if owner:
+            self.pubSubNodeTags.recover(callback=did_recover)
+        else:
+            self.pubSubNodeTags.recover(max_items=1, callback=did_recover)
+
+    def release_tag_store(self, origin=None, user_info=None, arguments=None):
+        """
+        Stop using the tag store, when the entity is disconnected. If it
+        owned the store, the new owner loads the node and subscribes to it.
+        Arguments here are used to be HOOK compliant see register_hook of L{TNHookableEntity}
+        """
+        successor = self.tag_store.release(self)
+        if successor:
+            self.log.info("TAGS: giving the tag store to %s." % successor.jid)
+            successor.recover_tags_node(True)
 
     def init_permissions(self):
         """
         Initialize the tag permissions.
         """
-        self.permission_center.create_permission("settags", "Authorizes users to modify entity's tags", False)
+        self.permission_center.create_permissions([
+            {"name": "settags", "description": "Authorizes users to modify entity's tags", "default": False}
+        ])
 
     def register_handlers(self):
         """
@@ -142,26 +382,44 @@ class TNTaggableEntity (object):
         @type tags: string
         @param tags: the string containing tags separated by ';;'
         """
-        current_id = None
-        for item in self.pubSubNodeTags.get_items():
-            if item.getTag("tag") and item.getTag("tag").getAttr("jid") == self.jid.getStripped():
-                current_id = item.getAttr("id")
-        if current_id:
-            self.pubSubNodeTags.remove_item(current_id, callback=self.did_clean_old_tags, user_info=tags)
-        else:
-            tagNode = xmpp.Node(tag="tag", attrs={"jid": self.jid.getStripped(), "tags": tags})
-            self.pubSubNodeTags.add_item(tagNode)
+        jid = self.jid.getStripped()
+        # legacy items are only known once the owner has loaded the node.
+        # If it's not done yet, they will be removed by the next update
+        legacy_ids = self.tag_store.get_legacy_item_ids(jid)
+        if legacy_ids:
+            self.pubSubNodeTags.remove_items(legacy_ids)
+        # the item id is the JID, so the server replaces the previous tags
+        tagNode = xmpp.Node(tag="tag", attrs={"jid": jid, "tags": tags})
+        self.pubSubNodeTags.add_item(tagNode, callback=self.did_set_tags, item_id=jid)
 
-    def did_clean_old_tags(self, resp, user_info):
+    def did_set_tags(self, resp):
         """
-        Callback called when old tags has been removed if any.
-        @raise Exception: Exception if not implemented
+        Callback called when the tags have been published.
         """
-        if resp.getType() == "result":
-            tagNode = xmpp.Node(tag="tag", attrs={"jid": self.jid.getStripped(), "tags": user_info})
-            self.pubSubNodeTags.add_item(tagNode)
-        else:
-            raise Exception("Tags unable to set tags. answer is: " + str(resp))
+        if not resp.getType() == "result":
+            self.log.error("Tags unable to set tags. answer is: %s", resp)
+            return
+        item = self.pubSubNodeTags.get_item(self.jid.getStripped())
+        if item is not None:
+            self.tag_store.update_item(item)
+
+    def get_tags(self):
+        """
+        Return the tags of the current entity, according to the tag store.
+        @rtype: list
+        @return: the list of tags
+        """
+        return self.tag_store.get_tags(self.jid.getStripped())
+
+    def get_entities_with_tag(self, tag):
+        """
+        Return the entities having the given tag, according to the tag store.
+        @type tag: string
+        @param tag: the tag
+        @rtype: list
+        @return: the list of bare JIDs
+        """
+        return self.tag_store.get_entities(tag)
 
     def iq_set_tags(self, iq):
         """
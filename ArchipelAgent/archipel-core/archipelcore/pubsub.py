@@ -57,10 +57,73 @@ XMPP_PUBSUB_VAR_SEND_LAST_PUBLISHED_ITEM_ON_SUB_PRESENCE    = "on_sub_and_presen
 XMPP_PUBSUB_VAR_ITEM_REPLY_OWNER                            = "owner"
 XMPP_PUBSUB_VAR_ITEM_REPLY_PUBLISHER                        = "publisher"
 
+XMPP_NS_RSM                                                 = "http://jabber.org/protocol/rsm"
+
+
+def _normalize_option(value):
+    """
+    Normalize a node configuration value, so booleans sent as 1/0
+    match the true/false returned by some servers.
+    """
+    value = str(value).lower()
+    return {"true": "1", "false": "0"}.get(value, value)
+
+
+class TNPubSubBatch:
+    """
+    Collect the responses of several pipelined IQs and call the callback
+    once, when all of them have been received.
+    """
+
+    def __init__(self, size, callback, user_info=None, with_user_info=False):
+        """
+        Initialize the batch.
+        @type size: int
+        @param size: the number of expected responses
+        @type callback: function
+        @param callback: the function to call with the list of responses, in sending order
+        @type user_info: object
+        @param user_info: random info to pass to the callback
+        @type with_user_info: Boolean
+        @param with_user_info: if True, user_info is given to the callback as second argument
+        """
+        self.responses      = [None] * size
+        self.remaining      = size
+        self.callback       = callback
+        self.user_info      = user_info
+        self.with_user_info = with_user_info
+        if not size:
+            self._done()
+
+    def did_receive(self, index, response):
+        """
+        Store the response of the IQ at given index.
+        """
+        self.responses[index] = response
+        self.remaining -= 1
+        if self.remaining == 0:
+            self._done()
+
+    def _done(self):
+        if not self.callback:
+            return
+        if self.with_user_info:
+            self.callback(self.responses, self.user_info)
+        else:
+            self.callback(self.responses)
+
+    def failures(self):
+        """
+        Return the responses that are not results.
+        @rtype: list
+        @return: list of xmpp.Iq
+        """
+        return [r for r in self.responses if r and not r.getType() == "result"]
+
 
 class TNPubSubNode:
 
-    def __init__(self, xmppclient, pubsubserver, nodename):
+    def __init__(self, xmppclient, pubsubserver, nodename, page_size=0, max_items=0):
         """
         Initialize the TNPubSubNode.
         @type xmppclient: xmpp.Dispatcher
@@ -69,64 +132,144 @@ class TNPubSubNode:
         @param xmppclient: the string containing the JID of the pubsub server
         @type nodename: string
         @param nodename: the name of the pubsub node
+        @type page_size: int
+        @param page_size: if not 0, items are retrieved by pages of this size (XEP-0059)
+        @type max_items: int
+        @param max_items: if not 0, only the given number of most recent items are retrieved
         """
         self.xmppclient     = xmppclient
         self.pubsubserver   = pubsubserver
         self.nodename       = nodename
+        self.page_size      = page_size
+        self.max_items      = max_items
         self.recovered      = False
         self.content        = None
+        self.content_by_id  = {}
 
 
     ### Node management
 
-    def recover(self, wait=False):
+    def recover(self, wait=False, max_items=None, callback=None):
         """
         Get the current pubsub node and wait for response. If not already recovered, ask to server.
         @type wait: Boolean
         @param wait: if True, recovering will be blockant (IE, execution interrupted until recovering)
+        @type max_items: int
+        @param max_items: if set, overrides the max_items of the node for this recovery
+        @type callback: function
+        @param callback: if not None and not wait, callback(success) will be called when recovered
         @rtype: Boolean
         @return: True in case of success
         """
         try:
-            return self.retrieve_items(wait=wait)
+            return self.retrieve_items(wait=wait, max_items=max_items, callback=callback)
         except Exception as ex:
             log.error("PUBSUB: can't get node %s : %s" % (self.nodename, str(ex)))
+            if callback and not wait:
+                callback(False)
             return False
 
-    def retrieve_items(self, wait=False):
+    def retrieve_items(self, wait=False, max_items=None, callback=None):
         """
-        Retrieve or update the content of the node.
+        Retrieve or update the content of the node. If the node has a page size,
+        items are retrieved page by page, each page being asked when the previous
+        one is received. Servers that don't support paging send all the items at once.
         @type wait: Boolean
         @param wait: if True, recovering will be blockant (IE, execution interrupted until recovering)
+        @type max_items: int
+        @param max_items: if set, overrides the max_items of the node for this retrieval
+        @type callback: function
+        @param callback: if not None and not wait, callback(success) will be called when all items are retrieved
         @rtype: Boolean
         @return: True in case of success
         """
-        iq           = xmpp.Iq(typ="get", to=self.pubsubserver)
-        iq_pubsub    = iq.addChild(name='pubsub', namespace="http://jabber.org/protocol/pubsub")
-        iq_pubsub.addChild(name="items", attrs={"node": self.nodename})
+        if max_items is None:
+            max_items = self.max_items
+        items = []
+        iq = self._items_iq(items, None, max_items)
         if wait:
-            resp = self.xmppclient.SendAndWaitForResponse(iq)
-            return self._did_retrieve_items(None, resp)
+            while iq:
+                resp = self.xmppclient.SendAndWaitForResponse(iq)
+                if not resp or not resp.getType() == "result":
+                    return False
+                iq = self._did_retrieve_page(resp, items, max_items)
+            return self._did_retrieve_items(None, items)
         else:
-            self.xmppclient.SendAndCallForResponse(iq, func=self._did_retrieve_items)
+            self.xmppclient.SendAndCallForResponse(iq, func=self._did_retrieve_items_page, args={"items": items, "max_items": max_items, "callback": callback})
             return True
 
-    def _did_retrieve_items(self, conn, resp):
+    def _items_iq(self, items, after, max_items):
         """
-        Callback triggered by retrieve_items.
+        Build the IQ asking for the next items.
         """
-        if resp.getType() == "result":
-            self.content = resp.getTag("pubsub").getTag("items").getTags("item")
-            self.recovered = True
-            return True
-        else:
+        iq           = xmpp.Iq(typ="get", to=self.pubsubserver)
+        iq_pubsub    = iq.addChild(name='pubsub', namespace="http://jabber.org/protocol/pubsub")
+        iq_items     = iq_pubsub.addChild(name="items", attrs={"node": self.nodename})
+        if self.page_size:
+            count = self.page_size
+            if max_items:
+                count = min(count, max_items - len(items))
+            rsm = iq_pubsub.addChild(name="set", namespace=XMPP_NS_RSM)
+            rsm.addChild(name="max").setData(str(count))
+            if after:
+                rsm.addChild(name="after").setData(after)
+        elif max_items:
+            iq_items.setAttr("max_items", max_items)
+        return iq
+
+    def _did_retrieve_page(self, resp, items, max_items):
+        """
+        Store the items of a page and return the IQ asking for the next
+        page, or None if all items have been retrieved.
+        """
+        pubsub = resp.getTag("pubsub")
+        page = pubsub.getTag("items").getTags("item")
+        items.extend(page)
+        if not self.page_size or not page:
+            return None
+        if max_items and len(items) >= max_items:
+            del items[max_items:]
+            return None
+        rsm = pubsub.getTag("set", namespace=XMPP_NS_RSM)
+        if not rsm or not rsm.getTagData("last") or len(page) < self.page_size:
+            return None
+        return self._items_iq(items, rsm.getTagData("last"), max_items)
+
+    def _did_retrieve_items_page(self, conn, resp, items, max_items, callback=None):
+        """
+        Callback triggered by retrieve_items for each page.
+        """
+        if not resp.getType() == "result":
+            if callback:
+                callback(False)
             return False
+        iq = self._did_retrieve_page(resp, items, max_items)
+        if iq:
+            self.xmppclient.SendAndCallForResponse(iq, func=self._did_retrieve_items_page, args={"items": items, "max_items": max_items, "callback": callback})
+            return True
+        ret = self._did_retrieve_items(None, items)
+        if callback:
+            callback(ret)
+        return ret
+
+    def _did_retrieve_items(self, conn, items):
+        """
+        Store the retrieved items.
+        """
+        self.content = items
+        self.content_by_id = {}
+        for item in self.content:
+            self.content_by_id[item.getAttr("id")] = item
+        self.recovered = True
+        return True
 
-    def create(self, wait=False):
+    def create(self, wait=False, callback=None):
         """
         Create node on server if not exists.
         @type wait: Boolean
         @param wait: if True, recovering will be blockant (IE, execution interrupted until recovering)
+        @type callback: function
+        @param callback: if not None and not wait, callback(success) will be called when created
         @rtype: Boolean
         @return: True in case of success
         """
@@ -139,22 +282,27 @@ class TNPubSubNode:
             resp = self.xmppclient.SendAndWaitForResponse(iq)
             return self._did_create(None, resp)
         else:
-            self.xmppclient.SendAndCallForResponse(iq, func=self._did_create)
+            self.xmppclient.SendAndCallForResponse(iq, func=self._did_create, args={"callback": callback})
             return True
 
-    def _did_create(self, conn, resp):
+    def _did_create(self, conn, resp, callback=None):
         """
-        Called after pubsub creation.
+        Called after pubsub creation. A new node is empty, so there
+        is nothing to recover.
         """
+        ret = False
         try:
             if resp.getType() == "result":
                 log.info("PUBSUB: pubsub node %s has been created." % self.nodename)
-                return self.recover(wait=True)
+                self._did_retrieve_items(None, [])
+                ret = True
             else:
                 log.error("PUBSUB: can't create pubsub: %s" % str(resp))
-                return False
         except Exception as ex:
             log.error("PUBSUB: unable to create pubsub node: %s" % str(ex))
+        if callback:
+            callback(ret)
+        return ret
 
     def delete(self, wait=False):
         """
@@ -189,13 +337,15 @@ class TNPubSubNode:
         except Exception as ex:
             log.error("PUBSUB: unable to delete pubsub node: %s" % str(ex))
 
-    def configure(self, options, wait=False):
+    def configure(self, options, wait=False, callback=None):
         """
         Configure the node.
         @type options: dict
         @param options: dictionary containing options: value for the pubsub configuration
         @type wait: Boolean
         @param wait: if True, recovering will be blockant (IE, execution interrupted until recovering)
+        @type callback: function
+        @param callback: if not None and not wait, callback(success) will be called when configured
         @rtype: Boolean
         @return: True in case of success
         """
@@ -217,22 +367,92 @@ class TNPubSubNode:
             resp = self.xmppclient.SendAndWaitForResponse(iq)
             return self._did_configure(None, resp)
         else:
-            self.xmppclient.SendAndCallForResponse(iq, func=self._did_configure)
+            self.xmppclient.SendAndCallForResponse(iq, func=self._did_configure, args={"callback": callback})
             return True
 
-    def _did_configure(self, conn, resp):
+    def _did_configure(self, conn, resp, callback=None):
         """
         Called when node has been configured.
         """
+        ret = False
         try:
             if resp.getType() == "result":
                 log.info("PUBSUB: pubsub node %s has been configured." % self.nodename)
-                return True
+                ret = True
             else:
                 log.error("PUBSUB: can't configure pubsub: %s" % str(resp))
-                return False
         except Exception as ex:
             log.error("PUBSUB: unable to configure pubsub node: %s" % str(ex))
+        if callback:
+            callback(ret)
+        return ret
+
+    def configure_if_needed(self, options, callback=None):
+        """
+        Get the current configuration of the node, and configure it only
+        if it doesn't match the given options.
+        @type options: dict
+        @param options: dictionary containing options: value for the pubsub configuration
+        @type callback: function
+        @param callback: if not None, callback(success) will be called when done
+        """
+        iq = xmpp.Iq(typ="get", to=self.pubsubserver)
+        iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB + "#owner").addChild("configure", attrs={"node": self.nodename})
+        self.xmppclient.SendAndCallForResponse(iq, func=self._did_get_configuration, args={"options": options, "callback": callback})
+
+    def _did_get_configuration(self, conn, resp, options, callback):
+        """
+        Called when the current configuration has been received.
+        """
+        try:
+            if resp.getType() == "result":
+                current = {}
+                for field in resp.getTag("pubsub").getTag("configure").getTag("x").getTags("field"):
+                    current[field.getAttr("var")] = [_normalize_option(v.getData()) for v in field.getTags("value")]
+                for key, value in options.items():
+                    if type(value) == types.ListType:
+                        wanted = [_normalize_option(v) for v in value]
+                    else:
+                        wanted = [_normalize_option(value)]
+                    if not current.get(key) == wanted:
+                        break
+                else:
+                    log.debug("PUBSUB: pubsub node %s is already configured.", self.nodename)
+                    if callback:
+                        callback(True)
+                    return
+        except Exception as ex:
+            log.warning("PUBSUB: unable to read configuration of node %s: %s" % (self.nodename, str(ex)))
+        self.configure(options, callback=callback)
+
+    def recover_or_create(self, options=None, max_items=None, callback=None):
+        """
+        Recover the node, create it if it doesn't exist, then configure it
+        if its configuration doesn't match the given options. Everything is
+        asynchronous, so several nodes can be set up at the same time.
+        @type options: dict
+        @param options: dictionary containing options: value for the pubsub configuration
+        @type max_items: int
+        @param max_items: if set, overrides the max_items of the node for the recovery
+        @type callback: function
+        @param callback: if not None, callback(success) will be called when done
+        """
+        def did_configure(success):
+            if callback:
+                callback(success)
+        def did_create(success):
+            if success and options:
+                self.configure(options, callback=did_configure)
+            else:
+                did_configure(success)
+        def did_recover(success):
+            if not success:
+                self.create(callback=did_create)
+            elif options:
+                self.configure_if_needed(options, callback=did_configure)
+            else:
+                did_configure(True)
+        self.recover(max_items=max_items, callback=did_recover)
 
 
     ### Item management
@@ -245,7 +465,77 @@ class TNPubSubNode:
         """
         return self.content
 
-    def add_item(self, itemcontentnode, callback=None):
+    def get_item(self, item_id):
+        """
+        Return the item with given ID.
+        @type item_id: string
+        @param item_id: the id of the item
+        @rtype: xmpp.Node
+        @return: the item or None
+        """
+        return self.content_by_id.get(item_id)
+
+    def fetch_item(self, item_id, wait=False, callback=None):
+        """
+        Fetch an item from the server according to its ID, and store it
+        in the content of the node.
+        @type item_id: string
+        @param item_id: the id of the item
+        @type wait: Boolean
+        @param wait: if True, fetching will be blockant
+        @type callback: function
+        @param callback: if not None and not wait, callback(item) will be called when received (item is None if not found)
+        @rtype: xmpp.Node
+        @return: the item or None if wait is True
+        """
+        iq           = xmpp.Iq(typ="get", to=self.pubsubserver)
+        iq_pubsub    = iq.addChild(name='pubsub', namespace="http://jabber.org/protocol/pubsub")
+        iq_pubsub.addChild(name="items", attrs={"node": self.nodename}).addChild(name="item", attrs={"id": item_id})
+        if wait:
+            resp = self.xmppclient.SendAndWaitForResponse(iq)
+            return self._did_fetch_item(None, resp, None)
+        self.xmppclient.SendAndCallForResponse(iq, func=self._did_fetch_item, args={"callback": callback})
+
+    def _did_fetch_item(self, conn, resp, callback):
+        """
+        Callback triggered by fetch_item.
+        """
+        item = None
+        if resp and resp.getType() == "result":
+            item = resp.getTag("pubsub").getTag("items").getTag("item")
+        if item is not None:
+            if self.content is None:
+                self.content = []
+            self._forget_item(item.getAttr("id"))
+            self.content.append(item)
+            self.content_by_id[item.getAttr("id")] = item
+        if callback:
+            callback(item)
+        return item
+
+    def _publish_iq(self, itemcontentnode, item_id=None):
+        iq          = xmpp.Iq(typ="set", to=self.pubsubserver)
+        pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
+        publish     = pubsub.addChild("publish", attrs={"node": self.nodename})
+        item        = publish.addChild("item")
+        if item_id:
+            item.setAttr("id", item_id)
+        item.addChild(node=itemcontentnode)
+        return iq, item
+
+    def _retract_iq(self, item_id):
+        iq          = xmpp.Iq(typ="set", to=self.pubsubserver)
+        pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
+        retract     = pubsub.addChild("retract", attrs={"node": self.nodename})
+        retract.addChild("item", attrs={"id": item_id})
+        return iq
+
+    def _forget_item(self, item_id):
+        item = self.content_by_id.pop(item_id, None)
+        if item is not None:
+            self.content.remove(item)
+
+    def add_item(self, itemcontentnode, callback=None, item_id=None):
         """
         Add a leaf item xmpp.node to the node and will trigger callback if any
         on server answer.
@@ -253,14 +543,12 @@ class TNPubSubNode:
         @param itemcontentnode: the node to publish on the pubsub
         @type callback: function
         @param callback: if not None, callback will be called after publication
+        @type item_id: string
+        @param item_id: if set, the id of the item. An existing item with the same id is replaced
         """
         if not self.recovered:
             raise Exception("PUBSUB: can't add item. Node %s doesn't exists." % self.nodename)
-        iq          = xmpp.Iq(typ="set", to=self.pubsubserver)
-        pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
-        publish     = pubsub.addChild("publish", attrs={"node": self.nodename})
-        item        = publish.addChild("item")
-        item.addChild(node=itemcontentnode)
+        iq, item = self._publish_iq(itemcontentnode, item_id)
         self.xmppclient.SendAndCallForResponse(iq, func=self.did_publish_item, args={"callback": callback, "item": item})
 
     def did_publish_item(self, conn, response, callback, item):
@@ -269,11 +557,42 @@ class TNPubSubNode:
         """
         log.debug("PUBSUB: item published is node %s" % self.nodename)
         if response.getType() == "result":
-            item.setAttr("id", response.getTag("pubsub").getTag("publish").getTag("item").getAttr("id"))
+            # servers may send an empty result when the id was given
+            item_id = item.getAttr("id")
+            if response.getTag("pubsub"):
+                item_id = response.getTag("pubsub").getTag("publish").getTag("item").getAttr("id")
+            item.setAttr("id", item_id)
+            self._forget_item(item_id)
             self.content.append(item)
+            self.content_by_id[item_id] = item
         if callback:
             callback(response)
 
+    def add_items(self, itemcontentnodes, callback=None):
+        """
+        Publish several items. The publish IQs are all sent without waiting
+        for the answers, and the callback is called once, with the list of
+        responses, when all of them have been received.
+        @type itemcontentnodes: list
+        @param itemcontentnodes: the list of xmpp.Node to publish on the pubsub
+        @type callback: function
+        @param callback: if not None, callback will be called after publication of all items
+        """
+        if not self.recovered:
+            raise Exception("PUBSUB: can't add items. Node %s doesn't exists." % self.nodename)
+        batch = TNPubSubBatch(len(itemcontentnodes), callback)
+        for index, itemcontentnode in enumerate(itemcontentnodes):
+            iq, item = self._publish_iq(itemcontentnode)
+            self.xmppclient.SendAndCallForResponse(iq, func=self._did_publish_batch_item, args={"batch": batch, "index": index, "item": item})
+        return batch
+
+    def _did_publish_batch_item(self, conn, response, batch, index, item):
+        """
+        Triggered on response of an item published by add_items.
+        """
+        self.did_publish_item(conn, response, None, item)
+        batch.did_receive(index, response)
+
 
     def remove_item(self, item_id, callback=None, user_info=None):
         """
@@ -285,24 +604,44 @@ class TNPubSubNode:
         @type user_info: Object
         @param user_info: random info to pass to the callback
         """
-        iq          = xmpp.Iq(typ="set", to=self.pubsubserver)
-        pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
-        retract     = pubsub.addChild("retract", attrs={"node": self.nodename})
-        item        = retract.addChild("item", attrs={"id": item_id})
-        for item in self.content:
-            if item.getAttr("id") == item_id:
-                self.content.remove(item)
-                break
+        iq = self._retract_iq(item_id)
+        self._forget_item(item_id)
         self.xmppclient.SendAndCallForResponse(iq, func=self.did_remove_item, args={"callback": callback, "user_info": user_info})
 
     def did_remove_item(self, conn, response, callback, user_info):
         """
         Triggered on response.
         """
-        log.debug("PUBSUB: retract done. Answer is: %s" % str(response))
+        log.debug("PUBSUB: retract done. Answer is: %s", response)
         if callback:
             callback(response, user_info)
 
+    def remove_items(self, item_ids, callback=None, user_info=None):
+        """
+        Remove several items according to their IDs. The retract IQs are all
+        sent without waiting for the answers, and the callback is called once,
+        with the list of responses, when all of them have been received.
+        @type item_ids: list
+        @param item_ids: the ids of the items to remove
+        @type callback: function
+        @param callback: if not None, callback(responses, user_info) will be called after removal of all items
+        @type user_info: Object
+        @param user_info: random info to pass to the callback
+        """
+        batch = TNPubSubBatch(len(item_ids), callback, user_info, with_user_info=True)
+        for index, item_id in enumerate(item_ids):
+            iq = self._retract_iq(item_id)
+            self._forget_item(item_id)
+            self.xmppclient.SendAndCallForResponse(iq, func=self._did_remove_batch_item, args={"batch": batch, "index": index})
+        return batch
+
+    def _did_remove_batch_item(self, conn, response, batch, index):
+        """
+        Triggered on response of an item removed by remove_items.
+        """
+        log.debug("PUBSUB: retract done. Answer is: %s", response)
+        batch.did_receive(index, response)
+
     def subscribe(self, jid, event_callback):
         """
         Subscribe to the node.
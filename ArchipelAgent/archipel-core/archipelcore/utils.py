@@ -26,11 +26,14 @@ functionalities or others common stuffs
 """
 
 import ConfigParser
-import inspect
 import logging
 import logging.handlers
 import os
+import sys
+import threading
+import time
 import xmpp
+from collections import deque, OrderedDict
 
 
 # Namespaces
@@ -42,9 +45,37 @@ ARCHIPEL_LOG_INFO                               = 1
 ARCHIPEL_LOG_WARNING                            = 2
 ARCHIPEL_LOG_ERROR                              = 3
 
+ARCHIPEL_LOG_LEVELS                             = { ARCHIPEL_LOG_DEBUG: logging.DEBUG,
+                                                    ARCHIPEL_LOG_INFO: logging.INFO,
+                                                    ARCHIPEL_LOG_WARNING: logging.WARNING,
+                                                    ARCHIPEL_LOG_ERROR: logging.ERROR }
+
+ARCHIPEL_LOG_PREFIX                             = "\033[33m%s.%s (%s)\033[0m::%s"
+
+ARCHIPEL_LOG_OVERFLOW_DROP_DEBUG_FIRST          = "drop_debug_first"
+ARCHIPEL_LOG_OVERFLOW_DROP_NEWEST               = "drop_newest"
+ARCHIPEL_LOG_OVERFLOW_BLOCK                     = "block"
+
 
 log = logging.getLogger('archipel')
 
+
+class TNArchipelLogMessage (object):
+    """
+    Defer the formatting of a message with its arguments until the
+    logging framework really needs it.
+    """
+
+    __slots__ = ("msg", "args")
+
+    def __init__(self, msg, args):
+        self.msg    = msg
+        self.args   = args
+
+    def __str__(self):
+        return self.msg % self.args
+
+
 class TNArchipelLogger:
     """
     archipel logger implt
@@ -55,36 +86,38 @@ class TNArchipelLogger:
         self.entity     = entity
         self.pubSubNode = pubsubnode
 
-    def __log(self, level, msg):
-        log = logging.getLogger('archipel')
-        msg = "\033[33m%s.%s (%s)\033[0m::%s" % (self.entity.__class__.__name__, inspect.stack()[2][3],  self.entity.jid, msg)
+    def __log(self, level, msg, args):
+        """
+        Log the message if the level is enabled. The caller name is
+        retrieved from the frame stack and the formatting is left
+        to the logging framework.
+        """
         if level < ARCHIPEL_LOG_LEVEL:
             return
-        elif level == ARCHIPEL_LOG_DEBUG:
-            log.debug(msg)
-        elif level == ARCHIPEL_LOG_INFO:
-            log.info(msg)
-        elif level == ARCHIPEL_LOG_WARNING:
-            log.warning(msg)
-        elif level == ARCHIPEL_LOG_ERROR:
-             log.error(msg)
+        logging_level = ARCHIPEL_LOG_LEVELS[level]
+        if not log.isEnabledFor(logging_level):
+            return
+        if args:
+            msg = TNArchipelLogMessage(msg, args)
+        caller = sys._getframe(2).f_code.co_name
+        log.log(logging_level, ARCHIPEL_LOG_PREFIX, self.entity.__class__.__name__, caller, self.entity.jid, msg)
 
         # if self.xmppclient and self.pubSubNode:
         #     log = xmpp.Node(tag="log", attrs={"date": datetime.datetime.now(), "level": str(level)})
         #     log.setData(msg)
         #     self.pubSubNode.add_item(log)
 
-    def debug(self, msg):
-        self.__log(ARCHIPEL_LOG_DEBUG, msg)
+    def debug(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_DEBUG, msg, args)
 
-    def info(self, msg):
-        self.__log(ARCHIPEL_LOG_INFO, msg)
+    def info(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_INFO, msg, args)
 
-    def warning(self, msg):
-        self.__log(ARCHIPEL_LOG_WARNING, msg)
+    def warning(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_WARNING, msg, args)
 
-    def error(self, msg):
-        self.__log(ARCHIPEL_LOG_ERROR, msg)
+    def error(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_ERROR, msg, args)
 
 
 class ColorFormatter (logging.Formatter):
@@ -103,6 +136,227 @@ class ColorFormatter (logging.Formatter):
         return rec
 
 
+class TNArchipelAsyncLogHandler (logging.Handler):
+    """
+    Non blocking log handler. Records are pushed in a bounded in-memory
+    queue and a writer thread drains it, writing them in batches into the
+    target handler (usually a RotatingFileHandler) and flushing once per
+    batch. Rotation is still decided by the target handler, record by record.
+    Debug records are kept in a queue of their own so the oldest one can be
+    evicted in constant time. Both queues hold (sequence, record) tuples and
+    the writer merges them back in emission order.
+    """
+
+    def __init__(self, target, queue_size=10000, batch_size=256, overflow_policy=ARCHIPEL_LOG_OVERFLOW_DROP_DEBUG_FIRST):
+        """
+        Initialize the handler and start the writer thread.
+        @type target: logging.Handler
+        @param target: the handler that will really write the records
+        @type queue_size: integer
+        @param queue_size: max number of records waiting to be written
+        @type batch_size: integer
+        @param batch_size: max number of records written between two flushes
+        @type overflow_policy: string
+        @param overflow_policy: what to do when the queue is full (drop_debug_first, drop_newest or block)
+        """
+        logging.Handler.__init__(self)
+        if not overflow_policy in (ARCHIPEL_LOG_OVERFLOW_DROP_DEBUG_FIRST, ARCHIPEL_LOG_OVERFLOW_DROP_NEWEST, ARCHIPEL_LOG_OVERFLOW_BLOCK):
+            raise Exception("Unknown log overflow policy %s" % overflow_policy)
+        self.target             = target
+        self.queue_size         = max(1, queue_size)
+        self.batch_size         = max(1, batch_size)
+        self.overflow_policy    = overflow_policy
+        self.queue              = deque()
+        self.debug_queue        = deque()
+        self.sequence           = 0
+        self.queue_condition    = threading.Condition(threading.Lock())
+        self.dropped_records    = 0
+        self.dropped_by_level   = {}
+        self.written_records    = 0
+        self.written_batches    = 0
+        self.closing            = False
+        self.writer_thread      = threading.Thread(target=self._writer_loop, name="archipel-log-writer")
+        self.writer_thread.setDaemon(True)
+        self.writer_thread.start()
+
+    def _drop(self, record):
+        """
+        Account a dropped record. Must be called with the queue condition held.
+        @type record: logging.LogRecord
+        @param record: the dropped record
+        """
+        self.dropped_records += 1
+        self.dropped_by_level[record.levelname] = self.dropped_by_level.get(record.levelname, 0) + 1
+
+    def _evict_debug_record(self):
+        """
+        Remove the oldest queued debug record. Must be called with the queue condition held.
+        @rtype: Boolean
+        @return: True if a record has been evicted
+        """
+        if not self.debug_queue:
+            return False
+        self._drop(self.debug_queue.popleft()[1])
+        return True
+
+    def _queued(self):
+        """
+        Return the number of queued records. Must be called with the queue condition held.
+        @rtype: integer
+        @return: the number of queued records
+        """
+        return len(self.queue) + len(self.debug_queue)
+
+    def _pop(self):
+        """
+        Remove and return the oldest queued record. Must be called with the queue condition held.
+        @rtype: logging.LogRecord
+        @return: the oldest record
+        """
+        if not self.debug_queue or (self.queue and self.queue[0][0] < self.debug_queue[0][0]):
+            return self.queue.popleft()[1]
+        return self.debug_queue.popleft()[1]
+
+    def prepare(self, record):
+        """
+        Freeze the record so it can be formatted later in the writer thread:
+        the message is merged with its arguments and the traceback is rendered.
+        @type record: logging.LogRecord
+        @param record: the record to prepare
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        """
+        Queue the record, applying the overflow policy if the queue is full.
+        @type record: logging.LogRecord
+        @param record: the record to queue
+        """
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.queue_condition.acquire()
+        try:
+            if self.closing:
+                self._drop(record)
+                return
+            if self._queued() >= self.queue_size:
+                if self.overflow_policy == ARCHIPEL_LOG_OVERFLOW_BLOCK:
+                    while self._queued() >= self.queue_size and not self.closing:
+                        self.queue_condition.wait()
+                    if self.closing:
+                        self._drop(record)
+                        return
+                elif self.overflow_policy == ARCHIPEL_LOG_OVERFLOW_DROP_DEBUG_FIRST and record.levelno > logging.DEBUG and self._evict_debug_record():
+                    pass
+                else:
+                    self._drop(record)
+                    return
+            self.sequence += 1
+            if record.levelno <= logging.DEBUG:
+                self.debug_queue.append((self.sequence, record))
+            else:
+                self.queue.append((self.sequence, record))
+            self.queue_condition.notifyAll()
+        finally:
+            self.queue_condition.release()
+
+    def _write_batch(self, batch):
+        """
+        Write a batch of records into the target handler and flush it once.
+        @type batch: list
+        @param batch: the records to write
+        """
+        target = self.target
+        target.acquire()
+        try:
+            for record in batch:
+                if not record.levelno >= target.level:
+                    continue
+                try:
+                    if hasattr(target, "shouldRollover") and target.shouldRollover(record):
+                        target.doRollover()
+                    if getattr(target, "stream", None) is None:
+                        target.emit(record)
+                        continue
+                    msg = "%s\n" % target.format(record)
+                    try:
+                        target.stream.write(msg)
+                    except UnicodeError:
+                        target.stream.write(msg.encode("UTF-8"))
+                except Exception:
+                    target.handleError(record)
+            if getattr(target, "stream", None):
+                target.flush()
+        finally:
+            target.release()
+
+    def _writer_loop(self):
+        """
+        Drain the queue until the handler is closed.
+        """
+        while True:
+            self.queue_condition.acquire()
+            try:
+                while not self._queued() and not self.closing:
+                    self.queue_condition.wait()
+                if not self._queued() and self.closing:
+                    return
+                batch = []
+                while self._queued() and len(batch) < self.batch_size:
+                    batch.append(self._pop())
+                self.queue_condition.notifyAll()
+            finally:
+                self.queue_condition.release()
+            self._write_batch(batch)
+            self.queue_condition.acquire()
+            try:
+                self.written_records += len(batch)
+                self.written_batches += 1
+            finally:
+                self.queue_condition.release()
+
+    def get_stats(self):
+        """
+        Return the counters of the handler.
+        @rtype: dict
+        @return: dict containing the number of queued, written and dropped records
+        """
+        self.queue_condition.acquire()
+        try:
+            return {"queued": self._queued(),
+                    "queue_size": self.queue_size,
+                    "written": self.written_records,
+                    "batches": self.written_batches,
+                    "dropped": self.dropped_records,
+                    "dropped_by_level": dict(self.dropped_by_level)}
+        finally:
+            self.queue_condition.release()
+
+    def close(self):
+        """
+        Write the remaining records, stop the writer thread and close the target.
+        """
+        self.queue_condition.acquire()
+        try:
+            self.closing = True
+            self.queue_condition.notifyAll()
+        finally:
+            self.queue_condition.release()
+        if self.writer_thread.isAlive() and not threading.currentThread() is self.writer_thread:
+            self.writer_thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
 def init_conf(path):
     """
     This method intialize the configuration object (that will be passed to all
@@ -133,14 +387,175 @@ def init_conf(path):
     handler         = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
     log_format      = ColorFormatter(conf.get("LOGGING", "logging_formatter", raw=True), conf.get("LOGGING", "logging_date_format", raw=True))
     handler.setFormatter(log_format)
+    if conf.has_option("LOGGING", "logging_async") and conf.getboolean("LOGGING", "logging_async"):
+        queue_size      = 10000
+        batch_size      = 256
+        overflow_policy = ARCHIPEL_LOG_OVERFLOW_DROP_DEBUG_FIRST
+        if conf.has_option("LOGGING", "logging_async_queue_size"):
+            queue_size = conf.getint("LOGGING", "logging_async_queue_size")
+        if conf.has_option("LOGGING", "logging_async_batch_size"):
+            batch_size = conf.getint("LOGGING", "logging_async_batch_size")
+        if conf.has_option("LOGGING", "logging_async_overflow_policy"):
+            overflow_policy = conf.get("LOGGING", "logging_async_overflow_policy")
+        handler = TNArchipelAsyncLogHandler(handler, queue_size=queue_size, batch_size=batch_size, overflow_policy=overflow_policy)
     logger.addHandler(handler)
     logger.setLevel(level)
     return conf
 
+class TNArchipelRateLimiter (object):
+    """
+    Token bucket limiting both the rate and the concurrency of an operation.
+    """
+
+    def __init__(self, rate=0, burst=1, concurrency=0):
+        """
+        Initialize the limiter.
+        @type rate: float
+        @param rate: the number of operations allowed per second (0 means unlimited)
+        @type burst: integer
+        @param burst: the max number of operations that can start at once
+        @type concurrency: integer
+        @param concurrency: the max number of running operations (0 means unlimited)
+        """
+        self.rate           = rate
+        self.burst          = max(1, burst)
+        self.concurrency    = concurrency
+        self.tokens         = float(self.burst)
+        self.last_refill    = time.time()
+        self.running        = 0
+        self.condition      = threading.Condition()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Block until the operation is allowed to start.
+        """
+        self.condition.acquire()
+        try:
+            while True:
+                if not self.concurrency or self.running < self.concurrency:
+                    if not self.rate:
+                        break
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.condition.wait()
+            self.running += 1
+        finally:
+            self.condition.release()
+
+    def release(self):
+        """
+        Notify the end of an operation.
+        """
+        self.condition.acquire()
+        try:
+            self.running -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+
+class TNArchipelCoalescer (object):
+    """
+    Collect keys during a time window and give them to a callback at the
+    end of the window. A key added several times during the same window
+    is given only once, at the position of its last occurrence, so the
+    order of the keys still tells the last state.
+    """
+
+    def __init__(self, window, callback):
+        """
+        Initialize the coalescer.
+        @type window: float
+        @param window: the length of the window in seconds
+        @type callback: function
+        @param callback: the function called with the list of collected keys
+        """
+        self.window     = window
+        self.callback   = callback
+        self.pending    = OrderedDict()
+        self.timer      = None
+        self.lock       = threading.Lock()
+        self.flush_lock = threading.RLock()
+        self.received   = 0
+        self.suppressed = 0
+        self.flushes    = 0
+        self.critical   = 0
+
+    def add(self, key, critical=False):
+        """
+        Add a key to the current window.
+        @type key: object
+        @param key: a hashable key
+        @type critical: boolean
+        @param critical: if True, the window is flushed right away
+        """
+        with self.lock:
+            self.received += 1
+            if key in self.pending:
+                self.suppressed += 1
+                del self.pending[key]
+            self.pending[key] = True
+            if not critical:
+                if not self.timer:
+                    self.timer = threading.Timer(self.window, self.flush)
+                    self.timer.setDaemon(True)
+                    self.timer.start()
+                return
+            self.critical += 1
+        self.flush()
+
+    def flush(self):
+        """
+        Give the collected keys to the callback and start a new window.
+        Flushes are serialized, so the callback gets the windows in order
+        even when a critical flush races the timer.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.pending:
+                    return
+                keys = self.pending.keys()
+                self.pending = OrderedDict()
+                self.flushes += 1
+            try:
+                self.callback(keys)
+            except Exception as ex:
+                log.error("COALESCER: unable to flush %d keys: %s" % (len(keys), str(ex)))
+
+    def get_stats(self):
+        """
+        Return the counters of the coalescer.
+        @rtype: dict
+        @return: dict containing the number of received, suppressed and pending keys, the number of flushes and of critical flushes
+        """
+        return {"received": self.received, "suppressed": self.suppressed, "pending": len(self.pending),
+                "flushes": self.flushes, "critical": self.critical}
+
+
+def get_log_handler_stats():
+    """
+    Return the counters of the asynchronous log handlers of the archipel logger.
+    @rtype: list
+    @return: list of dicts as returned by TNArchipelAsyncLogHandler.get_stats()
+    """
+    return [h.get_stats() for h in log.handlers if isinstance(h, TNArchipelAsyncLogHandler)]
+
 def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
     #traceback.print_exc(file=sys.stdout, limit=20)
-    caller = inspect.stack()[1][3]
-    log.error("%s.%s: exception raised is: %s" % (originclass, caller, ex))
+    caller = sys._getframe(1).f_code.co_name
+    log.error("%s.%s: exception raised is: %s", originclass, caller, ex)
     reply = iq.buildReply('error')
     reply.setQueryPayload(iq.getQueryPayload())
     error = xmpp.Node("error", attrs={"code": code, "type": "cancel"})
@@ -150,6 +565,6 @@ def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
     return reply
 
 def build_error_message(originclass, ex):
-    caller = inspect.stack()[3][3]
-    log.error("%s: exception raised is: %s" % (caller, str(ex)))
+    caller = sys._getframe(3).f_code.co_name
+    log.error("%s: exception raised is: %s", caller, ex)
     return str(ex)
\ No newline at end of file